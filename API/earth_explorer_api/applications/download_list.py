@@ -3,12 +3,17 @@ Download scenes from a given CSV list of scene IDs or product IDs.
 '''
 import argparse
 import csv
+import json
 import os
 import re
-import urllib.request
 from login import login
+from downloader import BATCH_SIZE, Downloader, scene_urls
 
-def main(output_dir, csv_path, scene_ids, dataset, landsat):
+# file in the output directory keeping translated product IDs
+ID_CACHE = 'id_cache.json'
+
+def main(output_dir, csv_path, scene_ids, dataset, landsat, workers=4,
+            per_host=2, batch_size=BATCH_SIZE, id_cache=None):
     '''
     Download scenes from a given list of scene IDs or product IDs.
     INPUTS:
@@ -20,11 +25,23 @@ def main(output_dir, csv_path, scene_ids, dataset, landsat):
         dataset : str : name to identify dataset (if all ids are 
             from the same dataset)
         landsat : bool : if True, IDs in CSV are all from Landsat datasets
+        workers : int : number of scenes downloaded at a time;
+            defaults to 4
+        per_host : int : max number of scenes downloaded at a time
+            from the same host; defaults to 2
+        batch_size : int : number of scenes per request for
+            product ID lookups, download options and URLs;
+            defaults to 100
+        id_cache : str : path to JSON file keeping the scene IDs
+            of product IDs, so they are only looked up once;
+            defaults to id_cache.json in output_dir
     RETURNS:
         tar files downloaded in output_dir
     '''
     # login to EROS account
     api = login()
+    if id_cache is None:
+        id_cache = os.path.join(output_dir, ID_CACHE)
 
     print('Converting CSV to list')
     if scene_ids == True:
@@ -50,7 +67,8 @@ def main(output_dir, csv_path, scene_ids, dataset, landsat):
 
         if dataset == False and landsat == True:
             # assign datasets and scenes to products
-            datasets, scene_ids = assign_datasets_and_scenes(product_ids, api)
+            datasets, scene_ids = assign_datasets_and_scenes(product_ids, api,
+                                                        id_cache, batch_size)
 
         if dataset == False and landsat == False:
             # datasets are unknown but NOT landsat
@@ -58,45 +76,26 @@ def main(output_dir, csv_path, scene_ids, dataset, landsat):
 
         elif dataset == True:
             # csv contains datasets
-            datasets, scene_ids = assign_scenes(product_ids, api)
-
-    # download data
-    os.makedirs(output_dir, exist_ok=True)
-
-    print(scene_ids)
-    print(datasets)
-
-    for i, entity_id in enumerate(scene_ids):
-        print(f'Downloading scene {i+1} of {len(scene_ids)}')
-        
-        dataset = datasets[i]
-        # create output filename
-        filename = os.path.join(output_dir, entity_id)
-
-        # get download code
-        try:
-            download_opts = api.download_options(dataset, entity_id)
-            download_opts_list = download_opts[0]['downloadOptions']
-            if len(download_opts_list) > 1:
-                download_code = 'STANDARD'
-            else:
-                download_code = download_opts_list[0]['downloadCode']
-
-        except Exception:
-            print('No download code found for this scene.')
+            datasets = csv_to_list(csv_path, 'dataset')
+            datasets, scene_ids = assign_scenes(product_ids, datasets, api,
+                                                id_cache, batch_size)
+
+    # group scenes by dataset, leaving out scenes already in output_dir
+    print(f'Downloading {len(scene_ids)} scenes')
+    downloader = Downloader(output_dir, workers, per_host)
+    dataset_scenes = {}
+    for dataset, entity_id in zip(datasets, scene_ids):
+        if downloader.skip(entity_id):
             continue
+        dataset_scenes.setdefault(dataset, []).append(entity_id)
 
-        # get download information
-        response = api.download(dataset, download_code, entity_id)
+    # download data while the URLs of the next batches are requested
+    for dataset, entity_ids in dataset_scenes.items():
+        for entity_id, url, size in scene_urls(api, dataset, entity_ids,
+                                                batch_size=batch_size):
+            downloader.add(entity_id, url, size)
+    downloader.finish()
 
-        if response == []:
-            raise Exception('No dataset matches the inputs provided')
-            continue
-        
-        # download dataset
-        url = response[0]['url']
-        urllib.request.urlretrieve(url, filename)
-        
     # logout of EROS account
     api.logout()
 
@@ -119,51 +118,115 @@ def assign_datasets(scene_ids):
     return datasets, scene_ids_real
 
 
-def assign_datasets_and_scenes(product_ids, api):
+def assign_datasets_and_scenes(product_ids, api, id_cache=None,
+                                batch_size=BATCH_SIZE):
     '''
     Assign datasets and scene IDs to product IDs.
     '''
     datasets = []
-    scene_ids = []
-    for i, product_id in enumerate(product_ids):
-        print(f'Finding scene ID and dataset {i+1} of {len(product_ids)}')
+    product_ids_real = []
+    for product_id in product_ids:
         # find dataset
         dataset = landsat_dataset(product_id, scene_id=False)
         if dataset == '':
             # CSV did not contain an ID
             continue
         datasets.append(dataset)
+        product_ids_real.append(product_id)
 
-        # find scene ID
-        try:
-            scene_id = api.id_lookup(dataset, product_id,
-                                        input_field='displayId')
-        except Exception:
-            print('Invalid product ID')
-            # invalid product ID
-            continue
-        scene_ids.append(scene_id[0])
-    return datasets, scene_ids
+    # find scene IDs
+    return lookup_scene_ids(product_ids_real, datasets, api, id_cache,
+                            batch_size)
 
 
-def assign_scenes(product_ids, api):
+def assign_scenes(product_ids, datasets, api, id_cache=None,
+                    batch_size=BATCH_SIZE):
     '''
     Assign scenes to product IDs with known datasets.
     '''
-    datasets = csv_to_list(csv_path, 'dataset')
-    scene_ids = []
-    for i, product_id in enumerate(product_ids):
-        print(f'Finding scene ID {i+1} of {len(product_ids)}')
-        dataset = datasets[i]
-        try:
-            scene_id = api.id_lookup(dataset, product_id,
-                                        input_field='displayId')
-        except Exception:
-            print('Invalid product ID or dataset')
+    return lookup_scene_ids(product_ids, datasets, api, id_cache, batch_size)
+
+
+def lookup_scene_ids(product_ids, datasets, api, id_cache=None,
+                        batch_size=BATCH_SIZE):
+    '''
+    Translate product IDs to scene IDs, with one id_lookup()
+    request per batch of product IDs of the same dataset.
+    INPUTS:
+        product_ids : list of str : product IDs
+        datasets : list of str : dataset of each product ID
+        api : API : logged in EarthExplorer API
+    OPTIONAL INPUTS:
+        id_cache : str : path to JSON file keeping translated
+            IDs; IDs found in it are not looked up again, and new
+            ones are added to it
+        batch_size : int : number of product IDs per request
+    RETURNS:
+        datasets : list of str : dataset of each scene ID
+        scene_ids : list of str : scene IDs of the product IDs
+            that could be translated
+    '''
+    cache = read_id_cache(id_cache)
+
+    # group product IDs that are not in the cache by dataset
+    missing = {}
+    for dataset, product_id in zip(datasets, product_ids):
+        known = cache.setdefault(dataset, {})
+        if product_id not in known:
+            missing.setdefault(dataset, {})[product_id] = None
+    n_missing = sum(len(ids) for ids in missing.values())
+    print(f'Looking up {n_missing} of {len(product_ids)} product IDs')
+
+    for dataset, dataset_ids in missing.items():
+        dataset_ids = list(dataset_ids)
+        for i in range(0, len(dataset_ids), batch_size):
+            try:
+                found = api.id_lookup(dataset, dataset_ids[i:i + batch_size],
+                                        input_field='displayId', as_dict=True)
+            except Exception as error:
+                # invalid dataset
+                print(f'Could not look up product IDs of {dataset}: {error}')
+                break
+            cache[dataset].update({product_id: scene_id
+                                    for product_id, scene_id in found.items()
+                                    if scene_id})
+            write_id_cache(cache, id_cache)
+
+    scene_ids_real = []
+    datasets_real = []
+    for dataset, product_id in zip(datasets, product_ids):
+        scene_id = cache[dataset].get(product_id)
+        if scene_id is None:
             # invalid product ID or dataset
+            print(f'Invalid product ID or dataset: {product_id}')
             continue
-        scene_ids.append(scene_id[0])
-    return datasets, scene_ids
+        datasets_real.append(dataset)
+        scene_ids_real.append(scene_id)
+    return datasets_real, scene_ids_real
+
+
+def read_id_cache(id_cache):
+    '''
+    Read translated IDs, as {dataset : {product ID : scene ID}};
+    empty if there is no cache (yet).
+    '''
+    if id_cache is None or not os.path.exists(id_cache):
+        return {}
+    with open(id_cache) as f:
+        return json.load(f)
+
+
+def write_id_cache(cache, id_cache):
+    '''
+    Write translated IDs, replacing the cache file at once so an
+    interrupted run does not leave it incomplete.
+    '''
+    if id_cache is None:
+        return
+    os.makedirs(os.path.dirname(os.path.abspath(id_cache)), exist_ok=True)
+    with open(id_cache + '.tmp', 'w') as f:
+        json.dump(cache, f)
+    os.replace(id_cache + '.tmp', id_cache)
 
 
 def csv_to_list(csv_path, header_str):
@@ -245,6 +308,18 @@ if __name__ == '__main__':
             dest='landsat',
             action='store_true',
             help='if flagged, IDs in CSV are all from Landsat datasets')
+    parser.add_argument('--workers',
+            metavar='N', type=int, default=4,
+            help='number of scenes to download at a time; defaults to 4')
+    parser.add_argument('--per_host',
+            metavar='N', type=int, default=2,
+            help='max number of scenes to download at a time from the same host; defaults to 2')
+    parser.add_argument('--batch_size',
+            metavar='N', type=int, default=BATCH_SIZE,
+            help=f'number of scenes per request for product ID lookups, download options and URLs; defaults to {BATCH_SIZE}')
+    parser.add_argument('--id_cache',
+            metavar='JSON_PATH', type=str, default=None,
+            help=f'file keeping the scene IDs of product IDs, so they are only looked up once; defaults to {ID_CACHE} in OUTPUT_DIR')
 
     id_type = parser.add_mutually_exclusive_group(required=True)
     id_type.add_argument('--scene_ids',
@@ -258,4 +333,7 @@ if __name__ == '__main__':
 
     args = parser.parse_args()
 
+    if args.workers < 1 or args.per_host < 1 or args.batch_size < 1:
+        parser.error('--workers, --per_host and --batch_size must be at least 1.')
+
     main(**vars(args))
@@ -2,13 +2,13 @@
 Download all scenes from a search on EarthExplorer.
 '''
 import argparse
-import os
-import sys
-import urllib.request
+import functools
 from login import login
+from downloader import Downloader, scene_url
 
 
-def main(output_dir, dataset, download_code=None, **kwargs):
+def main(output_dir, dataset, download_code=None, workers=4, per_host=2,
+            **kwargs):
     '''
     Download all scenes from a search on EarthExplorer.
     INPUTS: 
@@ -17,6 +17,10 @@ def main(output_dir, dataset, download_code=None, **kwargs):
     OPTIONAL INPUTS:
         download_code : str : download code to identify product; 
             key 'downloadCode' in download_options() response
+        workers : int : number of scenes downloaded at a time;
+            defaults to 4
+        per_host : int : max number of scenes downloaded at a time
+            from the same host; defaults to 2
         latitude : float : decimal degree coordinate in EPSG:4326
             projection
         longitude : float : decimal degree coordinate in EPSG:4326
@@ -32,38 +36,25 @@ def main(output_dir, dataset, download_code=None, **kwargs):
         max_cloud_cover : int : max cloud cover percentage (0-100);
             defaults to 100
         additional_criteria : list : currently not supported
-        max_results : int : max number of results displayed;
-            defaults to 20
+        max_results : int : max number of scenes downloaded;
+            defaults to all search results
     RETURNS: 
         downloads search results as tar files to output directory
     '''
     api = login()
     
-    # search all scenes
-    scenes = api.search(dataset, **kwargs)
-    print(f'{len(scenes)} scenes found')
+    # search all scenes, page by page; scenes start downloading as
+        # soon as their page of results arrives
+    scenes = api.iter_search(dataset, **kwargs)
     
-    # make output directory (if doesn't yet exist)
-    os.makedirs(output_dir, exist_ok=True)
-    
-    for i, scene in enumerate(scenes, start=1):
-        print(f'Downloading scene {i} of {len(scenes)}')
-
-        # get scene identifier
+    # download scenes, using scene identifiers as filenames; scenes
+        # already in output_dir are skipped
+    downloader = Downloader(output_dir, workers, per_host)
+    for scene in scenes:
         entity_id = scene['entityId']
-        # use scene identifier as filename 
-        filename = os.path.join(output_dir, entity_id)
-        
-        # get download code if unknown
-        if download_code == None:
-            download_code, _ = api.download_options(dataset, entity_id)
-
-        # get download information
-        response = api.download(dataset, download_code, entity_id)
-        url = response[0]['url']
-        
-        # download dataset
-        urllib.request.urlretrieve(url, filename)
+        downloader.add(entity_id, functools.partial(scene_url, api, dataset,
+                                        entity_id, download_code))
+    downloader.finish()
 
     # logout of EROS account
     api.logout()
@@ -113,11 +104,19 @@ if __name__ == '__main__':
             help='maximum cloud cover percentage (0-100); defaults to 100')
     parser.add_argument('--max_results',
             type=int,
-            help='maximum number of results per search; defaults to 20')
+            help='maximum number of scenes to download; defaults to all search results')
+    parser.add_argument('--workers',
+            metavar='N', type=int, default=4,
+            help='number of scenes to download at a time; defaults to 4')
+    parser.add_argument('--per_host',
+            metavar='N', type=int, default=2,
+            help='max number of scenes to download at a time from the same host; defaults to 2')
  
     args = parser.parse_args()
 
     if args.latitude and args.bbox:
         parser.error('Either latitude/longitude or bounding box can be specified, not both.')
+    if args.workers < 1 or args.per_host < 1:
+        parser.error('--workers and --per_host must be at least 1.')
 
     main(**vars(args))
@@ -0,0 +1,332 @@
+'''
+Download many scenes concurrently, in one restartable job.
+'''
+import concurrent.futures
+import hashlib
+import os
+import sys
+import threading
+import time
+import urllib.parse
+import requests
+sys.path.insert(1, '../')
+import earth_explorer_api as eeapi
+
+# suffix of files being downloaded; they are renamed once complete
+PART_SUFFIX = '.part'
+# number of scenes per download options and download request
+BATCH_SIZE = 100
+
+
+def scene_url(api, dataset, entity_id, download_code=None):
+    '''
+    Get the download URL of a scene.
+    INPUTS:
+        api : API : logged in EarthExplorer API
+        dataset : str : name to identify dataset
+        entity_id : str : scene identifier
+    OPTIONAL INPUTS:
+        download_code : str : download code to identify product;
+            if None, the only download option of the scene is used,
+            or STANDARD if it has several
+    RETURNS:
+        url : str : download URL of the scene
+    '''
+    if download_code is None:
+        download_opts = api.download_options(dataset, entity_id)
+        download_code, _ = pick_download_option(
+                                    download_opts[0]['downloadOptions'])
+
+    response = api.download(dataset, download_code, entity_id)
+    if response == []:
+        raise Exception('No dataset matches the inputs provided')
+    return response[0]['url']
+
+
+def pick_download_option(download_opts_list):
+    '''
+    Pick the download option of a scene to download: the only
+    one, or STANDARD if it has several.
+    INPUTS:
+        download_opts_list : list of dict : 'downloadOptions' of
+            the scene in the download_options() response
+    RETURNS:
+        download_code : str : download code of the option
+        size : int : size of the file in bytes; None if unknown
+    '''
+    if download_opts_list == []:
+        raise Exception('No download options for this scene')
+    option = download_opts_list[0]
+    if len(download_opts_list) > 1:
+        for option in download_opts_list:
+            if option['downloadCode'] == 'STANDARD':
+                break
+        else:
+            return 'STANDARD', None
+    return option['downloadCode'], option.get('filesize') or None
+
+
+def scene_urls(api, dataset, entity_ids, download_code=None,
+                batch_size=BATCH_SIZE):
+    '''
+    Get the download URLs of scenes of a dataset, with one
+    download_options() and one download() request per batch of
+    scenes (per download code) instead of per scene. URLs are
+    yielded batch by batch, so downloads can start while the
+    next batches are requested.
+    INPUTS:
+        api : API : logged in EarthExplorer API
+        dataset : str : name to identify dataset
+        entity_ids : list of str : scene identifiers
+    OPTIONAL INPUTS:
+        download_code : str : download code to identify product;
+            if None, it is picked for each scene as in scene_url
+        batch_size : int : number of scenes per request
+    RETURNS:
+        yields (entity_id, url, size) : size of the file in bytes
+            is None if unknown; scenes without a download URL
+            are reported and left out
+    '''
+    for i in range(0, len(entity_ids), batch_size):
+        batch = entity_ids[i:i + batch_size]
+
+        # group scenes by download code
+        codes = {}
+        sizes = {}
+        no_code = set()
+        if download_code is None:
+            for scene in api.download_options(dataset, batch):
+                try:
+                    code, size = pick_download_option(scene['downloadOptions'])
+                except Exception:
+                    print(f'No download code found for {scene["entityId"]}')
+                    no_code.add(scene['entityId'])
+                    continue
+                codes.setdefault(code, []).append(scene['entityId'])
+                sizes[scene['entityId']] = size
+        else:
+            codes[download_code] = batch
+
+        urls = {}
+        for code, code_entity_ids in codes.items():
+            for scene in api.download(dataset, code, code_entity_ids):
+                urls[scene['entityId']] = scene['url']
+
+        for entity_id in batch:
+            if entity_id in urls:
+                yield entity_id, urls[entity_id], sizes.get(entity_id)
+            elif entity_id not in no_code:
+                print(f'No download URL found for {entity_id}')
+
+
+class Downloader(object):
+    '''
+    Download files on a pool of threads, each streamed into a
+    .part file that is renamed once its size (and checksum, if
+    known) is verified. Interrupted downloads are resumed from
+    their .part file with HTTP range requests, and files that
+    are already downloaded are skipped, so a job can be run
+    again until all of its files are downloaded.
+    INPUTS:
+        output_dir : str : directory to download files to
+    OPTIONAL INPUTS:
+        workers : int : number of files downloaded at a time
+        per_host : int : max number of files downloaded at a
+            time from the same host
+        max_attempts : int : number of times a download is
+            resumed after an error before giving up on it
+        chunk_size : int : number of bytes written at a time
+        timeout : float or tuple : seconds to wait to connect
+            and to read data; see requests
+    '''
+    def __init__(self, output_dir, workers=4, per_host=2, max_attempts=5,
+                    chunk_size=1024 * 1024, timeout=(10, 120)):
+        self.output_dir = output_dir
+        os.makedirs(output_dir, exist_ok=True)
+        self.per_host = per_host
+        self.max_attempts = max_attempts
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+
+        self.session = eeapi.make_session(pool_size=max(workers, per_host))
+        self.executor = concurrent.futures.ThreadPoolExecutor(workers)
+        self.futures = {}
+        self.host_limits = {}
+        self.lock = threading.Lock()
+
+        self.n_skipped = 0
+        self.n_bytes = 0
+        self.start_time = time.time()
+
+    def path(self, entity_id):
+        '''
+        Path of the downloaded file of a scene.
+        '''
+        return os.path.join(self.output_dir, entity_id)
+
+    def is_done(self, entity_id):
+        '''
+        Check if a scene is already downloaded; files are only
+        given their final name once verified.
+        '''
+        return os.path.exists(self.path(entity_id))
+
+    def add(self, entity_id, url, size=None, checksum=None):
+        '''
+        Queue the download of a scene, unless it is already
+        downloaded.
+        INPUTS:
+            entity_id : str : scene identifier, used as filename
+            url : str or function : download URL, or function
+                returning it (eg. with scene_url), which is only
+                called right before downloading
+        OPTIONAL INPUTS:
+            size : int : expected size of the file, in bytes
+            checksum : str : expected MD5 checksum of the file
+        '''
+        if self.skip(entity_id):
+            return
+        self.futures[entity_id] = self.executor.submit(self.download,
+                                        entity_id, url, size, checksum)
+
+    def skip(self, entity_id):
+        '''
+        Check if a scene is already downloaded (or queued), and
+        count it as skipped if so.
+        '''
+        if self.is_done(entity_id) or entity_id in self.futures:
+            self.n_skipped += 1
+            print(f'Skipping {entity_id}: already downloaded')
+            return True
+        return False
+
+    def host_limit(self, url):
+        '''
+        Semaphore limiting the number of downloads from the host
+        of a URL.
+        '''
+        host = urllib.parse.urlsplit(url).netloc
+        with self.lock:
+            if host not in self.host_limits:
+                self.host_limits[host] = threading.Semaphore(self.per_host)
+            return self.host_limits[host]
+
+    def download(self, entity_id, url, size=None, checksum=None):
+        '''
+        Download a scene into its .part file, resuming after
+        errors, then verify and rename it; run on the pool.
+        RETURNS:
+            n_bytes : int : number of bytes downloaded
+        '''
+        if callable(url):
+            url = url()
+        part_path = self.path(entity_id) + PART_SUFFIX
+
+        n_bytes = 0
+        with self.host_limit(url):
+            for attempt in range(1, self.max_attempts + 1):
+                try:
+                    n_new, size = self.fetch(url, part_path, size)
+                    n_bytes += n_new
+                    break
+                except (requests.ConnectionError, requests.Timeout,
+                        requests.exceptions.ChunkedEncodingError) as error:
+                    if attempt == self.max_attempts:
+                        raise
+                    print(f'Resuming {entity_id} after error: {error}')
+                    time.sleep(2 ** (attempt - 1))
+
+        # verify the download before giving it its final name
+        part_size = os.path.getsize(part_path)
+        if size is not None and part_size != size:
+            if part_size > size:
+                os.remove(part_path)
+            raise Exception(f'{entity_id} has {part_size} bytes instead of {size}')
+        if checksum is not None and file_md5(part_path) != checksum.lower():
+            os.remove(part_path)
+            raise Exception(f'{entity_id} does not match its checksum')
+        os.replace(part_path, self.path(entity_id))
+        return n_bytes
+
+    def fetch(self, url, part_path, size=None):
+        '''
+        Stream a URL into a .part file, from the end of what is
+        already in it.
+        RETURNS:
+            n_bytes : int : number of bytes written
+            size : int : total size of the file; None if unknown
+        '''
+        start = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        if size is not None and start == size:
+            return 0, size
+        headers = {'Range': f'bytes={start}-'} if start > 0 else {}
+
+        with self.session.get(url, headers=headers, stream=True,
+                                timeout=self.timeout) as response:
+            if response.status_code == 416:
+                # the .part file is not a prefix of this file
+                os.remove(part_path)
+                return self.fetch(url, part_path, size)
+            response.raise_for_status()
+
+            if response.status_code == 206:
+                # Content-Range: bytes start-end/size
+                total = response.headers.get('Content-Range', '').rpartition('/')[2]
+                mode = 'ab'
+            else:
+                # the server sent the whole file
+                total = response.headers.get('Content-Length')
+                mode = 'wb'
+            if size is None and total and total != '*':
+                size = int(total)
+
+            n_bytes = 0
+            with open(part_path, mode) as f:
+                for chunk in response.iter_content(self.chunk_size):
+                    f.write(chunk)
+                    n_bytes += len(chunk)
+                    with self.lock:
+                        self.n_bytes += len(chunk)
+        return n_bytes, size
+
+    def finish(self):
+        '''
+        Wait for all queued downloads, and report the downloaded
+        scenes and throughput.
+        RETURNS:
+            failed : list of str : scenes that could not be
+                downloaded; running the job again retries them
+        '''
+        failed = []
+        n_done = 0
+        total = len(self.futures)
+        entity_ids = {future: entity_id
+                        for entity_id, future in self.futures.items()}
+        for future in concurrent.futures.as_completed(entity_ids):
+            entity_id = entity_ids[future]
+            try:
+                future.result()
+                n_done += 1
+                print(f'Downloaded {entity_id} ({n_done} of {total})')
+            except Exception as error:
+                failed.append(entity_id)
+                print(f'Could not download {entity_id}: {error}')
+        self.executor.shutdown()
+        self.session.close()
+
+        elapsed = time.time() - self.start_time
+        rate = self.n_bytes / max(elapsed, 1e-6) / 1024 ** 2
+        print(f'{n_done} scenes downloaded, {self.n_skipped} skipped, {len(failed)} failed')
+        print(f'{self.n_bytes / 1024 ** 2:.1f} MB in {elapsed:.1f} s ({rate:.2f} MB/s)')
+        return failed
+
+
+def file_md5(file_path, chunk_size=1024 * 1024):
+    '''
+    MD5 checksum of a file, as a hex string.
+    '''
+    md5 = hashlib.md5()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
@@ -9,7 +9,6 @@ use the following to call this example in your terminal:
 import sys
 sys.path.insert(1, '../')
 sys.path.insert(1, '../../')
-import numpy as np
 from download_search import main as download_search
 from untar import main as untar
 
@@ -26,16 +25,13 @@ bbox = (41.5, -70.75, 42.42, -69.75) # Cape Cod
 
 #max_cloud_cover = 50
 
-# download 5 files from each year for 30 years
-years = np.arange(1980, 2020)
-for year in years:
-    start_date = str(year) + '-01-01'
-    end_date = str(year+1) + '-01-01'
-    max_results = 1000
-    download_search(output_dir, dataset, download_code=product,
-            bbox=bbox,
-            start_date=start_date, end_date=end_date,
-            max_results=max_results)
+# download all files from 1980 to 2020; search results are
+    # requested page by page while the files are downloaded
+start_date = '1980-01-01'
+end_date = '2020-01-01'
+download_search(output_dir, dataset, download_code=product,
+        bbox=bbox,
+        start_date=start_date, end_date=end_date)
 
 # untar the downloaded files in the same directory
 untar(output_dir)
@@ -12,6 +12,8 @@ def login():
     Call API and login.
     If environment variables EROS_USERNAME and EROS_PASSWORD exist,
     do not prompt for username and password.
+    If environment variable EARTH_EXPLORER_ENDPOINT exists, use it
+    as the URL of the API (eg. a local mock_server.py).
     '''
     # get login information
     username = os.environ.get('EROS_USERNAME','')
@@ -23,5 +25,6 @@ def login():
         password = getpass.getpass()
     
     # login to EROS account
-    api = eeapi.API(username, password)
+    endpoint = os.environ.get('EARTH_EXPLORER_ENDPOINT') or None
+    api = eeapi.API(username, password, endpoint=endpoint)
     return api
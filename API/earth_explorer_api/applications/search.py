@@ -83,7 +83,7 @@ if __name__ == '__main__':
             dest='max_cloud_cover', type=int,
             help='maximum cloud cover percentage (0-100); defaults to 100')
     parser.add_argument('--max_results',
-            type=int,
+            type=int, default=20,
             help='maximum number of results per search; defaults to 20')
  
     
@@ -4,17 +4,85 @@ Large parts of this code are based on:
     https://github.com/yannforget/landsatxplore
     MIT License
 '''
+import concurrent.futures
 import json
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from utils_api import spatial_filter, temporal_filter
 
+# HTTP status codes of transient errors, which are retried
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# number of scenes requested per page of search results
+PAGE_SIZE = 1000
+
 def json_request_format(**kwargs):
     return {'jsonRequest': json.dumps(kwargs)}
 
+
+def make_session(max_retries=5, backoff_factor=1, pool_size=10):
+    '''
+    Make an HTTP session that keeps connections alive and
+    reuses them across requests, and retries transient errors.
+    INPUTS:
+        max_retries : int : number of retries of a request
+        backoff_factor : float : retries wait for
+            backoff_factor * 2 ** (retry - 1) seconds (or as long
+            as asked in a Retry-After header)
+        pool_size : int : number of connections kept per host
+    RETURNS:
+        session : requests.Session : session to send requests with
+    '''
+    retry_args = {'total': max_retries,
+                    'backoff_factor': backoff_factor,
+                    'status_forcelist': RETRY_STATUSES,
+                    'respect_retry_after_header': True}
+    methods = frozenset(['GET', 'POST'])
+    try:
+        retry = Retry(allowed_methods=methods, **retry_args)
+    except TypeError:
+        # older versions of urllib3
+        retry = Retry(method_whitelist=methods, **retry_args)
+
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size,
+                            max_retries=retry)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
 class API(object):
-    def __init__(self, username, password, version='1.4.1'):
+    def __init__(self, username, password, version='1.4.1', endpoint=None,
+                    timeout=(10, 120), max_retries=5, backoff_factor=1,
+                    pool_size=10):
+        '''
+        Log in to the EarthExplorer API. All requests are sent
+        on one session, which keeps connections alive and retries
+        transient errors; see make_session.
+        INPUTS:
+            username : str : EROS username
+            password : str : EROS password
+        OPTIONAL INPUTS:
+            version : str : API version
+            endpoint : str : URL of the API; defaults to the
+                EarthExplorer API of the given version (eg. a
+                mock_server.py URL can be given for development)
+            timeout : float or tuple : seconds to wait to connect
+                and to read a response; see requests
+            max_retries : int : number of retries of a request
+            backoff_factor : float : base of the waits between
+                retries, in seconds
+            pool_size : int : number of connections kept per host
+        '''
         self.version = version
-        self.endpoint = f'https://earthexplorer.usgs.gov/inventory/json/v/{version}/'
+        if endpoint is None:
+            endpoint = f'https://earthexplorer.usgs.gov/inventory/json/v/{version}/'
+        if not endpoint.endswith('/'):
+            endpoint += '/'
+        self.endpoint = endpoint
+        self.timeout = timeout
+        self.session = make_session(max_retries, backoff_factor, pool_size)
         self.key = self.login(username, password)
 
 
@@ -34,7 +102,8 @@ class API(object):
             kwargs.update(apiKey=self.key)
 
         params = json_request_format(**kwargs)
-        response = requests.get(url, params=params).json()
+        response = self.session.get(url, params=params,
+                                    timeout=self.timeout).json()
         
         error = response['error']
         if error:
@@ -53,7 +122,8 @@ class API(object):
         data = json_request_format(username=username, password=password, catalogID='EE')
         
         url = self.endpoint + 'login?'
-        response = requests.post(url, data=data).json()
+        response = self.session.post(url, data=data,
+                                        timeout=self.timeout).json()
 
         error = response['error']
         if error:
@@ -65,9 +135,11 @@ class API(object):
 
     def logout(self):
         '''
-        Log out of EROS account and invalidate API key
+        Log out of EROS account and invalidate API key, and close
+        the connections of the session
         '''
         self.request('logout')
+        self.session.close()
 
 
     def dataset_search(self, dataset=None, public_only=False,
@@ -130,15 +202,52 @@ class API(object):
             min_cloud_cover : int, optional : min cloud cover percentage (0-100); defaults to 0
             max_cloud_cover : int, optional : max cloud cover percentage (0-100); defaults to 100
             additional_criteria : list, optional : currently not supported
-            max_results : int, optional : max number of results displayed; defaults to 20
+            max_results : int, optional : max number of results displayed; defaults to 20;
+                if None, all results are returned
         RETURNS: 
-            search_results : dict : search results as a dictionary
+            search_results : list of dict : search results
         '''
+        scenes = self.iter_search(dataset,
+                    latitude=latitude, longitude=longitude, bbox=bbox,
+                    start_date=start_date, end_date=end_date, months=months,
+                    include_unknown_cloud_cover=include_unknown_cloud_cover,
+                    min_cloud_cover=min_cloud_cover,
+                    max_cloud_cover=max_cloud_cover,
+                    additional_criteria=additional_criteria,
+                    max_results=max_results)
+        search_results = list(scenes)
+        return search_results
+
+
+    def iter_search(self, dataset,
+                latitude=None, longitude=None, bbox=None,
+                start_date=None, end_date=None, months=None,
+                include_unknown_cloud_cover=True,
+                min_cloud_cover=0, max_cloud_cover=100,
+                additional_criteria=None, max_results=None,
+                page_size=PAGE_SIZE):
+        '''
+        Search for scenes based on various criteria, one page of
+        results at a time. Scenes are yielded as soon as their page
+        arrives, and the next page is requested while the scenes of
+        the current one are used, so at most two pages are held in
+        memory however many scenes match.
+        INPUTS:
+            same as search, except:
+            max_results : int, optional : max number of results;
+                defaults to None, for all results
+            page_size : int, optional : number of results per request;
+                defaults to 1000
+        RETURNS:
+            yields scene : dict : search result of a scene
+        '''
+        if max_results is not None:
+            page_size = min(page_size, max_results)
         params = {'datasetName': dataset,
                 'includeUnknownCloudCover': include_unknown_cloud_cover,
                 'minCloudCover': min_cloud_cover,
                 'maxCloudCover': max_cloud_cover,
-                'maxResults': max_results}
+                'maxResults': page_size}
         if latitude and longitude:
             params['spatialFilter'] = spatial_filter(latitude, longitude)
         if bbox: 
@@ -150,21 +259,50 @@ class API(object):
         if additional_criteria:
             params['additionalCriteria'] = search_filter(additional_criteria) #TODO make search filter function
 
-        response = self.request('search', **params)
-        search_results = response['results'] 
-
-        return search_results 
-
-
-    def id_lookup(self, dataset, id_list, input_field='entityId'):
+        if max_results == 0:
+            return
+
+        # request each page while the previous one is used
+        executor = concurrent.futures.ThreadPoolExecutor(1)
+        try:
+            n_results = 0
+            page = executor.submit(self.request, 'search', startingNumber=1,
+                                    **params)
+            while page is not None:
+                response = page.result()
+                results = response['results']
+
+                # nextRecord is the starting number of the next page
+                next_record = response.get('nextRecord')
+                page = None
+                if (results and next_record
+                        and next_record > response.get('lastRecord', 0)
+                        and next_record <= response.get('totalHits', 0)
+                        and (max_results is None
+                            or n_results + len(results) < max_results)):
+                    page = executor.submit(self.request, 'search',
+                                    startingNumber=next_record, **params)
+
+                for scene in results:
+                    if max_results is not None and n_results == max_results:
+                        return
+                    n_results += 1
+                    yield scene
+        finally:
+            executor.shutdown(wait=False)
+
+
+    def id_lookup(self, dataset, id_list, input_field='entityId', as_dict=False):
         '''
         Translate between entity ID (scene identifiers) and display ID (product identifiers)
         INPUTS: 
             dataset : str : dataset name
             id_list : list of str : list of scene (entity) IDs or product (display) IDs
             input_field : str : 'entityId' if id_list is scenes or 'displayId' if given list is products
+            as_dict : bool, optional : if True, return the translated ID of each given ID
         RETURNS:
-            new_id_list : list of str : list of translated IDs
+            new_id_list : list of str : list of translated IDs;
+                dict of {given ID : translated ID} if as_dict is True
         '''
         input_options = ['entityId', 'displayId']
         if input_field not in input_options:
@@ -174,6 +312,8 @@ class API(object):
                     'idList': id_list,
                     'inputField': input_field}
         response = self.request('idlookup', **params)
+        if as_dict:
+            return response
         new_id_list = list(response.values())
         return new_id_list
 
@@ -0,0 +1,275 @@
+'''
+Local mock of the EarthExplorer JSON API, to develop and
+try the API client and applications without an EROS account
+or network access.
+
+It answers the requests used by earth_explorer_api.py with
+made-up scenes, serves made-up files for their download URLs,
+and can fail a share of the requests with 429 or 503 errors
+to exercise the retries of the client. To use it, run:
+    python3 mock_server.py --port 8000
+and point the client to it, eg. for the applications:
+    EARTH_EXPLORER_ENDPOINT='http://localhost:8000/inventory/json/v/1.4.1/'
+'''
+import argparse
+import hashlib
+import http.server
+import json
+import random
+import threading
+import urllib.parse
+
+API_PREFIX = '/inventory/json/v/'
+FILES_PREFIX = '/files/'
+
+
+def entity_id(i):
+    '''
+    Made-up scene (entity) ID of scene i.
+    '''
+    return f'LC8{i:013d}LGN00'
+
+
+def display_id(i):
+    '''
+    Made-up product (display) ID of scene i; 40 characters,
+    like Landsat product IDs.
+    '''
+    return f'LC08_L1TP_{i:06d}_20200101_20200101_01_T1'
+
+
+def file_content(name, size):
+    '''
+    Made-up content of a downloaded file, the same on every
+    request for the same name.
+    '''
+    seed = hashlib.sha256(name.encode()).digest()
+    return (seed * (size // len(seed) + 1))[:size]
+
+
+class MockAPI(object):
+    '''
+    Made-up EarthExplorer data and the answers to API requests.
+    INPUTS:
+        n_scenes : int : number of scenes of each dataset
+        file_size : int : size of downloaded files, in bytes
+        fail_rate : float : share of requests (0-1) answered
+            with a 429 or 503 error
+    '''
+    def __init__(self, n_scenes=100, file_size=1024 * 1024, fail_rate=0.):
+        self.n_scenes = n_scenes
+        self.file_size = file_size
+        self.fail_rate = fail_rate
+        self.keys = set()
+        self.lock = threading.Lock()
+        self.random = random.Random(0)
+        self.n_requests = 0
+
+    def fail(self):
+        '''
+        Pick whether to fail the current request.
+        '''
+        with self.lock:
+            self.n_requests += 1
+            return self.random.random() < self.fail_rate
+
+    def scene(self, i):
+        return {'entityId': entity_id(i),
+                'displayId': display_id(i),
+                'acquisitionDate': f'2020-01-{i % 28 + 1:02d}',
+                'cloudCover': i % 100}
+
+    def answer(self, request_code, params, base_url):
+        '''
+        Answer an API request.
+        RETURNS:
+            data : response data
+            error : str : error message; empty if no error
+        '''
+        if request_code == 'login':
+            key = f'mock-key-{len(self.keys)}'
+            self.keys.add(key)
+            return key, ''
+        if params.get('apiKey') not in self.keys:
+            return None, 'AUTH_INVALID: invalid API key'
+
+        if request_code == 'logout':
+            self.keys.discard(params['apiKey'])
+            return True, ''
+
+        if request_code == 'datasets':
+            return [{'datasetName': 'SP_TILE_DSWE'},
+                    {'datasetName': 'LANDSAT_8_C1'}], ''
+
+        if request_code == 'search':
+            first = params.get('startingNumber', 1)
+            max_results = params.get('maxResults', 20)
+            last = min(first + max_results - 1, self.n_scenes)
+            results = [self.scene(i) for i in range(first - 1, last)]
+            next_record = last + 1 if last < self.n_scenes else None
+            return {'numberReturned': len(results),
+                    'totalHits': self.n_scenes,
+                    'firstRecord': first,
+                    'lastRecord': last,
+                    'nextRecord': next_record,
+                    'results': results}, ''
+
+        if request_code == 'idlookup':
+            ids = {}
+            for i in range(self.n_scenes):
+                ids[display_id(i)] = entity_id(i)
+                ids[entity_id(i)] = display_id(i)
+            return {data_id: ids[data_id] for data_id in params['idList']
+                        if data_id in ids}, ''
+
+        if request_code == 'metadata':
+            entity_ids = set(params['entityIds'])
+            return [self.scene(i) for i in range(self.n_scenes)
+                        if entity_id(i) in entity_ids], ''
+
+        entity_ids = params.get('entityIds', [])
+        if isinstance(entity_ids, str):
+            entity_ids = [entity_ids]
+
+        if request_code == 'downloadoptions':
+            return [{'entityId': scene,
+                        'downloadOptions': [{'downloadCode': 'STANDARD',
+                                            'filesize': self.file_size,
+                                            'available': True}]}
+                    for scene in entity_ids], ''
+
+        if request_code == 'download':
+            return [{'entityId': scene,
+                        'product': params.get('products'),
+                        'url': f'{base_url}{FILES_PREFIX}{scene}.tar.gz'}
+                    for scene in entity_ids], ''
+
+        return None, f'UNKNOWN_REQUEST: {request_code} is not supported'
+
+
+class MockHandler(http.server.BaseHTTPRequestHandler):
+    '''
+    Handle the HTTP requests to the mock API; the API is set as
+    the mock_api attribute of the server.
+    '''
+    # keep connections alive between requests
+    protocol_version = 'HTTP/1.1'
+
+    def send(self, status, body, content_type='application/json',
+                headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def handle_request(self, form=None):
+        mock_api = self.server.mock_api
+        if mock_api.fail():
+            status = random.choice([429, 503])
+            self.send(status, b'{}', headers={'Retry-After': '0'})
+            return
+
+        url = urllib.parse.urlsplit(self.path)
+        if url.path.startswith(FILES_PREFIX):
+            self.send_file(url.path[len(FILES_PREFIX):])
+            return
+        if not url.path.startswith(API_PREFIX):
+            self.send(404, b'{}')
+            return
+
+        # /inventory/json/v/<version>/<request code>
+        version, _, request_code = url.path[len(API_PREFIX):].partition('/')
+        if form is None:
+            form = urllib.parse.parse_qs(url.query)
+        params = json.loads(form.get('jsonRequest', ['{}'])[0])
+
+        base_url = f'http://{self.headers["Host"]}'
+        data, error = mock_api.answer(request_code, params, base_url)
+        response = {'errorCode': error.split(':')[0] if error else None,
+                    'error': error,
+                    'data': data,
+                    'api_version': version}
+        self.send(200, json.dumps(response).encode())
+
+    def send_file(self, name):
+        content = file_content(name, self.server.mock_api.file_size)
+
+        # resume from the start of a 'bytes=start-' range
+        byte_range = self.headers.get('Range', '')
+        if byte_range.startswith('bytes='):
+            start = int(byte_range[len('bytes='):].partition('-')[0])
+            if start >= len(content):
+                self.send(416, b'', headers={
+                            'Content-Range': f'bytes */{len(content)}'})
+                return
+            self.send(206, content[start:],
+                        content_type='application/octet-stream',
+                        headers={'Content-Range':
+                            f'bytes {start}-{len(content) - 1}/{len(content)}'})
+            return
+        self.send(200, content, content_type='application/octet-stream')
+
+    def do_GET(self):
+        self.handle_request()
+
+    def do_HEAD(self):
+        self.handle_request()
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        form = urllib.parse.parse_qs(self.rfile.read(length).decode())
+        self.handle_request(form)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+def serve(port=8000, n_scenes=100, file_size=1024 * 1024, fail_rate=0.,
+            verbose=False):
+    '''
+    Run the mock API until interrupted.
+    INPUTS:
+        port : int : port to listen on (on localhost)
+        n_scenes : int : number of scenes of each dataset
+        file_size : int : size of downloaded files, in bytes
+        fail_rate : float : share of requests (0-1) answered
+            with a 429 or 503 error
+        verbose : bool : if True, log every request
+    '''
+    server = http.server.ThreadingHTTPServer(('localhost', port), MockHandler)
+    server.mock_api = MockAPI(n_scenes, file_size, fail_rate)
+    server.verbose = verbose
+    print(f'Mock EarthExplorer API at http://localhost:{port}{API_PREFIX}1.4.1/')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run a local mock of the EarthExplorer JSON API.')
+
+    parser.add_argument('--port',
+            type=int, default=8000,
+            help='port to listen on; defaults to 8000')
+    parser.add_argument('--n_scenes',
+            type=int, default=100,
+            help='number of scenes of each dataset; defaults to 100')
+    parser.add_argument('--file_size',
+            type=int, default=1024 * 1024,
+            help='size of downloaded files in bytes; defaults to 1 MB')
+    parser.add_argument('--fail_rate',
+            type=float, default=0.,
+            help='share of requests (0-1) answered with a 429 or 503 error; defaults to 0')
+    parser.add_argument('--verbose',
+            action='store_true',
+            help='if flagged, log every request')
+
+    args = parser.parse_args()
+    serve(**vars(args))
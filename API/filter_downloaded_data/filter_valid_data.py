@@ -1,83 +1,385 @@
 '''
 Sorts data into good and bad directories, depending if
 the number of valid pixels in a raster is over a certain
-percent.
+percent, or only scores the files in the catalog so that
+other tools can filter them without moving them.
 '''
 import argparse
 import gdal
+import multiprocessing
 import numpy as np
+import ogr
+import osr
 import shutil
 import os
+import sys
 
-def get_files(main_dir):
+# the catalog of DSWE outputs is maintained by the DSWE code
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                    '..', '..', 'hls_dswe'))
+import catalog
+
+# max number of rows and columns read from a file with --approximate
+APPROX_SIZE = 1024
+
+def get_records(conn, main_dir, rescan=False):
     '''
-    Make a list of all INTR files in the directory.
+    Get catalog records of all INTR files in the directory;
+    files are added to the catalog from the directories that
+    were modified since the last scan, or from all directories
+    if rescan is True.
     INPUTS:
+        conn : sqlite3 connection : connection to the catalog
         main_dir : str : path to directory containing data
+        rescan : bool : if True, look for uncataloged files in
+            all directories, modified or not
     RETURNS:
-        all_files : list of str : list of paths to all INTR files
+        records : list of dict : catalog records of all INTR files
+    '''
+    n_added, n_removed = catalog.scan_outputs(conn, main_dir,
+                                                changed_only=not rescan)
+    if n_removed > 0:
+        print(f'Removed {n_removed} deleted files from the catalog')
+    records = catalog.query_outputs(conn, main_dir, 'INTR')
+    return records
+
+
+def read_roi(roi_file=None, bbox=None):
     '''
-    all_files = []
-    for dirpath, _, filenames in os.walk(main_dir):
-        for filename in filenames:
-            if 'INTR' in filename:
-                all_files.append(os.path.join(dirpath, filename))
-    return all_files
+    Read the region of interest (ROI) to score files in.
+    INPUTS:
+        roi_file : str : path to a vector file (any format read
+            by OGR, eg. shapefile or GeoJSON) of ROI polygons
+        bbox : list of float : ROI bounding box as min long,
+            min lat, max long, max lat
+    RETURNS:
+        roi : dict : 'wkt' (list of WKT polygons, in lat/long)
+            and 'srs' (WKT of the lat/long spatial reference);
+            None if neither roi_file nor bbox is given
+    '''
+    if roi_file is None and bbox is None:
+        return None
+
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(4326)
+    srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+
+    polygons = []
+    if roi_file is not None:
+        vector = ogr.Open(roi_file)
+        if vector is None:
+            raise Exception(f'Could not open ROI file {roi_file}')
+        for layer in vector:
+            layer_srs = layer.GetSpatialRef()
+            transform = None
+            if layer_srs is not None:
+                layer_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+                transform = osr.CoordinateTransformation(layer_srs, srs)
+            for feature in layer:
+                geometry = feature.GetGeometryRef()
+                if geometry is None:
+                    continue
+                geometry = geometry.Clone()
+                if transform is not None:
+                    geometry.Transform(transform)
+                polygons.append(geometry.ExportToWkt())
+
+    if bbox is not None:
+        min_lon, min_lat, max_lon, max_lat = bbox
+        polygons.append(f'POLYGON (({min_lon} {min_lat}, {max_lon} {min_lat}, '
+                        f'{max_lon} {max_lat}, {min_lon} {max_lat}, '
+                        f'{min_lon} {min_lat}))')
 
+    if len(polygons) == 0:
+        raise Exception('The region of interest has no polygons')
+    return {'wkt': polygons, 'srs': srs.ExportToWkt()}
 
-def open_raster(file):
+
+def roi_mask(roi, geo_transform, projection, shape):
     '''
-    Open raster from a given file.
+    Rasterize the region of interest on a tile grid, in the
+    window of the grid bounding it.
+    INPUTS:
+        roi : dict : region of interest; see read_roi
+        geo_transform : tuple : geo transform of the tile grid
+        projection : str : WKT projection of the tile grid
+        shape : tuple of int : (rows, cols) of the tile grid
+    RETURNS:
+        window : tuple of int : (xoff, yoff, xsize, ysize) of the
+            ROI's bounding window in the grid; None if the ROI is
+            outside of the grid
+        mask : numpy array : pixels of the window inside the ROI,
+            packed into bits with np.packbits; None if the ROI is
+            outside of the grid
+    '''
+    roi_srs = osr.SpatialReference()
+    roi_srs.ImportFromWkt(roi['srs'])
+    roi_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    grid_srs = osr.SpatialReference()
+    grid_srs.ImportFromWkt(projection)
+    grid_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    transform = osr.CoordinateTransformation(roi_srs, grid_srs)
+
+    # polygons of the ROI in the projection of the grid
+    vector = ogr.GetDriverByName('Memory').CreateDataSource('')
+    layer = vector.CreateLayer('roi', grid_srs)
+    for wkt in roi['wkt']:
+        geometry = ogr.CreateGeometryFromWkt(wkt)
+        geometry.Transform(transform)
+        feature = ogr.Feature(layer.GetLayerDefn())
+        feature.SetGeometry(geometry)
+        layer.CreateFeature(feature)
+
+    # bounding window of the ROI in the grid
+    n_rows, n_cols = shape
+    minx, maxx, miny, maxy = layer.GetExtent()
+    cols = sorted([(minx - geo_transform[0]) / geo_transform[1],
+                    (maxx - geo_transform[0]) / geo_transform[1]])
+    rows = sorted([(maxy - geo_transform[3]) / geo_transform[5],
+                    (miny - geo_transform[3]) / geo_transform[5]])
+    col_start = max(int(np.floor(cols[0])), 0)
+    col_stop = min(int(np.ceil(cols[1])), n_cols)
+    row_start = max(int(np.floor(rows[0])), 0)
+    row_stop = min(int(np.ceil(rows[1])), n_rows)
+    if col_stop <= col_start or row_stop <= row_start:
+        return None, None
+    window = (col_start, row_start, col_stop - col_start, row_stop - row_start)
+
+    # burn the ROI into the window
+    raster = gdal.GetDriverByName('MEM').Create('', window[2], window[3], 1,
+                                                    gdal.GDT_Byte)
+    raster.SetGeoTransform((geo_transform[0] + col_start * geo_transform[1],
+                            geo_transform[1], 0,
+                            geo_transform[3] + row_start * geo_transform[5],
+                            0, geo_transform[5]))
+    raster.SetProjection(projection)
+    gdal.RasterizeLayer(raster, [1], layer, burn_values=[1])
+    mask = raster.GetRasterBand(1).ReadAsArray().astype(bool)
+    return window, np.packbits(mask)
+
+
+def roi_masks(roi, records):
+    '''
+    Rasterize the region of interest once for each tile grid
+    (footprint and projection) of the records; see roi_mask.
+    RETURNS:
+        masks : dict : (footprint, projection) keys, and (window,
+            packed mask) values
+    '''
+    masks = {}
+    for record in records:
+        key = (record['footprint'], record['projection'])
+        if key not in masks:
+            masks[key] = roi_mask(roi, record['geo_transform'],
+                                    record['projection'],
+                                    (record['n_rows'], record['n_cols']))
+    return masks
+
+
+def percent_valid(file, percent_good=None, approximate=False,
+                    block_rows=256, window=None, mask=None):
+    '''
+    Calculates percent of valid (non-255) pixels in a given file,
+    reading it in strips of blocks into one reused buffer.
     INPUTS:
         file : str : path to TIF file
+    OPTIONAL INPUTS:
+        percent_good : float : if given, stop reading as soon as
+            the file is known to be over (or under) this percent
+        approximate : bool : if True, count the invalid pixels
+            of a decimated read of the file (at most APPROX_SIZE
+            pixels on a side, from overviews if the file has
+            them) instead of reading every pixel
+        block_rows : int : minimum number of rows read at a time
+        window : tuple of int : (xoff, yoff, xsize, ysize) of the
+            only part of the file to read; see roi_mask
+        mask : numpy array : packed bits of the pixels of the
+            window to score (eg. inside a region of interest);
+            see roi_mask
     RETURNS:
-        raster : numpy array : array of raster data
+        percent : float : percent of valid data in the file; if
+            not exact, a bound on it that is enough to compare it
+            to percent_good
+        exact : bool : True if percent was counted from all pixels
     '''
-    raster = gdal.Open(os.path.abspath(file))
-    raster = raster.GetRasterBand(1).ReadAsArray()
-    return raster
+    data = gdal.Open(os.path.abspath(file))
+    band = data.GetRasterBand(1)
+    if window is None:
+        window = (0, 0, data.RasterXSize, data.RasterYSize)
+    x_off, y_off, n_cols, n_rows = window
+
+    if mask is None:
+        total = n_rows * n_cols
+    else:
+        mask = np.unpackbits(mask, count=n_rows * n_cols).reshape(
+                                n_rows, n_cols).view(bool)
+        total = np.count_nonzero(mask)
+    if total == 0:
+        # no pixels to score
+        return 0., True
+
+    if approximate and mask is None:
+        # the histogram of the band would leave out its nodata
+            # value (255), so count 255 in a decimated read instead
+        buf_xsize = min(n_cols, APPROX_SIZE)
+        buf_ysize = min(n_rows, APPROX_SIZE)
+        sample = band.ReadAsArray(x_off, y_off, n_cols, n_rows,
+                                    buf_xsize=buf_xsize, buf_ysize=buf_ysize)
+        percent = (1 - np.count_nonzero(sample == 255) / sample.size) * 100.
+        return percent, False
+
+    # read whole rows of blocks at a time
+    block_height = band.GetBlockSize()[1]
+    rows = block_height * max(1, block_rows // block_height)
+    buffer = np.empty((rows, n_cols), dtype=np.uint8)
+    invalid = np.empty((rows, n_cols), dtype=bool)
+
+    n_invalid = 0
+    n_read = 0
+    for row in range(0, n_rows, rows):
+        n = min(rows, n_rows - row)
+        band.ReadAsArray(x_off, y_off + row, n_cols, n, buf_obj=buffer[:n])
+        np.equal(buffer[:n], 255, out=invalid[:n])
+        if mask is None:
+            n_read += n * n_cols
+        else:
+            np.logical_and(invalid[:n], mask[row:row + n], out=invalid[:n])
+            n_read += np.count_nonzero(mask[row:row + n])
+        n_invalid += np.count_nonzero(invalid[:n])
+
+        if percent_good is not None and row + n < n_rows:
+            # valid percent if the rest of the file is all invalid,
+                # or all valid
+            lowest = (n_read - n_invalid) / total * 100
+            highest = (total - n_invalid) / total * 100
+            if lowest >= percent_good:
+                return lowest, False
+            if highest < percent_good:
+                return highest, False
+
+    percent = (total - n_invalid) / total * 100
+    return percent, True
 
 
-def percent_valid(raster):
+def score_job(job):
     '''
-    Calculates percent of valid (non-255) pixels in a given raster.
+    Score one file on a worker process; see score_files.
+    '''
+    file, percent_good, approximate, window, mask = job
+    return file, percent_valid(file, percent_good, approximate,
+                                window=window, mask=mask)
+
+
+def score_files(conn, main_dir, records, percent_good=None,
+                    approximate=False, workers=1, roi=None):
+    '''
+    Find the percent of valid data of all files, scoring only
+    the files without a valid fraction in the catalog (eg. files
+    added since the last run), on a pool of processes. Exact
+    scores are saved in the catalog as they are found. Scores
+    in a region of interest are not saved, so all files are
+    scored in it; only its bounding window is read from them.
     INPUTS:
-        raster : numpy array : array of raster data
+        conn : sqlite3 connection : connection to the catalog
+        main_dir : str : path to directory containing data
+        records : list of dict : catalog records of the files
+    OPTIONAL INPUTS:
+        percent_good : float : if given, files are only read
+            until they are known to be over or under this percent;
+            see percent_valid
+        approximate : bool : if True, estimate scores from a
+            decimated read of each file; see percent_valid
+        workers : int : number of processes to use
+        roi : dict : if given, score files in this region of
+            interest only; see read_roi
     RETURNS:
-        percent : float : percent of valid data in the raster
+        percents : dict : paths of the files as keys, and their
+            percent of valid data (or a bound of it that is
+            enough to compare it to percent_good) as values
     '''
-    # replace valid pixels with 1 and invalid (255) pixels with 0
-    valid_data = np.where(raster == 255, 0, 1)
+    percents = {}
+    jobs = []
+    if roi is not None:
+        # the ROI is rasterized once per tile grid
+        masks = roi_masks(roi, records)
+        for record in records:
+            window, mask = masks[(record['footprint'], record['projection'])]
+            if window is None:
+                # the ROI is outside of the file
+                percents[record['path']] = 0.
+            else:
+                jobs.append((record['path'], percent_good, approximate,
+                                window, mask))
+    else:
+        for record in records:
+            if record['valid_fraction'] is None:
+                jobs.append((record['path'], percent_good, approximate,
+                                None, None))
+            else:
+                percents[record['path']] = record['valid_fraction'] * 100
+    print(f'{len(jobs)} out of {len(records)} files to score')
 
-    # count the number of valid pixels
-    n = np.count_nonzero(valid_data)
-    
-    # calculate the percentage of valid pixels out of all pixels
-    total = raster.shape[0] * raster.shape[1]
-    percent = n / total * 100
-    return percent
+    if workers > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(workers)
+        results = pool.imap_unordered(score_job, jobs, chunksize=16)
+    else:
+        pool = None
+        results = map(score_job, jobs)
 
+    try:
+        for i, (file, (percent, exact)) in enumerate(results, start=1):
+            percents[file] = percent
+            if exact and roi is None:
+                catalog.set_valid_fraction(conn, main_dir, file,
+                                            percent / 100)
+            print(f'{i} out of {len(jobs)} files scored')
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return percents
 
-def main(main_dir, percent_good):
+
+def main(main_dir, percent_good=None, approximate=False, workers=1,
+            rescan=False, score_only=False, roi_file=None, bbox=None):
     '''
     Takes a directory of DSWE data and sorts files into
     good or bad folders, depending if the percentage of 
     valid pixels in the data is over a certain percent.
+    If approximate, the percentage is estimated from a
+    decimated read of each file; see percent_valid.
+    If score_only, files are not moved: the percentage of
+    valid pixels of all files is saved in the catalog, where
+    other tools filter files by it (eg. the --min_valid option
+    of the proportions code).
+    If roi_file and/or bbox are given, files are scored in
+    that region of interest only; see read_roi.
     '''
+    # get all INTR files from the catalog
+    conn = catalog.open_catalog(main_dir)
+    records = get_records(conn, main_dir, rescan)
+
+    if score_only:
+        # exact scores of all files, without moving them
+        score_files(conn, main_dir, records, workers=workers)
+        conn.close()
+        return
 
     # make good and bad directories
     good_data = os.path.join(main_dir, 'good_data')
     bad_data = os.path.join(main_dir, 'bad_data')
     os.makedirs(good_data, exist_ok=True)
     os.makedirs(bad_data, exist_ok=True)
-    
-    # get all INTR files
-    all_files = get_files(main_dir)
-
-    for i, file in enumerate(all_files, start=1):
-        # open raster and calculate percent valid data
-        raster = open_raster(file)
-        percent = percent_valid(raster)
+
+    # count valid data, stopping once each file is known
+        # to be good or bad; only exact counts are cataloged
+    roi = read_roi(roi_file, bbox)
+    percents = score_files(conn, main_dir, records, percent_good,
+                                approximate, workers, roi)
+
+    for i, record in enumerate(records, start=1):
+        file = record['path']
+        percent = percents[file]
         
         filedir, _ = os.path.split(file)
         _, dirname = os.path.split(filedir)
@@ -90,9 +392,12 @@ def main(main_dir, percent_good):
             path_to = os.path.join(bad_data, dirname)
         
         # move data to good or bad folder
-        shutil.move(filedir, path_to)
+        if filedir != path_to:
+            shutil.move(filedir, path_to)
+            catalog.move_outputs(conn, main_dir, filedir, path_to)
 
-        print(f'{i} out of {len(all_files)} files sorted')
+        print(f'{i} out of {len(records)} files sorted')
+    conn.close()
 
 if __name__ == '__main__':
     # get command line arguments
@@ -102,9 +407,37 @@ if __name__ == '__main__':
                 metavar='DIRECTORY_PATH', type=str,
                 help='main directory where DSWE data is located')
     parser.add_argument('percent_good',
-                metavar='PERCENT', type=float,
-                help='desired percentage for valid data in a given file (float, 0-100)')
+                metavar='PERCENT', type=float, nargs='?',
+                help='desired percentage for valid data in a given file (float, 0-100); not used with --score_only')
+    parser.add_argument('--approximate',
+                action='store_true',
+                help='if flagged, estimate the percentage of valid data from overviews or a subsample of each file')
+    parser.add_argument('--workers',
+                metavar='N', type=int, default=1,
+                help='number of processes to score files on; defaults to 1')
+    parser.add_argument('--rescan',
+                action='store_true',
+                help='if flagged, search all directories (not only those modified since the last run) for files missing from the catalog')
+    parser.add_argument('--score_only',
+                action='store_true',
+                help='if flagged, save the percentage of valid data of all files in the catalog without moving them')
+    parser.add_argument('--roi',
+                metavar='VECTOR_PATH', dest='roi_file', type=str,
+                help='vector file (eg. shapefile or GeoJSON) of polygons to score files in, instead of the whole file')
+    parser.add_argument('--bbox',
+                metavar=('MIN_LONG', 'MIN_LAT', 'MAX_LONG', 'MAX_LAT'),
+                type=float, nargs=4,
+                help='lat/long bounding box to score files in, instead of the whole file')
 
     args = parser.parse_args()
 
+    if not args.score_only and args.percent_good is None:
+        parser.error('must specify PERCENT, unless --score_only is flagged')
+    if args.score_only and args.approximate:
+        parser.error('--approximate cannot be used with --score_only, which saves exact scores')
+    if args.score_only and (args.roi_file or args.bbox):
+        parser.error('--roi and --bbox cannot be used with --score_only, which saves scores of whole files')
+    if args.approximate and (args.roi_file or args.bbox):
+        parser.error('--approximate cannot be used with --roi or --bbox')
+
     main(**vars(args))
@@ -0,0 +1,406 @@
+'''
+SQLite catalog kept in the DSWE output directory.
+
+The scenes table caches the metadata of each HLS input file
+(sun angles, sensor, tile, acquisition date, cloud cover and
+spatial coverage, along with its subdataset paths), keyed by
+file path and modification time. HDF4 files only need to be
+opened once to learn these facts; later runs and batch
+planning read them from the catalog.
+
+The outputs table records each DSWE output layer written by
+dswe.py (path relative to the catalog directory, layer, date,
+sensor, tile, georeferencing, extent, shape, footprint key and
+fraction of valid pixels). The proportions and filter tools
+query it instead of walking and opening the whole output tree;
+outputs with the same footprint key cover exactly the same
+pixels, so tiles are grouped without opening any raster.
+'''
+import argparse
+import gdal
+import json
+import numpy as np
+import os
+import sqlite3
+import utils_dswe as utils
+
+CATALOG_NAME = 'dswe_catalog.sqlite'
+
+SCENE_COLUMNS = ['path', 'mtime', 'subdatasets', 'azimuth',
+                    'altitude', 'product', 'sensor', 'tile_id',
+                    'acquisition_date', 'cloud_cover',
+                    'spatial_coverage']
+
+OUTPUT_COLUMNS = ['path', 'layer', 'acquisition_date', 'sensor',
+                    'tile_id', 'geo_transform', 'projection',
+                    'minx', 'maxy', 'maxx', 'miny', 'n_rows',
+                    'n_cols', 'footprint', 'valid_fraction', 'mtime']
+
+# layers recorded in the outputs table
+CATALOG_LAYERS = ['INTR', 'INWM']
+
+
+def open_catalog(catalog_dir):
+    '''
+    Open (and create if needed) the catalog in a directory.
+    INPUTS:
+        catalog_dir : str : directory holding the catalog;
+            normally the DSWE output directory
+    RETURNS:
+        conn : sqlite3 connection : connection to the catalog
+    '''
+    os.makedirs(catalog_dir, exist_ok=True)
+    conn = sqlite3.connect(os.path.join(catalog_dir, CATALOG_NAME))
+    conn.row_factory = sqlite3.Row
+    conn.execute('''CREATE TABLE IF NOT EXISTS scenes (
+                        path TEXT PRIMARY KEY,
+                        mtime REAL,
+                        subdatasets TEXT,
+                        azimuth REAL,
+                        altitude REAL,
+                        product TEXT,
+                        sensor TEXT,
+                        tile_id TEXT,
+                        acquisition_date TEXT,
+                        cloud_cover REAL,
+                        spatial_coverage REAL)''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS outputs (
+                        path TEXT PRIMARY KEY,
+                        layer TEXT,
+                        acquisition_date TEXT,
+                        sensor TEXT,
+                        tile_id TEXT,
+                        geo_transform TEXT,
+                        projection TEXT,
+                        minx REAL,
+                        maxy REAL,
+                        maxx REAL,
+                        miny REAL,
+                        n_rows INTEGER,
+                        n_cols INTEGER,
+                        footprint TEXT,
+                        valid_fraction REAL,
+                        mtime REAL)''')
+    # modification times of the directories when last scanned
+    conn.execute('''CREATE TABLE IF NOT EXISTS dirs (
+                        path TEXT PRIMARY KEY,
+                        mtime REAL)''')
+
+    # catalogs made before footprints were recorded
+    columns = [row['name'] for row in conn.execute('PRAGMA table_info(outputs)')]
+    if 'footprint' not in columns:
+        conn.execute('ALTER TABLE outputs ADD COLUMN footprint TEXT')
+        rows = conn.execute('SELECT path, geo_transform, n_rows, n_cols '
+                                'FROM outputs').fetchall()
+        for row in rows:
+            conn.execute('UPDATE outputs SET footprint = ? WHERE path = ?',
+                            (footprint_key(json.loads(row['geo_transform']),
+                                (row['n_rows'], row['n_cols'])), row['path']))
+
+    conn.execute('''CREATE INDEX IF NOT EXISTS outputs_layer_date
+                        ON outputs (layer, acquisition_date)''')
+    conn.execute('''CREATE INDEX IF NOT EXISTS outputs_layer_footprint
+                        ON outputs (layer, footprint)''')
+    conn.commit()
+    return conn
+
+
+def footprint_key(geo_transform, shape):
+    '''
+    Key of the exact footprint of a raster (origin, pixel size
+    and shape); rasters with the same key cover the same pixels.
+    '''
+    n_rows, n_cols = shape
+    return (f'{geo_transform[0]:.3f}_{geo_transform[3]:.3f}_'
+            f'{geo_transform[1]:g}_{geo_transform[5]:g}_{n_cols}_{n_rows}')
+
+
+def get_scene(conn, filename):
+    '''
+    Get band paths and scene information for an HLS file,
+    only opening the HDF4 file if it is not in the catalog
+    or has been modified since it was cataloged.
+    INPUTS:
+        conn : sqlite3 connection : connection to the catalog
+        filename : str : path to HDF4 file
+    RETURNS:
+        all_bands : list of str : list of paths to each band
+        scene_info : dict : scene information; see
+            utils_dswe.hdf_scene_info
+    '''
+    path = os.path.abspath(filename)
+    mtime = os.path.getmtime(path)
+
+    row = conn.execute('SELECT * FROM scenes WHERE path = ? AND mtime = ?',
+                        (path, mtime)).fetchone()
+    if row is not None:
+        scene_info = dict(row)
+        all_bands = json.loads(scene_info.pop('subdatasets'))
+        return all_bands, scene_info
+
+    # not cataloged yet; parse the HDF4 file once
+    all_bands, metadata = utils.hdf_bands(path)
+    scene_info = utils.hdf_scene_info(path, metadata)
+    scene_info['path'] = path
+    scene_info['mtime'] = mtime
+
+    values = [scene_info.get(col) for col in SCENE_COLUMNS]
+    values[SCENE_COLUMNS.index('subdatasets')] = json.dumps(all_bands)
+    conn.execute(f'INSERT OR REPLACE INTO scenes ({", ".join(SCENE_COLUMNS)}) '
+                    f'VALUES ({", ".join("?" * len(SCENE_COLUMNS))})',
+                    values)
+    conn.commit()
+    return all_bands, scene_info
+
+
+def list_scenes(conn):
+    '''
+    List all cataloged scenes, ordered by acquisition date.
+    INPUTS:
+        conn : sqlite3 connection : connection to the catalog
+    RETURNS:
+        scenes : list of dict : scene information for each
+            cataloged HLS file
+    '''
+    rows = conn.execute('SELECT * FROM scenes ORDER BY acquisition_date, path')
+    scenes = []
+    for row in rows:
+        scene_info = dict(row)
+        del scene_info['subdatasets']
+        scenes.append(scene_info)
+    return scenes
+
+
+def valid_fraction(data):
+    '''
+    Fraction (0-1) of valid (non-255) pixels in an array.
+    '''
+    return np.count_nonzero(data != 255) / data.size
+
+
+def record_output(conn, catalog_dir, filename, layer,
+                    geo_transform, projection, shape,
+                    valid_fraction=None):
+    '''
+    Add (or update) a DSWE output layer in the catalog.
+    INPUTS:
+        conn : sqlite3 connection : connection to the catalog
+        catalog_dir : str : directory holding the catalog
+        filename : str : path to the output file
+        layer : str : DSWE layer (eg. INTR or INWM)
+        geo_transform : tuple : raster coordinates related to
+            georeferencing coordinates by affine transform
+        projection : list : GDAL projection metadata
+        shape : tuple : (n_rows, n_cols) of the output
+    OPTIONAL INPUTS:
+        valid_fraction : float : fraction (0-1) of valid pixels;
+            left empty if unknown
+    RETURNS:
+        output file added to the outputs table
+    '''
+    n_rows, n_cols = shape
+    minx = geo_transform[0]
+    maxy = geo_transform[3]
+    maxx = minx + geo_transform[1] * n_cols
+    miny = maxy + geo_transform[5] * n_rows
+
+    record = utils.parse_scene_name(filename)
+    record.update(path=os.path.relpath(filename, catalog_dir),
+                    layer=layer,
+                    geo_transform=json.dumps(list(geo_transform)),
+                    projection=projection,
+                    minx=minx, maxy=maxy, maxx=maxx, miny=miny,
+                    n_rows=n_rows, n_cols=n_cols,
+                    footprint=footprint_key(geo_transform, shape),
+                    valid_fraction=valid_fraction,
+                    mtime=os.path.getmtime(filename))
+
+    values = [record[col] for col in OUTPUT_COLUMNS]
+    conn.execute(f'INSERT OR REPLACE INTO outputs ({", ".join(OUTPUT_COLUMNS)}) '
+                    f'VALUES ({", ".join("?" * len(OUTPUT_COLUMNS))})',
+                    values)
+    conn.commit()
+
+
+def scan_outputs(conn, catalog_dir, changed_only=False):
+    '''
+    Walk the output tree once and add any DSWE output that is
+    missing from the catalog (eg. outputs written before the
+    catalog existed, or copied in since the last scan), and
+    remove cataloged outputs that are no longer on disk. Only
+    raster headers are read, so the valid fraction of new
+    outputs is left empty; cataloged outputs are not reopened.
+    The modification time of each directory is recorded, so
+    that later scans can skip the files of directories where
+    no file was added or removed since.
+    INPUTS:
+        conn : sqlite3 connection : connection to the catalog
+        catalog_dir : str : directory holding the catalog
+    OPTIONAL INPUTS:
+        changed_only : bool : if True, only look at the files of
+            directories that are new or modified since the last
+            scan
+    RETURNS:
+        n_added : int : number of outputs added
+        n_removed : int : number of outputs removed
+    '''
+    known = set(row['path'] for row in
+                    conn.execute('SELECT path FROM outputs'))
+    dir_mtimes = dict(conn.execute('SELECT path, mtime FROM dirs').fetchall())
+
+    # names of the cataloged outputs of each directory
+    known_dirs = {}
+    for path in known:
+        rel_dir = os.path.dirname(path) or os.curdir
+        known_dirs.setdefault(rel_dir, set()).add(os.path.basename(path))
+
+    n_added = 0
+    removed = []
+    dirpaths = [catalog_dir]
+    while dirpaths:
+        dirpath = dirpaths.pop()
+        # read the modification time before listing the directory,
+            # so files added while it is scanned are found next time
+        mtime = os.stat(dirpath).st_mtime
+        rel_dir = os.path.relpath(dirpath, catalog_dir)
+        scan_files = not changed_only or dir_mtimes.get(rel_dir) != mtime
+
+        names = set()
+        with os.scandir(dirpath) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    dirpaths.append(entry.path)
+                    continue
+                names.add(entry.name)
+                layer = entry.name[-8:-4]
+                if (not scan_files or not entry.name.endswith('.tif')
+                        or layer not in CATALOG_LAYERS):
+                    continue
+                if os.path.relpath(entry.path, catalog_dir) in known:
+                    continue
+
+                raster = gdal.Open(entry.path)
+                record_output(conn, catalog_dir, entry.path, layer,
+                                raster.GetGeoTransform(),
+                                raster.GetProjection(),
+                                (raster.RasterYSize, raster.RasterXSize))
+                n_added += 1
+
+        # outputs deleted from the directory
+        if scan_files:
+            removed += [os.path.join(rel_dir, name) for name in
+                            known_dirs.get(rel_dir, set()) - names]
+        conn.execute('INSERT OR REPLACE INTO dirs (path, mtime) VALUES (?, ?)',
+                        (rel_dir, mtime))
+        dir_mtimes.pop(rel_dir, None)
+        known_dirs.pop(rel_dir, None)
+
+    # outputs of directories that no longer exist
+    for rel_dir, old_names in known_dirs.items():
+        removed += [os.path.join(rel_dir, name) for name in old_names]
+    for path in removed:
+        conn.execute('DELETE FROM outputs WHERE path = ?',
+                        (os.path.normpath(path),))
+    for rel_dir in dir_mtimes:
+        conn.execute('DELETE FROM dirs WHERE path = ?', (rel_dir,))
+    conn.commit()
+    return n_added, len(removed)
+
+
+def query_outputs(conn, catalog_dir, layer, min_valid=None):
+    '''
+    Get cataloged DSWE outputs of a layer, ordered by date.
+    INPUTS:
+        conn : sqlite3 connection : connection to the catalog
+        catalog_dir : str : directory holding the catalog
+        layer : str : DSWE layer (eg. INTR or INWM)
+    OPTIONAL INPUTS:
+        min_valid : float : only return outputs with at least
+            this fraction (0-1) of valid pixels
+    RETURNS:
+        records : list of dict : one record per output; path
+            is absolute and geo_transform is a tuple
+    '''
+    query = 'SELECT * FROM outputs WHERE layer = ?'
+    params = [layer]
+    if min_valid is not None:
+        query += ' AND valid_fraction >= ?'
+        params.append(min_valid)
+    query += ' ORDER BY acquisition_date, path'
+
+    records = []
+    for row in conn.execute(query, params):
+        record = dict(row)
+        record['path'] = os.path.join(catalog_dir, record['path'])
+        record['geo_transform'] = tuple(json.loads(record['geo_transform']))
+        records.append(record)
+    return records
+
+
+def set_valid_fraction(conn, catalog_dir, filename, valid_fraction):
+    '''
+    Store the valid fraction (0-1) of a cataloged output.
+    '''
+    conn.execute('UPDATE outputs SET valid_fraction = ? WHERE path = ?',
+                    (valid_fraction, os.path.relpath(filename, catalog_dir)))
+    conn.commit()
+
+
+def move_outputs(conn, catalog_dir, old_dir, new_dir):
+    '''
+    Update the paths of cataloged outputs after moving the
+    directory that contains them.
+    INPUTS:
+        conn : sqlite3 connection : connection to the catalog
+        catalog_dir : str : directory holding the catalog
+        old_dir : str : path of the directory before the move
+        new_dir : str : path of the directory after the move
+    '''
+    old_rel = os.path.relpath(old_dir, catalog_dir)
+    new_rel = os.path.relpath(new_dir, catalog_dir)
+    prefix = os.path.join(old_rel, '')
+    rows = conn.execute('SELECT path FROM outputs WHERE substr(path, 1, ?) = ?',
+                        (len(prefix), prefix)).fetchall()
+    for row in rows:
+        new_path = os.path.join(new_rel, os.path.relpath(row['path'], old_rel))
+        conn.execute('UPDATE outputs SET path = ? WHERE path = ?',
+                        (new_path, row['path']))
+    conn.commit()
+
+
+def main(input_dir, output_dir):
+    '''
+    Catalog all HLS files in input_dir without running DSWE,
+    eg. to plan a batch before processing it.
+    '''
+    conn = open_catalog(output_dir)
+
+    files = [f.path for f in os.scandir(input_dir)
+                if os.path.isfile(f)]
+    for i, filename in enumerate(files, start=1):
+        if utils.is_hdf(filename):
+            get_scene(conn, filename)
+        print(f'{i} out of {len(files)} files cataloged')
+
+    for scene_info in list_scenes(conn):
+        print(scene_info['acquisition_date'], scene_info['product'],
+                scene_info['tile_id'], scene_info['cloud_cover'],
+                scene_info['spatial_coverage'], scene_info['path'])
+    conn.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+                description=('Catalog the metadata of HLS files '
+                'in the DSWE output directory, without running DSWE.'))
+    parser.add_argument('input_dir',
+            metavar='INPUT_DIRECTORY',
+            type=str,
+            help='path to directory with HLS data in HDF4 format')
+    parser.add_argument('output_dir',
+            metavar='OUTPUT_DIRECTORY',
+            type=str,
+            help='DSWE output directory where the catalog is kept')
+
+    args = parser.parse_args()
+    main(**vars(args))
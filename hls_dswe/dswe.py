@@ -14,6 +14,7 @@ import gdal
 import numpy as np
 import os
 import tarfile
+import catalog
 import utils_dswe as utils
 
 def clip_dem(dem_path, output_dir, geo_transform, shape):
@@ -54,7 +55,7 @@ def percent_slope(dem_clip, output_subdir, use_zeven_thorne):
     return slope
 
 
-def diagnostic_setup(band_dict, fill):
+def diagnostic_setup(band_dict, fill, window=None):
     '''
     Calculate indexes based on non-fill (valid) pixels of
     input bands for diagnostic tests.
@@ -65,6 +66,9 @@ def diagnostic_setup(band_dict, fill):
             paths to those bands or files
         fill : int : value of non-data (fill) pixels in the
             above bands
+    OPTIONAL INPUTS:
+        window : tuple of slice : (rows, cols) sub-window of
+            the bands to read; defaults to the full raster
     RETURNS:
         mndwi : numpy array : Modified Normalized Difference
             Wetness Index
@@ -77,12 +81,12 @@ def diagnostic_setup(band_dict, fill):
             Index
     '''
     # get bands as np arrays
-    blue = utils.file_to_array(band_dict['blue'])
-    green = utils.file_to_array(band_dict['green'])
-    red = utils.file_to_array(band_dict['red'])
-    nir = utils.file_to_array(band_dict['nir'])
-    swir1 = utils.file_to_array(band_dict['swir1'])
-    swir2 = utils.file_to_array(band_dict['swir2'])
+    blue = utils.file_to_array(band_dict['blue'], window)
+    green = utils.file_to_array(band_dict['green'], window)
+    red = utils.file_to_array(band_dict['red'], window)
+    nir = utils.file_to_array(band_dict['nir'], window)
+    swir1 = utils.file_to_array(band_dict['swir1'], window)
+    swir2 = utils.file_to_array(band_dict['swir2'], window)
 
     # calculate indexes and account for non-data (fill) values
     mndwi = (green - swir1) / (green + swir1)
@@ -104,7 +108,7 @@ def diagnostic_setup(band_dict, fill):
     return mndwi, mbsrv, mbsrn, awesh, ndvi
 
 
-def diagnostic_tests(band_dict, fill):
+def diagnostic_tests(band_dict, fill, window=None):
     '''
     Perform five diagnostic tests for each pixel using indexes
     and user-defined threshold values from thresholds.json.
@@ -115,6 +119,9 @@ def diagnostic_tests(band_dict, fill):
             paths to those bands or files
         fill : int : value of non-data (fill) pixels in the
             above bands
+    OPTIONAL INPUTS:
+        window : tuple of slice : (rows, cols) sub-window of
+            the bands to test; defaults to the full raster
     RETURNS:
         diag : numpy array : (n by m by 5) boolean array;
             third dimension contains boolean results for the
@@ -134,12 +141,12 @@ def diagnostic_tests(band_dict, fill):
     pswt_2_swir1 = thresholds_dict['PSWT_2_SWIR1']
     pswt_2_swir2 = thresholds_dict['PSWT_2_SWIR2']
     
-    mndwi, mbsrv, mbsrn, awesh, ndvi = diagnostic_setup(band_dict, fill)
+    mndwi, mbsrv, mbsrn, awesh, ndvi = diagnostic_setup(band_dict, fill, window)
     # get bands as np arrays
-    blue = utils.file_to_array(band_dict['blue'])
-    nir = utils.file_to_array(band_dict['nir'])
-    swir1 = utils.file_to_array(band_dict['swir1'])
-    swir2 = utils.file_to_array(band_dict['swir2'])
+    blue = utils.file_to_array(band_dict['blue'], window)
+    nir = utils.file_to_array(band_dict['nir'], window)
+    swir1 = utils.file_to_array(band_dict['swir1'], window)
+    swir2 = utils.file_to_array(band_dict['swir2'], window)
     
     # all bands are the same shape
     shape = blue.shape
@@ -342,6 +349,10 @@ def main(input_dir, output_dir, dem_path, include_tests,
     files = [f.path for f in os.scandir(input_dir)
                 if os.path.isfile(f)]
 
+    # scene metadata and outputs are recorded in a catalog in
+        # the output dir
+    conn = catalog.open_catalog(output_dir)
+
     for i, filename in enumerate(files):
         log(f'Processing file {i+1} of {len(files)}')
 
@@ -352,13 +363,14 @@ def main(input_dir, output_dir, dem_path, include_tests,
         os.makedirs(output_subdir, exist_ok=True)
 
         # check if file is HDF4 or TAR
-        with open(filename, 'rb') as f:
-            magic_string = f.read(4)
-        if magic_string == b'\x0e\x03\x13\x01':
-            # this is a HDF4 file
-            all_bands, metadata = utils.hdf_bands(filename)
+        if utils.is_hdf(filename):
+            # this is a HDF4 file; only opened if not yet cataloged
+            all_bands, scene_info = catalog.get_scene(conn, filename)
             if dem_path:
-                altitude, azimuth = utils.hdf_solar(metadata)
+                azimuth = scene_info['azimuth']
+                altitude = scene_info['altitude']
+                if azimuth is None or altitude is None:
+                    raise Exception(f'Solar azimuth and zenith angles are missing from the metadata of {filename}; they are needed for the hillshade when a DEM is given.')
         elif tarfile.is_tarfile(filename):
             # this is a tar file
             unpack_subdir = os.path.join(input_dir, subdir_name)
@@ -371,8 +383,13 @@ def main(input_dir, output_dir, dem_path, include_tests,
         band_dict, geo_transform, projection = utils.assign_bands(all_bands)
         fill, fill_array = utils.get_fill_array(band_dict)
 
+        # only run the DSWE kernels on the bounding window of
+            # valid pixels; fill borders are padded back with 255
+        window = utils.get_valid_window(fill_array)
+        fill_window = fill_array[window]
+
         log('Performing diagnostic tests')
-        diag = diagnostic_tests(band_dict, fill)
+        diag = diagnostic_tests(band_dict, fill, window)
 
         if include_tests:
             log('Saving diagnostic layer')
@@ -383,19 +400,25 @@ def main(input_dir, output_dir, dem_path, include_tests,
             diag_save = np.reshape(np.array(diag_int), diag.shape[0:2])
 
             # account for non-data (fill) pixels
-            diag_save[fill_array == True] = 255
+            diag_save[fill_window == True] = 255
+            diag_save = utils.pad_to_extent(diag_save,
+                                fill_array.shape, window)
 
             diag_filename = os.path.join(output_subdir, subdir_name + '_DIAG.tif')
             utils.save_output_tiff(diag_save, diag_filename,
                                         geo_transform, projection)
 
         log('Recoding diagnostic layer to interpreted DSWE')
-        intr = recode_to_interpreted(diag, fill_array)
+        intr = recode_to_interpreted(diag, fill_window)
+        intr = utils.pad_to_extent(intr, fill_array.shape, window)
 
         log('Saving interpreted layer')
         intr_filename = os.path.join(output_subdir, subdir_name + '_INTR.tif')
         utils.save_output_tiff(intr, intr_filename,
                                     geo_transform, projection)
+        catalog.record_output(conn, output_dir, intr_filename, 'INTR',
+                                    geo_transform, projection, intr.shape,
+                                    catalog.valid_fraction(intr))
 
         # only calculate masked layers if DEM is provided by user
         if dem_path:
@@ -426,10 +449,14 @@ def main(input_dir, output_dir, dem_path, include_tests,
             log('Saving masked interpreted layer')
             inwm_filename = os.path.join(output_subdir, subdir_name + '_INWM.tif')
             utils.save_output_tiff(inwm, inwm_filename, geo_transform, projection)
+            catalog.record_output(conn, output_dir, inwm_filename, 'INWM',
+                                    geo_transform, projection, inwm.shape,
+                                    catalog.valid_fraction(inwm))
 
             log('Saving mask')
             mask_filename = os.path.join(output_subdir, subdir_name + '_MASK.tif')
             utils.save_output_tiff(mask, mask_filename, geo_transform, projection)
+    conn.close()
     log('Done')
 
 verbose = False
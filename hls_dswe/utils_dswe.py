@@ -1,12 +1,28 @@
 '''
 Contains utility functions used in DSWE code.
 '''
+import datetime
 import gdal
 import json
 import numpy as np
 import os
+import re
 import tarfile
 
+# HLS file names, eg. HLS.L30.T18TWL.2019001.v1.4.hdf
+HLS_PATTERN = re.compile(r'HLS\.([LS]30)\.T(\w{5})\.(\d{4})(\d{3})\.v\d\.\d')
+# Landsat ARD scene IDs, eg. LT05_CU_029008_19990127_20190120_C01_V01
+ARD_PATTERN = re.compile(r'(L[CETM]0\d)_CU_(\d{6})_(\d{4})(\d{2})(\d{2})_\d{8}_C01_V01')
+
+def is_hdf(filename):
+    '''
+    Check the magic number of a file to see if it is HDF4.
+    '''
+    with open(filename, 'rb') as f:
+        magic_string = f.read(4)
+    return magic_string == b'\x0e\x03\x13\x01'
+
+
 def hdf_bands(filename):
     '''
     Get file paths to all bands in an HDF4 file.
@@ -23,6 +39,36 @@ def hdf_bands(filename):
     return all_bands, metadata
 
 
+def search_metadata(metadata, search_dict):
+    '''
+    Find values for several metadata fields in one pass over
+    the metadata keys.
+    INPUTS:
+        metadata : dict : dictionary of metadata from HLS file
+        search_dict : dict : keys are names to return, values
+            are strings to search for in the metadata keys
+    RETURNS:
+        found : dict : names from search_dict with the first
+            matching metadata value; missing fields are None
+    '''
+    found = dict.fromkeys(search_dict)
+    for key, val in metadata.items():
+        for name, search in search_dict.items():
+            if found[name] is None and search in key:
+                found[name] = val
+    return found
+
+
+def mean_value(value_str):
+    '''
+    Convert a metadata value to a float; takes the average
+    when there are multiple comma separated numbers.
+    '''
+    value_list = value_str.replace(' ', '').split(',')
+    value_float = [float(i) for i in value_list]
+    return sum(value_float) / len(value_float)
+
+
 def hdf_solar(metadata):
     '''
     Gets solar azimuth and altitude from HLS file metadata.
@@ -30,32 +76,92 @@ def hdf_solar(metadata):
         metadata : dict : dictionary of metadata from HLS file
     RETURNS:
         azimuth : float : solar azimuth in degrees
-        altitude : float : solar altitude in degrees
+        altitude : float : solar altitude in degrees; both are
+            None if the angles are missing from the metadata
     '''
-    # search strings
-    azimuth_search = 'MEAN_SUN_AZIMUTH_ANGLE'
-    zenith_search = 'MEAN_SUN_ZENITH_ANGLE'
-    
     # search metadata
-    azimuth_str = [val for key, val in metadata.items()
-                    if azimuth_search in key][0]
-    zenith_str = [val for key, val in metadata.items()
-                    if zenith_search in key][0]
-
-    # fix for case where there are sometimes multiple numbers
-    azimuth_list = azimuth_str.replace(' ', '').split(',')
-    zenith_list = zenith_str.replace(' ', '').split(',')
-
-    azimuth_float = [float(i) for i in azimuth_list]
-    zenith_float = [float(i) for i in zenith_list]
-    
-    # take the average if multiple numbers
-    azimuth = sum(azimuth_float) / len(azimuth_float)
-    zenith = sum(zenith_float) / len(zenith_float)
+    found = search_metadata(metadata,
+                {'azimuth': 'MEAN_SUN_AZIMUTH_ANGLE',
+                'zenith': 'MEAN_SUN_ZENITH_ANGLE'})
+    if not (found['azimuth'] and found['zenith']):
+        return None, None
+
+    azimuth = mean_value(found['azimuth'])
+    zenith = mean_value(found['zenith'])
     altitude = 90.0 - zenith
     return azimuth, altitude
 
 
+def hdf_scene_info(filename, metadata):
+    '''
+    Parse the scene information needed for processing and
+    planning from an HLS file name and its metadata.
+    INPUTS:
+        filename : str : path to HDF4 file, named with the
+            HLS convention (eg. HLS.L30.T18TWL.2019001.v1.4.hdf)
+        metadata : dict : dictionary of metadata from HLS file
+    RETURNS:
+        scene_info : dict : solar azimuth and altitude (deg),
+            product (L30 or S30), sensor, tile ID, acquisition
+            date (YYYY-MM-DD), cloud cover and spatial
+            coverage (percent)
+    '''
+    found = search_metadata(metadata,
+                {'sensor': 'SENSOR',
+                'spacecraft': 'SPACECRAFT_NAME',
+                'cloud_cover': 'cloud_coverage',
+                'spatial_coverage': 'spatial_coverage'})
+
+    scene_info = dict.fromkeys(['azimuth', 'altitude', 'product',
+                    'sensor', 'tile_id', 'acquisition_date',
+                    'cloud_cover', 'spatial_coverage'])
+    scene_info['azimuth'], scene_info['altitude'] = hdf_solar(metadata)
+    scene_info['sensor'] = found['sensor'] or found['spacecraft']
+    if found['cloud_cover']:
+        scene_info['cloud_cover'] = float(found['cloud_cover'])
+    if found['spatial_coverage']:
+        scene_info['spatial_coverage'] = float(found['spatial_coverage'])
+
+    # product, tile and date are given in the HLS file name
+    scene_name_info = parse_scene_name(filename)
+    scene_info['product'] = scene_name_info['sensor']
+    scene_info['tile_id'] = scene_name_info['tile_id']
+    scene_info['acquisition_date'] = scene_name_info['acquisition_date']
+    return scene_info
+
+
+def parse_scene_name(filename):
+    '''
+    Get acquisition date, sensor and tile from an HLS or
+    Landsat ARD file name (or a DSWE output named after one).
+    INPUTS:
+        filename : str : path to file
+    RETURNS:
+        scene_name_info : dict : acquisition date (YYYY-MM-DD),
+            sensor and tile ID; values are None if the file
+            name does not follow either convention
+    '''
+    name = os.path.basename(filename)
+    scene_name_info = dict.fromkeys(['acquisition_date', 'sensor', 'tile_id'])
+
+    hls_match = HLS_PATTERN.match(name)
+    ard_match = ARD_PATTERN.match(name)
+    if hls_match:
+        sensor, tile_id, year, year_day = hls_match.groups()
+        file_date = (datetime.date(int(year), 1, 1) +
+                        datetime.timedelta(int(year_day) - 1))
+    elif ard_match:
+        sensor, tile_id, year, month, day = ard_match.groups()
+        file_date = datetime.date(int(year), int(month), int(day))
+    else:
+        return scene_name_info
+
+    scene_name_info['acquisition_date'] = file_date.isoformat()
+    scene_name_info['sensor'] = sensor
+    scene_name_info['tile_id'] = tile_id
+    return scene_name_info
+
+
 def tar_bands(filename, unpack_subdir):
     '''
     Untar and get paths to all bands in a TAR file.
@@ -205,15 +311,67 @@ def get_fill_array(band_dict):
     return fill, fill_array
 
 
-def file_to_array(filename):
+def file_to_array(filename, window=None):
     '''
-    Open file as GDAL dataset and read as numpy array.
+    Open file as GDAL dataset and read as numpy array;
+    if window (tuple of row and column slices) is given,
+    only that sub-window of the raster is read.
     '''
     data = gdal.Open(filename)
-    array = data.GetRasterBand(1).ReadAsArray()
+    band = data.GetRasterBand(1)
+    if window is None:
+        array = band.ReadAsArray()
+    else:
+        rows, cols = window
+        array = band.ReadAsArray(cols.start, rows.start,
+                    cols.stop - cols.start, rows.stop - rows.start)
     return array
 
 
+def get_valid_window(fill_array):
+    '''
+    Find the bounding window of valid (non-fill) pixels.
+    INPUTS:
+        fill_array : numpy array : (n by m) boolean array;
+            pixels are True where any input band has non-data
+            (fill) values
+    RETURNS:
+        window : tuple of slice : (rows, cols) slices of the
+            smallest window containing every valid pixel; a
+            single pixel window if the scene is entirely fill
+    '''
+    valid = ~fill_array
+    rows = np.flatnonzero(valid.any(axis=1))
+    cols = np.flatnonzero(valid.any(axis=0))
+
+    if rows.size == 0:
+        # no valid data; keep a 1 pixel window so the
+            # kernels still return an (all fill) result
+        return (slice(0, 1), slice(0, 1))
+
+    window = (slice(int(rows[0]), int(rows[-1]) + 1),
+                slice(int(cols[0]), int(cols[-1]) + 1))
+    return window
+
+
+def pad_to_extent(data, shape, window, fill=255):
+    '''
+    Paste data computed on a sub-window back into an array
+    with the full extent of the scene.
+    INPUTS:
+        data : numpy array : data calculated on window
+        shape : tuple : (n, m) shape of the full scene
+        window : tuple of slice : (rows, cols) position of
+            data in the full scene
+        fill : int : value for pixels outside of window
+    RETURNS:
+        full : numpy array : (n by m) array of data
+    '''
+    full = np.full(shape, fill, dtype=data.dtype)
+    full[window] = data
+    return full
+
+
 def fill_value(filename):
     '''
     Find fill (no-data) value for a GDAL dataset.
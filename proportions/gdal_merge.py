@@ -30,9 +30,12 @@
 # building the stack.
 # anssi.pekkarinen@fao.org
 
+import collections
+import concurrent.futures
 import math
 import os.path
 import sys
+import threading
 import time
 
 from osgeo import gdal
@@ -110,19 +113,16 @@ def raster_copy(s_fh, s_xoff, s_yoff, s_xsize, s_ysize, s_band_n,
             nodata)
 
     s_band = s_fh.GetRasterBand(s_band_n)
-    m_band = None
-    # Works only in binary mode and doesn't take into account
-    # intermediate transparency values for compositing.
-    if s_band.GetMaskFlags() != gdal.GMF_ALL_VALID:
-        m_band = s_band.GetMaskBand()
-    elif s_band.GetColorInterpretation() == gdal.GCI_AlphaBand:
-        m_band = s_band
+    m_band = source_mask_band(s_band)
     if m_band is not None:
         return raster_copy_with_mask(
             s_fh, s_xoff, s_yoff, s_xsize, s_ysize, s_band_n,
             t_fh, t_xoff, t_yoff, t_xsize, t_ysize, t_band_n,
             m_band)
 
+    # blocks cached by earlier copies are written back first
+    target_blocks.flush()
+
     s_band = s_fh.GetRasterBand(s_band_n)
     t_band = t_fh.GetRasterBand(t_band_n)
 
@@ -136,29 +136,39 @@ def raster_copy(s_fh, s_xoff, s_yoff, s_xsize, s_ysize, s_band_n,
 # =============================================================================
 
 
+def source_mask_band(s_band):
+    """
+    Return the band masking the valid pixels of s_band, or None if all
+    of its pixels are valid.
+    """
+    # Works only in binary mode and doesn't take into account
+    # intermediate transparency values for compositing.
+    if s_band.GetMaskFlags() != gdal.GMF_ALL_VALID:
+        return s_band.GetMaskBand()
+    elif s_band.GetColorInterpretation() == gdal.GCI_AlphaBand:
+        return s_band
+    return None
+
+# =============================================================================
+
+
 def raster_copy_with_nodata(s_fh, s_xoff, s_yoff, s_xsize, s_ysize, s_band_n,
                             t_fh, t_xoff, t_yoff, t_xsize, t_ysize, t_band_n,
                             nodata):
-    try:
-        import numpy as Numeric
-    except ImportError:
-        import Numeric
+    import numpy
 
     s_band = s_fh.GetRasterBand(s_band_n)
-    t_band = t_fh.GetRasterBand(t_band_n)
+    read_src = source_reader(s_band, s_xoff, s_yoff, s_xsize, s_ysize,
+                             t_xsize, t_ysize)
 
-    data_src = s_band.ReadAsArray(s_xoff, s_yoff, s_xsize, s_ysize,
-                                  t_xsize, t_ysize)
-    data_dst = t_band.ReadAsArray(t_xoff, t_yoff, t_xsize, t_ysize)
+    def read_valid(xoff, yoff, xsize, ysize):
+        data_src = read_src(xoff, yoff, xsize, ysize)
+        if not numpy.isnan(nodata):
+            return data_src, numpy.not_equal(data_src, nodata)
+        return data_src, ~numpy.isnan(data_src)
 
-    if not Numeric.isnan(nodata):
-        nodata_test = Numeric.equal(data_src, nodata)
-    else:
-        nodata_test = Numeric.isnan(data_src)
-
-    to_write = Numeric.choose(nodata_test, (data_src, data_dst))
-
-    t_band.WriteArray(to_write, t_xoff, t_yoff)
+    composite_blocks(t_fh, t_xoff, t_yoff, t_xsize, t_ysize, t_band_n,
+                     read_valid)
 
     return 0
 
@@ -168,26 +178,278 @@ def raster_copy_with_nodata(s_fh, s_xoff, s_yoff, s_xsize, s_ysize, s_band_n,
 def raster_copy_with_mask(s_fh, s_xoff, s_yoff, s_xsize, s_ysize, s_band_n,
                           t_fh, t_xoff, t_yoff, t_xsize, t_ysize, t_band_n,
                           m_band):
-    try:
-        import numpy as Numeric
-    except ImportError:
-        import Numeric
+    import numpy
 
     s_band = s_fh.GetRasterBand(s_band_n)
+    read_src = source_reader(s_band, s_xoff, s_yoff, s_xsize, s_ysize,
+                             t_xsize, t_ysize)
+    read_mask = source_reader(m_band, s_xoff, s_yoff, s_xsize, s_ysize,
+                              t_xsize, t_ysize)
+
+    def read_valid(xoff, yoff, xsize, ysize):
+        data_mask = read_mask(xoff, yoff, xsize, ysize)
+        return (read_src(xoff, yoff, xsize, ysize),
+                numpy.not_equal(data_mask, 0))
+
+    composite_blocks(t_fh, t_xoff, t_yoff, t_xsize, t_ysize, t_band_n,
+                     read_valid)
+
+    return 0
+
+# =============================================================================
+
+
+def source_reader(s_band, s_xoff, s_yoff, s_xsize, s_ysize,
+                  t_xsize, t_ysize):
+    """
+    Return a function reading parts of a source window, given as
+    (xoff, yoff, xsize, ysize) in pixels of the target window.
+
+    Sources at the target resolution are read part by part; resampled
+    sources are read once at the target resolution, as parts of them
+    do not fall on whole source pixels.
+    """
+    if s_xsize == t_xsize and s_ysize == t_ysize:
+        def read(xoff, yoff, xsize, ysize):
+            return s_band.ReadAsArray(s_xoff + xoff, s_yoff + yoff,
+                                      xsize, ysize)
+        return read
+
+    data = s_band.ReadAsArray(s_xoff, s_yoff, s_xsize, s_ysize,
+                              t_xsize, t_ysize)
+
+    def read_resampled(xoff, yoff, xsize, ysize):
+        return data[yoff:yoff + ysize, xoff:xoff + xsize]
+    return read_resampled
+
+# =============================================================================
+
+
+def composite_blocks(t_fh, t_xoff, t_yoff, t_xsize, t_ysize, t_band_n,
+                     read_valid):
+    """
+    Composite a source into a target window, block by block of the
+    target band.
+
+    read_valid -- function returning the source data and its valid
+    pixels for a part of the target window (see source_reader); valid
+    pixels are copied in place into the cached target block.
+    """
+    import numpy
+
     t_band = t_fh.GetRasterBand(t_band_n)
+    b_xsize, b_ysize = target_blocks.block_size(t_band)
+
+    for b_yoff in range(t_yoff - t_yoff % b_ysize, t_yoff + t_ysize, b_ysize):
+        y_start = max(b_yoff, t_yoff)
+        y_stop = min(b_yoff + b_ysize, t_yoff + t_ysize)
+
+        for b_xoff in range(t_xoff - t_xoff % b_xsize, t_xoff + t_xsize,
+                            b_xsize):
+            x_start = max(b_xoff, t_xoff)
+            x_stop = min(b_xoff + b_xsize, t_xoff + t_xsize)
+
+            block = target_blocks.get(t_fh, t_band_n, b_xoff, b_yoff,
+                                      min(b_xsize, t_band.XSize - b_xoff),
+                                      min(b_ysize, t_band.YSize - b_yoff))
+            data_src, valid = read_valid(x_start - t_xoff, y_start - t_yoff,
+                                         x_stop - x_start, y_stop - y_start)
+            numpy.copyto(block[y_start - b_yoff:y_stop - b_yoff,
+                               x_start - b_xoff:x_stop - b_xoff],
+                         data_src, where=valid, casting='unsafe')
 
-    data_src = s_band.ReadAsArray(s_xoff, s_yoff, s_xsize, s_ysize,
-                                  t_xsize, t_ysize)
-    data_mask = m_band.ReadAsArray(s_xoff, s_yoff, s_xsize, s_ysize,
-                                   t_xsize, t_ysize)
-    data_dst = t_band.ReadAsArray(t_xoff, t_yoff, t_xsize, t_ysize)
+# =============================================================================
 
-    mask_test = Numeric.equal(data_mask, 0)
-    to_write = Numeric.choose(mask_test, (data_src, data_dst))
 
-    t_band.WriteArray(to_write, t_xoff, t_yoff)
+class block_cache(object):
+    """
+    Cache of target blocks, kept between the copies of consecutive
+    source files, so that each target block is read and written about
+    once instead of once per source file overlapping it.  Blocks are
+    written back to the target when evicted (least recently used first)
+    or flushed.
+    """
 
-    return 0
+    def __init__(self, max_bytes=256 * 1024 * 1024, block_pixels=512):
+        self.max_bytes = max_bytes
+        self.block_pixels = block_pixels
+        self.n_bytes = 0
+        self.t_fh = None
+        self.blocks = collections.OrderedDict()
+
+    def block_size(self, t_band):
+        """
+        Size of the cached blocks of t_band: whole multiples of its
+        natural block size, of at least block_pixels if possible.
+        """
+        b_xsize, b_ysize = t_band.GetBlockSize()
+        return (b_xsize * max(1, self.block_pixels // b_xsize),
+                b_ysize * max(1, self.block_pixels // b_ysize))
+
+    def get(self, t_fh, t_band_n, b_xoff, b_yoff, b_xsize, b_ysize):
+        """
+        Return the target block at b_xoff, b_yoff as an array that can
+        be updated in place, reading it from the target if not cached.
+        """
+        if t_fh is not self.t_fh:
+            self.flush()
+            self.t_fh = t_fh
+
+        key = (t_band_n, b_xoff, b_yoff)
+        if key in self.blocks:
+            self.blocks.move_to_end(key)
+            return self.blocks[key]
+
+        data = t_fh.GetRasterBand(t_band_n).ReadAsArray(b_xoff, b_yoff,
+                                                        b_xsize, b_ysize)
+        self.blocks[key] = data
+        self.n_bytes += data.nbytes
+        while self.n_bytes > self.max_bytes and len(self.blocks) > 1:
+            self.evict()
+        return data
+
+    def evict(self):
+        (t_band_n, b_xoff, b_yoff), data = self.blocks.popitem(last=False)
+        self.t_fh.GetRasterBand(t_band_n).WriteArray(data, b_xoff, b_yoff)
+        self.n_bytes -= data.nbytes
+
+    def flush(self):
+        """Write all cached blocks back to the target."""
+        while self.blocks:
+            self.evict()
+        self.t_fh = None
+
+
+target_blocks = block_cache()
+
+# =============================================================================
+
+
+def merge_rows(t_data, t_row, copies, nodata):
+    """
+    Composite sources into rows of the target, held in t_data (all
+    columns of the target, from row t_row).  Run on worker threads:
+    each thread opens its own source handles and only updates its
+    own rows, so no locking is needed.
+
+    copies -- list of (file_info, source band, window) in merge order;
+    see file_info.target_window.
+
+    Returns t_data.
+    """
+    import numpy
+
+    handles = getattr(thread_handles, 'handles', None)
+    if handles is None:
+        handles = thread_handles.handles = {}
+
+    r_stop = t_row + t_data.shape[0]
+    for fi, s_band_n, window in copies:
+        sw_xoff, sw_yoff, _, _, tw_xoff, tw_yoff, tw_xsize, tw_ysize = window
+        y_start = max(t_row, tw_yoff)
+        y_stop = min(r_stop, tw_yoff + tw_ysize)
+        if y_stop <= y_start:
+            continue
+
+        if fi.filename not in handles:
+            handles[fi.filename] = gdal.Open(fi.filename)
+        s_band = handles[fi.filename].GetRasterBand(s_band_n)
+
+        s_window = (sw_xoff, sw_yoff + y_start - tw_yoff,
+                    tw_xsize, y_stop - y_start)
+        data_src = s_band.ReadAsArray(*s_window)
+        if nodata is not None:
+            if not numpy.isnan(nodata):
+                valid = numpy.not_equal(data_src, nodata)
+            else:
+                valid = ~numpy.isnan(data_src)
+        else:
+            m_band = source_mask_band(s_band)
+            if m_band is None:
+                valid = True
+            else:
+                valid = numpy.not_equal(m_band.ReadAsArray(*s_window), 0)
+
+        numpy.copyto(t_data[y_start - t_row:y_stop - t_row,
+                            tw_xoff:tw_xoff + tw_xsize],
+                     data_src, where=valid, casting='unsafe')
+
+    return t_data
+
+
+thread_handles = threading.local()
+
+# =============================================================================
+
+
+def merge_parallel(file_infos, t_fh, bands, separate, nodata, threads):
+    """
+    Merge file_infos into t_fh on several threads.
+
+    The target is split into disjoint rows of blocks, and each row is
+    composited by a worker from the sources intersecting it, in merge
+    order; the main thread reads the rows of the target and writes
+    the composited rows back, so only it touches the target.
+
+    Returns 1 on success, or 0 if a source would have to be resampled
+    to the target resolution, in which case nothing is copied and the
+    serial merge should be used instead.
+    """
+    t_geotransform = t_fh.GetGeoTransform()
+
+    # target band -> list of copies into it, in merge order
+    copies = {}
+    t_band = 1
+    for fi in file_infos:
+        if separate == 0:
+            band_pairs = [(band, band) for band in range(1, bands + 1)]
+        else:
+            band_pairs = [(band, t_band + band - 1)
+                          for band in range(1, fi.bands + 1)]
+            t_band = t_band + fi.bands
+
+        window = fi.target_window(t_geotransform, t_fh.RasterXSize,
+                                  t_fh.RasterYSize)
+        if window is None:
+            continue
+        if window[2] != window[6] or window[3] != window[7]:
+            return 0
+        for s_band_n, t_band_n in band_pairs:
+            copies.setdefault(t_band_n, []).append((fi, s_band_n, window))
+
+    n_rows = target_blocks.block_size(t_fh.GetRasterBand(1))[1]
+    jobs = [(t_band_n, t_row) for t_band_n in sorted(copies)
+            for t_row in range(0, t_fh.RasterYSize, n_rows)]
+
+    def write(job):
+        t_band_n, t_row, future = job
+        t_fh.GetRasterBand(t_band_n).WriteArray(future.result(), 0, t_row)
+
+    with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+        pending = collections.deque()
+        for job_n, (t_band_n, t_row) in enumerate(jobs):
+            r_stop = min(t_row + n_rows, t_fh.RasterYSize)
+            row_copies = [copy for copy in copies[t_band_n]
+                          if copy[2][5] < r_stop and
+                          copy[2][5] + copy[2][7] > t_row]
+            if row_copies:
+                t_data = t_fh.GetRasterBand(t_band_n).ReadAsArray(
+                    0, t_row, t_fh.RasterXSize, r_stop - t_row)
+                future = executor.submit(merge_rows, t_data, t_row,
+                                         row_copies, nodata)
+                pending.append((t_band_n, t_row, future))
+
+            # bound the number of rows held in memory
+            while len(pending) > 2 * threads:
+                write(pending.popleft())
+
+            if quiet == 0 and verbose == 0:
+                progress((job_n + 1) / float(len(jobs)))
+
+        while pending:
+            write(pending.popleft())
+
+    return 1
 
 # =============================================================================
 
@@ -271,29 +533,19 @@ class file_info(object):
         print('UL:(%f,%f)   LR:(%f,%f)'
               % (self.ulx, self.uly, self.lrx, self.lry))
 
-    def copy_into(self, t_fh, s_band=1, t_band=1, nodata_arg=None):
+    def target_window(self, t_geotransform, t_xsize, t_ysize):
         """
-        Copy this files image into target file.
-
-        This method will compute the overlap area of the file_info objects
-        file, and the target gdal.Dataset object, and copy the image data
-        for the common window area.  It is assumed that the files are in
-        a compatible projection ... no checking or warping is done.  However,
-        if the destination file is a different resolution, or different
-        image pixel type, the appropriate resampling and conversions will
-        be done (using normal GDAL promotion/demotion rules).
+        Compute the overlap area of this file and a target of t_xsize
+        by t_ysize pixels with t_geotransform.
 
-        t_fh -- gdal.Dataset object for the file into which some or all
-        of this file may be copied.
-
-        Returns 1 on success (or if nothing needs to be copied), and zero one
-        failure.
+        Returns (sw_xoff, sw_yoff, sw_xsize, sw_ysize, tw_xoff, tw_yoff,
+        tw_xsize, tw_ysize), the source and target windows in pixel
+        coordinates, or None if they do not intersect.
         """
-        t_geotransform = t_fh.GetGeoTransform()
         t_ulx = t_geotransform[0]
         t_uly = t_geotransform[3]
-        t_lrx = t_geotransform[0] + t_fh.RasterXSize * t_geotransform[1]
-        t_lry = t_geotransform[3] + t_fh.RasterYSize * t_geotransform[5]
+        t_lrx = t_geotransform[0] + t_xsize * t_geotransform[1]
+        t_lry = t_geotransform[3] + t_ysize * t_geotransform[5]
 
         # figure out intersection region
         tgw_ulx = max(t_ulx, self.ulx)
@@ -307,11 +559,11 @@ class file_info(object):
 
         # do they even intersect?
         if tgw_ulx >= tgw_lrx:
-            return 1
+            return None
         if t_geotransform[5] < 0 and tgw_uly <= tgw_lry:
-            return 1
+            return None
         if t_geotransform[5] > 0 and tgw_uly >= tgw_lry:
-            return 1
+            return None
 
         # compute target window in pixel coordinates.
         tw_xoff = int((tgw_ulx - t_geotransform[0]) / t_geotransform[1] + 0.1)
@@ -322,7 +574,7 @@ class file_info(object):
             - tw_yoff
 
         if tw_xsize < 1 or tw_ysize < 1:
-            return 1
+            return None
 
         # Compute source window in pixel coordinates.
         sw_xoff = int((tgw_ulx - self.geotransform[0]) / self.geotransform[1])
@@ -333,7 +585,35 @@ class file_info(object):
                        self.geotransform[5] + 0.5) - sw_yoff
 
         if sw_xsize < 1 or sw_ysize < 1:
+            return None
+
+        return (sw_xoff, sw_yoff, sw_xsize, sw_ysize,
+                tw_xoff, tw_yoff, tw_xsize, tw_ysize)
+
+    def copy_into(self, t_fh, s_band=1, t_band=1, nodata_arg=None):
+        """
+        Copy this files image into target file.
+
+        This method will compute the overlap area of the file_info objects
+        file, and the target gdal.Dataset object, and copy the image data
+        for the common window area.  It is assumed that the files are in
+        a compatible projection ... no checking or warping is done.  However,
+        if the destination file is a different resolution, or different
+        image pixel type, the appropriate resampling and conversions will
+        be done (using normal GDAL promotion/demotion rules).
+
+        t_fh -- gdal.Dataset object for the file into which some or all
+        of this file may be copied.
+
+        Returns 1 on success (or if nothing needs to be copied), and zero one
+        failure.
+        """
+        window = self.target_window(t_fh.GetGeoTransform(), t_fh.RasterXSize,
+                                    t_fh.RasterYSize)
+        if window is None:
             return 1
+        sw_xoff, sw_yoff, sw_xsize, sw_ysize, \
+            tw_xoff, tw_yoff, tw_xsize, tw_ysize = window
 
         # Open the source file, and copy the selected region.
         s_fh = gdal.Open(self.filename)
@@ -349,7 +629,7 @@ def Usage():
     print('                     [-ps pixelsize_x pixelsize_y] [-tap] [-separate] [-q] [-v] [-pct]')
     print('                     [-ul_lr ulx uly lrx lry] [-init "value [value...]"]')
     print('                     [-n nodata_value] [-a_nodata output_nodata_value]')
-    print('                     [-ot datatype] [-createonly] input_files')
+    print('                     [-ot datatype] [-createonly] [-threads n] input_files')
     print('                     [--help-general]')
     print('')
 
@@ -378,6 +658,7 @@ def main(argv=None):
     pre_init = []
     band_type = None
     createonly = 0
+    threads = 1
     bTargetAlignedPixels = False
     start_time = time.time()
 
@@ -406,6 +687,10 @@ def main(argv=None):
         elif arg == '-createonly':
             createonly = 1
 
+        elif arg == '-threads':
+            i = i + 1
+            threads = int(argv[i])
+
         elif arg == '-separate':
             separate = 1
 
@@ -579,8 +864,17 @@ def main(argv=None):
         progress(0.0)
     fi_processed = 0
 
+    # merge on several threads if asked, unless sources have to be
+    # resampled, which is only done by the serial merge
+    merged = 0
+    if threads > 1 and createonly == 0:
+        merged = merge_parallel(file_infos, t_fh, bands, separate, nodata,
+                                threads)
+        if merged == 0 and quiet == 0:
+            print('Sources have to be resampled, merging on one thread.')
+
     for fi in file_infos:
-        if createonly != 0:
+        if createonly != 0 or merged != 0:
             continue
 
         if verbose != 0:
@@ -603,7 +897,8 @@ def main(argv=None):
         if quiet == 0 and verbose == 0:
             progress(fi_processed / float(len(file_infos)))
 
-    # Force file to be closed.
+    # Write back the cached blocks, and force file to be closed.
+    target_blocks.flush()
     t_fh = None
 
 
@@ -2,11 +2,15 @@
 Main code to calculate proportions.
 '''
 import argparse
+import datetime
 import os
 import utils_proportions as utils
 import time_periods as tp
 
-def main(main_dir, dswe_layer, time_period, multiyear=None):
+def main(main_dir, dswe_layer, time_period, multiyear=None, rescan=False,
+            workers=1, chunk_size=None, update=False, water_year_start=10,
+            season_starts=None, days=None, step=None, start=None,
+            bin_edges=None, min_valid=None):
     '''
     Calculate proportions of pixels inundated with open or 
     partial surface water over time.
@@ -14,46 +18,65 @@ def main(main_dir, dswe_layer, time_period, multiyear=None):
         main_dir : str : main directory where DSWE data is located
         dswe_layer : str : DSWE layer to be used in calculations ;
             INWM or INTR
-        time_period : str : time period to process files by;
-            year, month, month_across_years, season, multiyear 
+        time_period : list of str : time periods to process files by;
+            year, month, month_across_years, season, multiyear,
+            water_year, hydro_season, fixed, rolling, custom;
+            all time periods are processed in one pass over the files
         multiyear : int : integer number of years to process files by;
             only required if timeperiod=multiyear
+        water_year_start : int : first month of water years
+        season_starts : list of int : first month of each
+            hydrological season; only required if timeperiod=hydro_season
+        days : int : number of days of fixed or rolling windows;
+            only required if timeperiod=fixed or rolling
+        step : int : number of days between the starts of rolling
+            windows; only required if timeperiod=rolling
+        start : date : start of the first fixed or rolling window;
+            defaults to the date of the first file
+        bin_edges : list of dates : edges of custom time periods;
+            only required if timeperiod=custom
+        rescan : bool : if True, walk the directory tree to add
+            uncataloged DSWE files to the catalog
+        min_valid : float : if given, only use DSWE files with
+            at least this percent of valid pixels in the catalog
+        workers : int : number of processes to use; if more than
+            one, periods (or parts of them) are processed in parallel
+        chunk_size : int : number of rows and columns of the chunks
+            the grid is processed in, to bound memory use; if None,
+            the whole grid is processed at once
+        update : bool : if True, only process periods with new
+            DSWE files, adding their counts to the counts saved
+            by earlier runs
     RETURNS:
         processes and saves data
     '''
     # move to main directory
     os.chdir(main_dir)
 
-    # make a list of DSWE files of interest and their dates
-    all_files, all_dates = utils.get_files(main_dir, dswe_layer)
-    num_files = len(all_files)
-    print(f'Processing {num_files} total scenes from {min(all_dates)} to {max(all_dates)}')
+    # index of DSWE files of interest, sorted by date
+    records = utils.get_records(main_dir, dswe_layer, rescan, min_valid)
+    index = utils.SceneIndex(records)
+    if len(index) == 0:
+        raise Exception(f'No {dswe_layer} files to process in {main_dir}; '
+                        'check --min_valid, or try --rescan')
+    num_files = len(index)
+    print(f'Processing {num_files} total scenes from {index.dates[0]} to {index.dates[-1]}')
 
-    # make output directory
-    if time_period == 'multiyear':
-        time_period = time_period + '_' + str(multiyear)
-    prop_dir = utils.make_output_dir(main_dir, time_period)
+    # make output directories
+    if isinstance(time_period, str):
+        time_period = [time_period]
+    options = {'multiyear': multiyear, 'water_year_start': water_year_start,
+                'season_starts': season_starts, 'days': days, 'step': step,
+                'start': start, 'bin_edges': bin_edges}
+    calendars = tp.make_calendars(time_period, index.dates, options)
+    prop_dirs = utils.make_output_dirs(main_dir, calendars)
 
-    # initialize extent to be overwritten
-    extent_0 = [1e12, -1e12, -1e12, 1e12]
+    # common grid covering the max extent of all files
+    grid = utils.make_grid(records)
 
-    # loop through all files to calculate max extent
-    #XXX is this the correct way of calculating this??
-    for file in all_files:
-        extent_0 = utils.find_max_extent(file, extent_0)
-    max_extent = extent_0
-
-    # gather and process files depending on time period chosen
-    if time_period == 'year':
-        tp.process_by_year(all_files, all_dates, prop_dir, max_extent)
-    elif time_period == 'month':
-        tp.process_by_month(all_files, all_dates, prop_dir, max_extent)
-    elif time_period == 'month_across_years':
-        tp.process_by_month_across_years(all_files, all_dates, prop_dir, max_extent)
-    elif time_period == 'season':
-        tp.process_by_season(all_files, all_dates, prop_dir, max_extent)
-    elif 'multiyear' in time_period:
-        tp.process_by_multiyear(all_files, all_dates, prop_dir, max_extent, multiyear)
+    # process files for all time periods chosen
+    tp.process_chunks(index, prop_dirs, grid, calendars, workers,
+                        chunk_size, update)
 
     print('Processing done!')
 
@@ -69,17 +92,68 @@ if __name__ == '__main__':
             choices=['INWM', 'INTR'], 
             help='DSWE layer to be used in calculations' )
     parser.add_argument('time_period',
-            type=str.lower, 
-            choices=['year', 'month', 'month_across_years', 'season', 'multiyear'], 
-            help='time period to process files by')
+            type=str.lower, nargs='+',
+            choices=tp.TIME_PERIODS,
+            help='time period(s) to process files by')
     parser.add_argument('-y', 
             metavar='NUM_YEARS', dest='multiyear',
             type=int, required=False, 
             help='integer number of years to process files by; only required if timeperiod=multiyear')
+    parser.add_argument('--water_year_start',
+            metavar='MONTH', type=int, default=10,
+            help='first month of water years; defaults to 10 (October)')
+    parser.add_argument('--season_starts',
+            metavar='MONTH', type=int, nargs='+',
+            help='first month of each hydrological season; only required if timeperiod=hydro_season')
+    parser.add_argument('--days',
+            metavar='N', type=int,
+            help='number of days of each window; only required if timeperiod=fixed or rolling')
+    parser.add_argument('--step',
+            metavar='N', type=int,
+            help='number of days between the starts of rolling windows; only required if timeperiod=rolling')
+    parser.add_argument('--start',
+            metavar='YYYY-MM-DD', type=datetime.date.fromisoformat,
+            help='start of the first fixed or rolling window; defaults to the date of the first file')
+    parser.add_argument('--bin_edges',
+            metavar='YYYY-MM-DD', type=datetime.date.fromisoformat, nargs='+',
+            help='edges of custom time periods, each running from one edge up to the next; only required if timeperiod=custom')
+    parser.add_argument('--rescan',
+            action='store_true',
+            help='if flagged, search all directories (not only those modified since the last run) for DSWE files missing from the catalog')
+    parser.add_argument('--min_valid',
+            metavar='PERCENT', type=float,
+            help='only use DSWE files with at least this percentage of valid data, as scored in the catalog (see filter_valid_data.py)')
+    parser.add_argument('--workers',
+            metavar='N', type=int, default=1,
+            help='number of processes to use; defaults to 1')
+    parser.add_argument('--chunk_size',
+            metavar='N', type=int, required=False,
+            help='process the study area in chunks of N by N pixels to limit memory use; by default the whole area is processed at once')
+    parser.add_argument('--update',
+            action='store_true',
+            help='if flagged, only process time periods with new DSWE files, adding them to the counts saved by earlier runs')
 
     args = parser.parse_args()
 
-    if args.time_period == 'multiyear' and args.multiyear == None:
+    if 'multiyear' in args.time_period and args.multiyear == None:
         parser.error('for multiyear time period, must specify number of years with -m NUM_YEARS')
+    if 'hydro_season' in args.time_period and args.season_starts == None:
+        parser.error('for hydro_season time period, must specify the first month of each season with --season_starts')
+    if ('fixed' in args.time_period or 'rolling' in args.time_period) and args.days == None:
+        parser.error('for fixed and rolling time periods, must specify number of days with --days')
+    if 'rolling' in args.time_period and args.step == None:
+        parser.error('for rolling time period, must specify number of days between windows with --step')
+    if 'custom' in args.time_period and (args.bin_edges == None or len(args.bin_edges) < 2):
+        parser.error('for custom time period, must specify at least two dates with --bin_edges')
+    if args.multiyear is not None and args.multiyear < 1:
+        parser.error('-y NUM_YEARS must be at least 1')
+    if not 1 <= args.water_year_start <= 12:
+        parser.error('--water_year_start must be a month from 1 to 12')
+    if args.season_starts and not all(1 <= month <= 12 for month in args.season_starts):
+        parser.error('--season_starts must be months from 1 to 12')
+    if (args.days is not None and args.days < 1) or (args.step is not None and args.step < 1):
+        parser.error('--days and --step must be at least 1')
+    if args.bin_edges and any(stop <= start for start, stop in zip(args.bin_edges[:-1], args.bin_edges[1:])):
+        parser.error('--bin_edges must be strictly increasing dates')
     
     main(**vars(args))
@@ -1,30 +1,76 @@
 '''
 Main code to calculate proportions for a large study area,
 composed of multiple tiles.
-
-NOTE: Requires gdal_merge.py in the same directory as where
-code is run.
 '''
 import argparse
-import itertools
-import gdal_merge
-import operator
+import datetime
 import os
 import utils_proportions as utils
 import time_periods as tp
 
-def main(main_dir, dswe_layer, time_period, multiyear=None):
+# default number of rows and columns of the chunks the study
+    # area is processed in
+CHUNK_SIZE = 4096
+
+# with the vrt and merge backends, each tile is processed into its own
+    # subdirectory of this directory in the output directories
+TILES_DIR = 'tiles'
+
+BACKENDS = ['grid', 'vrt', 'merge']
+
+def main(main_dir, dswe_layer, time_period, multiyear=None, rescan=False,
+            workers=1, chunk_size=CHUNK_SIZE, update=False, water_year_start=10,
+            season_starts=None, days=None, step=None, start=None,
+            bin_edges=None, backend='grid', virtual=False, min_valid=None):
     '''
     Calculate proportions of pixels inundated with water over
     time, for a large study area composed of multiple tiles.
+    The counts of all tiles are accumulated directly into one
+    grid covering the study area, processed chunk by chunk, so
+    one output file per period is written for the whole mosaic;
+    where tiles overlap, the observations of all of them are
+    counted. With the vrt and merge backends, each tile is
+    processed on its own grid instead, and the outputs of the
+    tiles are mosaicked with a VRT or with gdal_merge.
     INPUTS:
         main_dir : str : main directory where DSWE data is located
         dswe_layer : str : DSWE layer to be used in calculations ;
             INWM or INTR
-        time_period : str : time period to process files by;
-            year, month, month_across_years, season, multiyear 
+        time_period : list of str : time periods to process files by;
+            year, month, month_across_years, season, multiyear,
+            water_year, hydro_season, fixed, rolling, custom;
+            all time periods are processed in one pass over the files
         multiyear : int : integer number of years to process files by;
             only required if timeperiod=multiyear
+        water_year_start : int : first month of water years
+        season_starts : list of int : first month of each
+            hydrological season; only required if timeperiod=hydro_season
+        days : int : number of days of fixed or rolling windows;
+            only required if timeperiod=fixed or rolling
+        step : int : number of days between the starts of rolling
+            windows; only required if timeperiod=rolling
+        start : date : start of the first fixed or rolling window;
+            defaults to the date of the first file
+        bin_edges : list of dates : edges of custom time periods;
+            only required if timeperiod=custom
+        rescan : bool : if True, walk the directory tree to add
+            uncataloged DSWE files to the catalog
+        min_valid : float : if given, only use DSWE files with
+            at least this percent of valid pixels in the catalog
+        workers : int : number of processes to use; if more than
+            one, periods (or parts of them) are processed in parallel
+        chunk_size : int : number of rows and columns of the chunks
+            the grid is processed in, to bound memory use; if None,
+            the whole grid is processed at once
+        update : bool : if True, only process periods with new
+            DSWE files, adding their counts to the counts saved
+            by earlier runs
+        backend : str : grid, to accumulate all tiles into one
+            grid, or vrt or merge, to process each tile on its own
+            and mosaic their outputs; see build_mosaic and
+            merge_mosaic
+        virtual : bool : if True, the vrt backend leaves the
+            mosaics as VRTs instead of translating them to GeoTIFFs
     RETURNS:
         processes and saves data
 
@@ -32,109 +78,92 @@ def main(main_dir, dswe_layer, time_period, multiyear=None):
     # move to main directory
     os.chdir(main_dir)
 
-    # make a list of DSWE files of interest and their dates
-    all_files, _ = utils.get_files(main_dir, dswe_layer)
-
-    # make output directory
-    if time_period == 'multiyear':
-        time_period = time_period + '_' + str(multiyear)
-    prop_dir = utils.make_output_dir(main_dir, time_period)
-
-    # get top left corner of each file
-    all_top_left = []
-    for file in all_files:
-        top_left = utils.get_corner(file)
-        all_top_left.append(top_left)
-
-    # sort by x, then y, val of top left corner
-    key_func = lambda t: (t[0], t[1])
-    all_top_left.sort(key=key_func)
-
-    # find total length for printing purposes
-    i = 1
-    total_len = sum(1 for key,_ in itertools.groupby(all_top_left,
-                                        operator.itemgetter(1)))
-
-    for key, g in itertools.groupby(all_top_left,
-                                        operator.itemgetter(1)):
-        print(f'Processing group {i} of {total_len}')
-        i += 1
-
-        # make a list of filenames in the group
-        group = list(g)
-        group_files = [i[2] for i in group]
-
-        group_dates = []
-        # get group dates
-        for file in group_files:
-            _, filename = os.path.split(file)
-            file_date = utils.get_file_date(filename)
-            group_dates.append(file_date)
-
-        # initialize extent to be overwritten
-        extent_0 = [1e12, -1e12, -1e12, 1e12]
-        # loop through all files in the group to calculate max extent
-        for file in group_files:
-            extent_0 = utils.find_max_extent(file, extent_0)
-        max_extent = extent_0
-
-        # process each group to find proportions
-        if time_period == 'year':
-            tp.process_by_year(group_files, group_dates,
-                                prop_dir, max_extent)
-        elif time_period == 'month':
-            tp.process_by_month(group_files, group_dates,
-                                prop_dir, max_extent)
-        elif time_period == 'month_across_years':
-            tp.process_by_month_across_years(group_files, group_dates,
-                                prop_dir, max_extent)
-        elif time_period == 'season':
-            tp.process_by_season(group_files, group_dates,
-                                prop_dir, max_extent)
-        elif 'multiyear' in time_period:
-            tp.process_by_multiyear(group_files, group_dates,
-                                prop_dir, max_extent, multiyear)
-
-    # now we need to mosaic processed images from same time period
-    
-    # make a list of processed files
-    os.chdir(prop_dir)
-    filenames = []
-    for root, dirs, files in os.walk(prop_dir):
-        for file in files:
-            filenames.append(os.path.join(root, file))
-
-    # splits filename at the '.tif' and 
-        # the '(#)' if there are musltiple in the same time period
-    key_func = lambda t: t.split('.')[0].split('(')[0]
-
-    # sort filenames by time period and open/partial/non
-    filenames.sort(key=key_func)
-
-    # for printing purposes, find total length of files to merge
-    i = 1
-    total_len = sum(1 for key,_ in itertools.groupby(filenames, key=key_func))
-
-    group = []
-    for key, g in itertools.groupby(filenames, key=key_func):
-        print(f'Merging group {i} of {total_len}: {os.path.split(key)[1]}')
-        i += 1
-
-        group = list(g)
-        out_filename = key + '_merged.tif'
-
-        # arguments to use in gdal_merge
-        args = ['', '-o', out_filename, 
-                    '-of', 'gtiff',
-                    '-n', '255',
-                    '-a_nodata', '255'] + group
-        
-        # use gdal_merge to combine images spatially
-        gdal_merge.main(args)
-
-        # delete files once merged
-        for file in group:
-            os.remove(file)
+    # index of DSWE files of interest, sorted by date
+    records = utils.get_records(main_dir, dswe_layer, rescan, min_valid)
+    index = utils.SceneIndex(records)
+    if len(index) == 0:
+        raise Exception(f'No {dswe_layer} files to process in {main_dir}; '
+                        'check --min_valid, or try --rescan')
+    num_tiles = len(index.footprint_groups())
+    print(f'Processing {len(index)} total scenes of {num_tiles} tiles from {index.dates[0]} to {index.dates[-1]}')
+
+    # make output directories
+    if isinstance(time_period, str):
+        time_period = [time_period]
+    options = {'multiyear': multiyear, 'water_year_start': water_year_start,
+                'season_starts': season_starts, 'days': days, 'step': step,
+                'start': start, 'bin_edges': bin_edges}
+    calendars = tp.make_calendars(time_period, index.dates, options)
+    prop_dirs = utils.make_output_dirs(main_dir, calendars)
+
+    if backend in ['vrt', 'merge']:
+        # process each tile on its own, then mosaic their outputs
+        process_tiles(index, prop_dirs, calendars, workers, chunk_size,
+                        update)
+        for prop_dir in prop_dirs.values():
+            mosaic_outputs(prop_dir, backend, virtual, workers)
+    else:
+        # common grid covering the max extent of all tiles
+        grid = utils.make_grid(records)
+
+        # accumulate all tiles into the mosaic grid, chunk by chunk;
+            # only the tiles overlapping a chunk are read for it
+        tp.process_chunks(index, prop_dirs, grid, calendars, workers,
+                            chunk_size, update)
+
+    print('Processing done!')
+
+
+def process_tiles(index, prop_dirs, calendars, workers=1, chunk_size=None,
+                    update=False):
+    '''
+    Process the files of each tile footprint on their own grid,
+    into a subdirectory of each output directory named after the
+    footprint, so the counts of each tile are kept for --update.
+    '''
+    groups = index.footprint_groups()
+    for i, footprint in enumerate(sorted(groups), start=1):
+        print(f'Processing tile {i} of {len(groups)}: {footprint}')
+        tile_index = index.subset(groups[footprint])
+
+        # grid of the footprint shared by all files of the tile
+        grid = utils.make_grid(tile_index.records)
+
+        tile_dirs = {}
+        for period_type, prop_dir in prop_dirs.items():
+            tile_dirs[period_type] = os.path.join(prop_dir, TILES_DIR,
+                                                    footprint)
+            os.makedirs(tile_dirs[period_type], exist_ok=True)
+        tp.process_chunks(tile_index, tile_dirs, grid, calendars, workers,
+                            chunk_size, update)
+
+
+def mosaic_outputs(prop_dir, backend='vrt', virtual=False, workers=1):
+    '''
+    Mosaic the outputs of each tile (in the tile subdirectories
+    of prop_dir) that are from the same time period, into
+    prop_dir; see utils_proportions.build_mosaic and
+    utils_proportions.merge_mosaic, which merges on workers
+    threads.
+    '''
+    # outputs of the same time period and open/partial/non
+        # have the same name in each tile subdirectory
+    tiles_dir = os.path.join(prop_dir, TILES_DIR)
+    outputs = {}
+    for tile in sorted(os.listdir(tiles_dir)):
+        for file in os.listdir(os.path.join(tiles_dir, tile)):
+            if file.endswith('_proportion.tif'):
+                outputs.setdefault(file, []).append(
+                                    os.path.join(tiles_dir, tile, file))
+
+    for i, (filename, files) in enumerate(sorted(outputs.items()), start=1):
+        print(f'Mosaicking {i} of {len(outputs)}: {filename}')
+        if backend == 'merge':
+            utils.merge_mosaic(files, os.path.join(prop_dir, filename),
+                                workers)
+        else:
+            utils.build_mosaic(files, os.path.join(prop_dir, filename),
+                                virtual)
 
 
 if __name__ == '__main__':
@@ -148,17 +177,76 @@ if __name__ == '__main__':
             choices=['INWM', 'INTR'], 
             help='DSWE layer to be used in calculations' )
     parser.add_argument('time_period',
-            type=str.lower, 
-            choices=['year', 'month', 'month_across_years', 'season', 'multiyear'], 
-            help='time period to process files by')
+            type=str.lower, nargs='+',
+            choices=tp.TIME_PERIODS,
+            help='time period(s) to process files by')
     parser.add_argument('-y', 
             metavar='NUM_YEARS', dest='multiyear',
             type=int, required=False, 
             help='integer number of years to process files by; only required if timeperiod=multiyear')
+    parser.add_argument('--water_year_start',
+            metavar='MONTH', type=int, default=10,
+            help='first month of water years; defaults to 10 (October)')
+    parser.add_argument('--season_starts',
+            metavar='MONTH', type=int, nargs='+',
+            help='first month of each hydrological season; only required if timeperiod=hydro_season')
+    parser.add_argument('--days',
+            metavar='N', type=int,
+            help='number of days of each window; only required if timeperiod=fixed or rolling')
+    parser.add_argument('--step',
+            metavar='N', type=int,
+            help='number of days between the starts of rolling windows; only required if timeperiod=rolling')
+    parser.add_argument('--start',
+            metavar='YYYY-MM-DD', type=datetime.date.fromisoformat,
+            help='start of the first fixed or rolling window; defaults to the date of the first file')
+    parser.add_argument('--bin_edges',
+            metavar='YYYY-MM-DD', type=datetime.date.fromisoformat, nargs='+',
+            help='edges of custom time periods, each running from one edge up to the next; only required if timeperiod=custom')
+    parser.add_argument('--rescan',
+            action='store_true',
+            help='if flagged, search all directories (not only those modified since the last run) for DSWE files missing from the catalog')
+    parser.add_argument('--min_valid',
+            metavar='PERCENT', type=float,
+            help='only use DSWE files with at least this percentage of valid data, as scored in the catalog (see filter_valid_data.py)')
+    parser.add_argument('--workers',
+            metavar='N', type=int, default=1,
+            help='number of processes to use; defaults to 1')
+    parser.add_argument('--chunk_size',
+            metavar='N', type=int, default=CHUNK_SIZE,
+            help=f'process the study area in chunks of N by N pixels to limit memory use; defaults to {CHUNK_SIZE}')
+    parser.add_argument('--update',
+            action='store_true',
+            help='if flagged, only process time periods with new DSWE files, adding them to the counts saved by earlier runs')
+    parser.add_argument('--backend',
+            type=str.lower, choices=BACKENDS, default='grid',
+            help='grid, to accumulate all tiles into one grid, or vrt or merge, to process each tile on its own and mosaic the outputs with a VRT or with gdal_merge; defaults to grid')
+    parser.add_argument('--virtual',
+            action='store_true',
+            help='if flagged, the vrt backend leaves the mosaics as VRTs instead of translating them to compressed GeoTIFFs')
 
     args = parser.parse_args()
 
-    if args.time_period == 'multiyear' and args.multiyear == None:
+    if 'multiyear' in args.time_period and args.multiyear == None:
         parser.error('for multiyear time period, must specify number of years with -m NUM_YEARS')
+    if 'hydro_season' in args.time_period and args.season_starts == None:
+        parser.error('for hydro_season time period, must specify the first month of each season with --season_starts')
+    if ('fixed' in args.time_period or 'rolling' in args.time_period) and args.days == None:
+        parser.error('for fixed and rolling time periods, must specify number of days with --days')
+    if 'rolling' in args.time_period and args.step == None:
+        parser.error('for rolling time period, must specify number of days between windows with --step')
+    if 'custom' in args.time_period and (args.bin_edges == None or len(args.bin_edges) < 2):
+        parser.error('for custom time period, must specify at least two dates with --bin_edges')
+    if args.multiyear is not None and args.multiyear < 1:
+        parser.error('-y NUM_YEARS must be at least 1')
+    if not 1 <= args.water_year_start <= 12:
+        parser.error('--water_year_start must be a month from 1 to 12')
+    if args.season_starts and not all(1 <= month <= 12 for month in args.season_starts):
+        parser.error('--season_starts must be months from 1 to 12')
+    if (args.days is not None and args.days < 1) or (args.step is not None and args.step < 1):
+        parser.error('--days and --step must be at least 1')
+    if args.bin_edges and any(stop <= start for start, stop in zip(args.bin_edges[:-1], args.bin_edges[1:])):
+        parser.error('--bin_edges must be strictly increasing dates')
+    if args.virtual and args.backend != 'vrt':
+        parser.error('--virtual is only used with --backend vrt')
     
     main(**vars(args))
@@ -2,201 +2,901 @@
 Functions to sort files by time period and process data.
 '''
 import datetime
+import math
+import multiprocessing
 import numpy as np
-from dateutil.rrule import rrule, MONTHLY
+import os
 import utils_proportions as utils
 
-def process_files(current_files, prop_dir, max_extent, time_str):
+TIME_PERIODS = ['year', 'month', 'month_across_years', 'season', 'multiyear',
+                'water_year', 'hydro_season', 'fixed', 'rolling', 'custom']
+
+# seasons defined meteorologically (N. Hemisphere names)
+SEASONS = {12: 'Winter', 1: 'Winter', 2: 'Winter',
+            3: 'Spring', 4: 'Spring', 5: 'Spring',
+            6: 'Summer', 7: 'Summer', 8: 'Summer',
+            9: 'Autumn', 10: 'Autumn', 11: 'Autumn'}
+
+
+class PeriodCounts(object):
+    '''
+    Running counts of open surface water, partial surface water,
+    nonwater and valid observations for each pixel of the common
+    grid (or of one chunk of it) in one time period. Counts
+    are uint16 (up to 65535 observations per pixel) and are
+    updated in place. If base is True, the counts saved for
+    the period by an earlier run are added to them when saved.
+    '''
+    def __init__(self, grid, base=False):
+        shape = grid['shape']
+        self.base = base
+        self.open_sw = np.zeros(shape, dtype=np.uint16)
+        self.partial_sw = np.zeros(shape, dtype=np.uint16)
+        self.nonwater = np.zeros(shape, dtype=np.uint16)
+        self.total = np.zeros(shape, dtype=np.uint16)
+        # position of the counts in the output files
+        self.window = grid.get('window', (slice(0, shape[0]),
+                                            slice(0, shape[1])))
+        self.full_grid = grid.get('full_grid', grid)
+
+    def add(self, classes, window):
+        '''
+        Add one reclassified layer (class codes from
+        utils_proportions.reclassify) to the counts, in its
+        window of the grid.
+        '''
+        for counts, test in [(self.open_sw, classes == utils.OPEN_SW),
+                    (self.partial_sw, classes == utils.PARTIAL_SW),
+                    (self.nonwater, classes == utils.NONWATER),
+                    (self.total, classes != utils.INVALID)]:
+            counts_window = counts[window]
+            np.add(counts_window, 1, out=counts_window, where=test)
+
+    def merge(self, other):
+        '''
+        Add the counts of another PeriodCounts on the same grid
+        (eg. computed from other files of the period).
+        '''
+        self.open_sw += other.open_sw
+        self.partial_sw += other.partial_sw
+        self.nonwater += other.nonwater
+        self.total += other.total
+
+    def save(self, prop_dir, time_str, outputs=None):
+        '''
+        Save the counts, then calculate proportions from them
+        and write them into their window of the output files in
+        prop_dir. Output files are created on the first save of
+        a period; outputs maps (prop_dir, time_str, data_str) to
+        the file created, so that the other chunks of the period
+        are written into the same file.
+        '''
+        if outputs is None:
+            outputs = {}
+
+        # save the counts, starting from the saved counts if any
+        key = (prop_dir, time_str, 'counts')
+        if key not in outputs:
+            outputs[key] = utils.create_counts_file(prop_dir, time_str,
+                                self.full_grid, self.base)
+        all_counts = [self.open_sw, self.partial_sw, self.nonwater, self.total]
+        if self.base:
+            saved = utils.read_counts_window(outputs[key], self.window)
+            for counts, saved_counts in zip(all_counts, saved):
+                counts += saved_counts
+        utils.write_counts_window(outputs[key], all_counts, self.window)
+
+        # calculate proportions open and partial surface water
+        open_sw_prop = utils.calculate_proportion(self.open_sw, self.total)
+        partial_sw_prop = utils.calculate_proportion(self.partial_sw, self.total)
+        nonwater_prop = utils.calculate_proportion(self.nonwater, self.total)
+
+        # create output files
+        prop_data = [open_sw_prop, partial_sw_prop, nonwater_prop]
+        data_str = ['open_sw', 'partial_sw', 'nonwater']
+
+        for i, data in enumerate(prop_data):
+            key = (prop_dir, time_str, data_str[i])
+            if key not in outputs and self.base:
+                # only the windows with new files are rewritten
+                outputs[key] = utils.output_path(data_str[i],
+                                    prop_dir, time_str)
+            elif key not in outputs:
+                outputs[key] = utils.create_output_file(data_str[i],
+                                    prop_dir, time_str, self.full_grid)
+            utils.write_output_window(outputs[key], data, self.window)
+
+
+class Calendar(object):
+    '''
+    Calendar of a time period, mapping dates to the periods
+    (bins) they fall in. Time is split into intervals at sorted
+    edges, and each interval belongs to one bin (or to none, -1);
+    a bin can be made of several intervals (eg. all Januaries).
+    For rolling windows, bins are slabs of days, and each window
+    is the sum of window_slabs consecutive slabs, starting every
+    step_slabs slabs; see RollingSums.
+    '''
+    def __init__(self, name, edges, interval_bins, time_strs,
+                    window_slabs=None, step_slabs=None, window_strs=None):
+        self.name = name
+        self.edges = np.asarray(edges, dtype='datetime64[D]')
+        self.interval_bins = np.asarray(interval_bins, dtype=np.int64)
+        self.time_strs = time_strs
+        self.window_slabs = window_slabs
+        self.step_slabs = step_slabs
+        self.window_strs = window_strs
+
+        # last interval of each bin; once (date sorted) files
+            # are past it, the bin gets no more files
+        self.last_interval = np.full(len(time_strs), -1, dtype=np.int64)
+        in_bin = np.nonzero(self.interval_bins >= 0)[0]
+        np.maximum.at(self.last_interval, self.interval_bins[in_bin], in_bin)
+
+    @property
+    def rolling(self):
+        return self.window_slabs is not None
+
+    def assign(self, dates):
+        '''
+        Map dates to bins with one vectorized search of the edges.
+        INPUTS:
+            dates : list of dates : dates of files
+        RETURNS:
+            bins : numpy array : bin of each date; -1 if the date
+                is in no bin
+            intervals : numpy array : interval of each date
+        '''
+        dates = np.asarray(dates, dtype='datetime64[D]')
+        intervals = np.searchsorted(self.edges, dates, side='right') - 1
+        inside = (intervals >= 0) & (intervals < len(self.interval_bins))
+        bins = np.full(len(dates), -1, dtype=np.int64)
+        bins[inside] = self.interval_bins[intervals[inside]]
+        return bins, intervals
+
+
+def calendar_from_keys(name, edges, keys, key_strs):
+    '''
+    Make a calendar from the sortable key of the bin of each
+    interval and its time_str; intervals with the same key
+    belong to the same bin.
+    '''
+    unique_keys = sorted(set(keys))
+    bin_ids = {key: i for i, key in enumerate(unique_keys)}
+    time_strs = [None] * len(unique_keys)
+    for key, key_str in zip(keys, key_strs):
+        time_strs[bin_ids[key]] = key_str
+    return Calendar(name, edges, [bin_ids[key] for key in keys], time_strs)
+
+
+def day_range_str(start, stop):
+    '''
+    time_str of the days from start up to (not including) stop.
+    '''
+    return str(start) + '_' + str(stop - np.timedelta64(1, 'D'))
+
+
+def check_options(time_period, options):
+    '''
+    Check the options of a time period (see make_calendar),
+    which would otherwise give empty or wrong calendars.
     '''
-    Process files in the current time period of interest.
+    if time_period == 'multiyear' and (options.get('multiyear') or 0) < 1:
+        raise Exception('Number of years of multiyear periods must be at least 1')
+    if time_period == 'water_year' and options.get('water_year_start', 10) not in range(1, 13):
+        raise Exception('First month of water years must be from 1 to 12')
+    if time_period == 'hydro_season' and any(month not in range(1, 13)
+                                            for month in options['season_starts']):
+        raise Exception('First months of hydrological seasons must be from 1 to 12')
+    if time_period in ['fixed', 'rolling']:
+        if options['days'] < 1 or (options.get('step') or 1) < 1:
+            raise Exception('Numbers of days of windows and steps must be at least 1')
+    if time_period == 'custom':
+        edges = np.asarray(options['bin_edges'], dtype='datetime64[D]')
+        if len(edges) < 2 or np.any(np.diff(edges) <= np.timedelta64(0, 'D')):
+            raise Exception('Edges of custom time periods must be at least two strictly increasing dates')
+
+
+def make_calendar(time_period, all_dates, options=None):
+    '''
+    Make the calendar of a time period, covering all dates.
     INPUTS:
-        current_file s : list of str : list of paths to current file
-        prop_dir : str : path to directory to store processed data
-        max_extent : list of float : max extent of all files;
-            in form [minx, maxy, maxx, miny]
-        time_str : str : time period for filename
+        time_period : str : time period to process files by;
+            year, month, month_across_years, season, multiyear,
+            water_year, hydro_season, fixed, rolling or custom
+        all_dates : list of dates : list of dates of files of interest
+    OPTIONAL INPUTS:
+        options : dict : options of the time periods;
+            multiyear : int : number of years of multiyear periods
+            water_year_start : int : first month of water years
+                (default 10); water years are named by the year
+                they end in
+            season_starts : list of int : first month of each
+                hydrological season
+            days : int : number of days of fixed and rolling windows
+            step : int : number of days between the starts of
+                rolling windows
+            start : date : start of the first fixed or rolling
+                window (default first date)
+            bin_edges : list of dates : sorted edges of custom bins;
+                each bin runs from an edge up to the next one
     RETURNS:
-       saves processed data in prop_dir
+        calendar : Calendar : calendar of the time period
     '''
-    if current_files == []:
-        # no file to be processed for this time period
-        return
+    if options is None:
+        options = {}
+    check_options(time_period, options)
+    dates = np.asarray(all_dates, dtype='datetime64[D]')
+    first = dates.min()
+    last = dates.max()
 
-    for i, file in enumerate(current_files):
-        # open the file
-        raster, geo_transform, projection = utils.open_raster(
-            file, prop_dir, max_extent)
-
-        if i == 0:
-            shape = raster.shape
-            # initialize arrays
-            open_sw = np.zeros(shape)
-            partial_sw = np.zeros(shape)
-            nonwater = np.zeros(shape)
-            total = np.zeros(shape)
+    if time_period in ['year', 'month', 'month_across_years', 'season',
+                        'multiyear', 'water_year', 'hydro_season']:
+        # calendar made of whole months; intervals are months
+        if time_period == 'water_year':
+            starts = [options.get('water_year_start', 10)]
+        elif time_period == 'hydro_season':
+            starts = sorted(options['season_starts'])
+        elif time_period in ['year', 'multiyear']:
+            starts = [1]
         else:
-            # ensure that geo_transform and projection stay the same
-            #XXX unsure if they would ever change
-            assert geo_transform_0 == geo_transform
-            assert projection_0 == projection
-        geo_transform_0 = geo_transform
-        projection_0 = projection
+            starts = range(1, 13)
+
+        months = np.arange(first.astype('datetime64[Y]') - 1,
+                            last.astype('datetime64[Y]') + 2,
+                            dtype='datetime64[M]')
+        month_nums = months.astype(np.int64) % 12 + 1
+        months = months[np.isin(month_nums, starts)]
+        edges = months.astype('datetime64[D]')
+
+        keys = []
+        key_strs = []
+        for interval_start, interval_stop in zip(months[:-1], months[1:]):
+            year = interval_start.astype('datetime64[Y]').astype(np.int64) + 1970
+            month = int(interval_start.astype(np.int64) % 12 + 1)
+            if time_period == 'year':
+                keys.append((year,))
+                key_strs.append(str(year))
+            elif time_period == 'multiyear':
+                multiyear = options['multiyear']
+                start_year = year - year % multiyear
+                keys.append((start_year,))
+                key_strs.append(str(start_year) + '_' + str(start_year + multiyear - 1))
+            elif time_period == 'month':
+                keys.append((year, month))
+                key_strs.append(datetime.date(year, month, 1).strftime('%b_%Y'))
+            elif time_period == 'month_across_years':
+                keys.append((month,))
+                key_strs.append(datetime.date(1800, month, 1).strftime('%B'))
+            elif time_period == 'season':
+                # months are grouped by season within each year
+                keys.append((year, (month % 12) // 3))
+                key_strs.append(SEASONS[month] + '_' + str(year))
+            elif time_period == 'water_year':
+                end_year = year + 1 if month > 1 else year
+                keys.append((end_year,))
+                key_strs.append('WY' + str(end_year))
+            elif time_period == 'hydro_season':
+                end_month = int((interval_stop - 1).astype(np.int64) % 12 + 1)
+                keys.append((year, month))
+                key_strs.append(datetime.date(year, month, 1).strftime('%b') + '_' +
+                                datetime.date(year, end_month, 1).strftime('%b') +
+                                '_' + str(year))
+        name = time_period
+        if time_period == 'multiyear':
+            name = time_period + '_' + str(options['multiyear'])
+        return calendar_from_keys(name, edges, keys, key_strs)
+
+    elif time_period == 'custom':
+        edges = np.asarray(options['bin_edges'], dtype='datetime64[D]')
+        key_strs = [day_range_str(start, stop)
+                        for start, stop in zip(edges[:-1], edges[1:])]
+        return Calendar('custom', edges, np.arange(len(edges) - 1), key_strs)
+
+    elif time_period in ['fixed', 'rolling']:
+        days = options['days']
+        step = options.get('step') or days
+        origin = np.datetime64(options.get('start') or first, 'D')
+        if time_period == 'fixed':
+            step = days
+        # windows are made of slabs of days that do not overlap
+        slab = math.gcd(days, step)
+        n_windows = max(int((last - origin).astype(np.int64)) // step + 1, 0)
+        n_slabs = ((n_windows - 1) * step + days) // slab if n_windows else 0
+        edges = origin + np.arange(n_slabs + 1) * np.timedelta64(slab, 'D')
+        slab_strs = [day_range_str(start, stop)
+                        for start, stop in zip(edges[:-1], edges[1:])]
+        if time_period == 'fixed':
+            return Calendar(f'fixed_{days}d', edges, np.arange(n_slabs), slab_strs)
+
+        window_slabs = days // slab
+        step_slabs = step // slab
+        window_strs = [day_range_str(edges[k * step_slabs],
+                                        edges[k * step_slabs + window_slabs])
+                        for k in range(n_windows)]
+        return Calendar(f'rolling_{days}d_{step}d', edges, np.arange(n_slabs),
+                            slab_strs, window_slabs, step_slabs, window_strs)
+
+    raise Exception(f'{time_period} is not a valid time period')
+
+
+def make_calendars(time_periods, all_dates, options=None):
+    '''
+    Make the calendars of several time periods; see make_calendar.
+    RETURNS:
+        calendars : dict : time periods as keys and their
+            calendars as values
+    '''
+    return {time_period: make_calendar(time_period, all_dates, options)
+                for time_period in time_periods}
+
+
+class RollingSums(object):
+    '''
+    Counts of rolling windows, computed from the counts of the
+    slabs of days they are made of. As the windows roll forward,
+    the counts of slabs entering the current window are added to
+    a running sum and the counts of slabs leaving it are taken
+    out, so overlapping windows are never counted from scratch.
+    Each window is saved once the slabs after it are reached.
+    '''
+    def __init__(self, calendar, grid, prop_dir, outputs):
+        self.calendar = calendar
+        self.prop_dir = prop_dir
+        self.outputs = outputs
+        self.sums = PeriodCounts(grid)
+        # counts of the slabs in the running sum
+        self.slabs = {}
+        self.window = 0
+
+    def add(self, slab, counts):
+        '''
+        Add the counts of a slab; slabs are added in time order.
+        '''
+        self.roll(slab)
+        if slab >= self.window * self.calendar.step_slabs:
+            # otherwise, the slab falls between windows
+            self.sums.merge(counts)
+            self.slabs[slab] = counts
+
+    def roll(self, slab):
+        '''
+        Save the windows ending before slab, and move the running
+        sum forward to the first window that slab can be in.
+        '''
+        window_slabs = self.calendar.window_slabs
+        step_slabs = self.calendar.step_slabs
+        n_windows = len(self.calendar.window_strs)
+        while (self.window < n_windows and
+                self.window * step_slabs + window_slabs <= slab):
+            if self.slabs:
+                time_str = self.calendar.window_strs[self.window]
+                self.sums.save(self.prop_dir, time_str, self.outputs)
+                print(f'Proportions completed for {time_str}')
+
+            # take out the slabs leaving the window
+            self.window += 1
+            for old in sorted(self.slabs):
+                if old >= self.window * step_slabs:
+                    break
+                old_counts = self.slabs.pop(old)
+                self.sums.open_sw -= old_counts.open_sw
+                self.sums.partial_sw -= old_counts.partial_sw
+                self.sums.nonwater -= old_counts.nonwater
+                self.sums.total -= old_counts.total
+
+    def finish(self):
+        '''
+        Save the remaining windows.
+        '''
+        self.roll(len(self.calendar.time_strs) + self.calendar.window_slabs)
+
+
+def process_all(all_files, all_dates, prop_dirs, grid, calendars=None,
+                    outputs=None, plan=None):
+    '''
+    Process files for one or more time periods at once; each
+    file is read and reclassified only once, and its counts
+    are added to the period it falls in for every time period.
+    Periods are saved as soon as all of their files are added.
+    INPUTS:
+        all_files : list of str : list of paths to all DSWE files of interest
+        all_dates : list of dates : list of dates of files of interest
+        prop_dirs : dict : time periods to process files by
+            (see TIME_PERIODS) as keys, and paths to save their
+            output data as values
+        grid : dict : common grid covering all files; see
+            utils_proportions.make_grid
+        calendars : dict : time periods as keys and their
+            calendars as values; see make_calendars; made from
+            all_dates if None
+        outputs : dict : output files of the periods; see
+            PeriodCounts.save
+        plan : tuple : periods to process; see plan_periods. If
+            None, all periods are processed from all files, and
+            their counts are saved
+    RETURNS:
+        processed data saved in prop_dirs
+    '''
+    if outputs is None:
+        outputs = {}
+    if calendars is None:
+        calendars = make_calendars(prop_dirs, all_dates)
+    own_plan = plan is None
+    if own_plan:
+        plan = plan_periods(all_files, all_dates, prop_dirs, grid, calendars)
+    period_plans = plan[0]
+
+    # files to read for each period
+    read_files = {}
+    for time_period in prop_dirs:
+        for period, period_plan in period_plans[time_period].items():
+            read_files[(time_period, period)] = set(period_plan['files'])
+    all_read = set().union(*read_files.values())
+
+    # bins and intervals of each file in each calendar
+    assigned = {time_period: calendars[time_period].assign(all_dates)
+                    for time_period in prop_dirs}
+    rolling = {time_period: RollingSums(calendars[time_period], grid,
+                                            prop_dir, outputs)
+                    if calendars[time_period].rolling else None
+                for time_period, prop_dir in prop_dirs.items()}
+
+    # counts of periods still receiving files, keyed by period
+    open_counts = {time_period: {} for time_period in prop_dirs}
+    order = np.argsort(np.asarray(all_dates, dtype='datetime64[D]'),
+                        kind='stable')
+    for i in order:
+        if all_files[i] not in all_read:
+            continue
+
+        # read and reclassify the file once
+        raster, window = utils.read_into_grid(all_files[i], grid)
+        if raster is None:
+            continue
+        classes = utils.reclassify(raster)
+
+        for time_period, prop_dir in prop_dirs.items():
+            calendar = calendars[time_period]
+            period = int(assigned[time_period][0][i])
+            interval = assigned[time_period][1][i]
+
+            # periods that end before this file will not get any more files
+            done = [done_period for done_period in open_counts[time_period]
+                        if calendar.last_interval[done_period] < interval]
+            save_periods(open_counts[time_period], prop_dir, outputs,
+                            done, rolling[time_period])
+
+            if all_files[i] not in read_files.get((time_period, period), ()):
+                # period is up to date, or file is already counted
+                continue
+            if period not in open_counts[time_period]:
+                base = period_plans[time_period][period]['base']
+                counts = PeriodCounts(grid, base)
+                time_str = calendar.time_strs[period]
+                open_counts[time_period][period] = (time_str, counts)
+            open_counts[time_period][period][1].add(classes, window)
+
+    # save the remaining periods
+    for time_period, prop_dir in prop_dirs.items():
+        save_periods(open_counts[time_period], prop_dir, outputs,
+                        rolling=rolling[time_period])
+        if rolling[time_period] is not None:
+            rolling[time_period].finish()
+
+    if own_plan:
+        save_manifests(prop_dirs, plan, outputs)
+
+
+def save_periods(period_counts, prop_dir, outputs=None, periods=None,
+                    rolling=None):
+    '''
+    Save periods in period_counts (in time order; all of them
+    if periods is None) and remove them from the dict. For
+    rolling windows, the periods are slabs, which are added to
+    the rolling sums instead.
+    '''
+    if periods is None:
+        periods = list(period_counts)
+    for period in sorted(periods):
+        time_str, counts = period_counts.pop(period)
+        if rolling is not None:
+            rolling.add(period, counts)
+            continue
+        counts.save(prop_dir, time_str, outputs)
+        print(f'Proportions completed for {time_str}')
+
+
+def group_files(all_files, all_dates, calendar):
+    '''
+    Group files by the period they fall in.
+    INPUTS:
+        all_files : list of str : list of paths to all DSWE files of interest
+        all_dates : list of dates : list of dates of files of interest
+        calendar : Calendar : calendar of the time period to
+            group files by
+    RETURNS:
+        groups : dict : periods (bins of the calendar) as keys,
+            and (time_str, list of files in the period) as values;
+            files in no period are left out
+    '''
+    groups = {}
+    bins, _ = calendar.assign(all_dates)
+    for file, period in zip(all_files, bins.tolist()):
+        if period < 0:
+            continue
+        if period not in groups:
+            groups[period] = (calendar.time_strs[period], [])
+        groups[period][1].append(file)
+    return groups
+
+
+def count_files(current_files, grid):
+    '''
+    Read and reclassify files, and count observations.
+    INPUTS:
+        current_files : list of str : list of paths to files
+        grid : dict : common grid covering all files; see
+            utils_proportions.make_grid
+    RETURNS:
+        counts : PeriodCounts : counts of all files
+    '''
+    counts = PeriodCounts(grid)
+    for file in current_files:
+        # open the file
+        raster, window = utils.read_into_grid(file, grid)
+        if raster is None:
+            continue
 
         # reclassify layer and add to previous
-        open_sw_new, partial_sw_new, nonwater_new, valid_new = utils.reclassify(raster)
-        
-        # add new layer to previous
-        open_sw += open_sw_new
-        partial_sw += partial_sw_new
-        nonwater += nonwater_new
-        total += valid_new
+        counts.add(utils.reclassify(raster), window)
+    return counts
+
+
+def count_job(job):
+    '''
+    Count the files of one job in a worker process.
+    '''
+    job_key, current_files, grid = job
+    return job_key, count_files(current_files, grid)
+
+
+def process_parallel(all_files, all_dates, prop_dirs, grid,
+                        calendars=None, workers=2, outputs=None, plan=None):
+    '''
+    Process files for one or more time periods with a pool of
+    worker processes. Each period is split into jobs of files;
+    workers return the counts of their job, which are merged
+    and saved once all jobs of the period are done. Files are
+    read once per time period (not once overall as in
+    process_all).
+    INPUTS:
+        all_files : list of str : list of paths to all DSWE files of interest
+        all_dates : list of dates : list of dates of files of interest
+        prop_dirs : dict : time periods to process files by as
+            keys, and paths to save their output data as values
+        grid : dict : common grid covering all files; see
+            utils_proportions.make_grid
+        calendars : dict : time periods as keys and their
+            calendars as values; see make_calendars; made from
+            all_dates if None
+        workers : int : number of worker processes
+        outputs : dict : output files of the periods; see
+            PeriodCounts.save
+        plan : tuple : periods to process; see plan_periods. If
+            None, all periods are processed from all files, and
+            their counts are saved
+    RETURNS:
+        processed data saved in prop_dirs
+    '''
+    if outputs is None:
+        outputs = {}
+    if calendars is None:
+        calendars = make_calendars(prop_dirs, all_dates)
+    own_plan = plan is None
+    if own_plan:
+        plan = plan_periods(all_files, all_dates, prop_dirs, grid, calendars)
+    period_plans = plan[0]
+
+    # files of the periods to process (eg. inside the chunk)
+    in_files = set(all_files)
+    periods = {}
+    for time_period in prop_dirs:
+        for period, period_plan in period_plans[time_period].items():
+            current_files = [file for file in period_plan['files']
+                                if file in in_files]
+            if current_files:
+                periods[(time_period, period)] = (period_plan['time_str'],
+                                                    current_files)
+    if not periods:
+        if own_plan:
+            save_manifests(prop_dirs, plan, outputs)
+        return
+
+    # split periods so that there are enough jobs for all
+        # workers (eg. a single multiyear period)
+    n_splits = math.ceil(workers / len(periods))
+    jobs = []
+    n_jobs = {}
+    for key in sorted(periods):
+        current_files = periods[key][1]
+        n_parts = min(n_splits, len(current_files))
+        for part in range(n_parts):
+            jobs.append((key, current_files[part::n_parts], grid))
+        n_jobs[key] = n_parts
+
+    # slabs of rolling windows must be added in time order
+    rolling = {}
+    slabs_todo = {}
+    slabs_done = {}
+    for time_period, prop_dir in prop_dirs.items():
+        if calendars[time_period].rolling:
+            rolling[time_period] = RollingSums(calendars[time_period], grid,
+                                                prop_dir, outputs)
+            slabs_todo[time_period] = sorted(period for tp_key, period in periods
+                                                if tp_key == time_period)
+            slabs_done[time_period] = {}
+
+    # merge counts of each period as the jobs finish
+    period_counts = {}
+    with multiprocessing.Pool(workers) as pool:
+        for key, counts in pool.imap_unordered(count_job, jobs):
+            if key in period_counts:
+                period_counts[key].merge(counts)
+            else:
+                period_counts[key] = counts
+            n_jobs[key] -= 1
 
-    # calculate proportions open and partial surface water
-    open_sw_prop = utils.calculate_proportion(open_sw, total)
-    partial_sw_prop = utils.calculate_proportion(partial_sw, total)
-    nonwater_prop = utils.calculate_proportion(nonwater, total)
+            if n_jobs[key] == 0 and key[0] in rolling:
+                time_period, period = key
+                slabs_done[time_period][period] = period_counts.pop(key)
+                todo = slabs_todo[time_period]
+                while todo and todo[0] in slabs_done[time_period]:
+                    slab = todo.pop(0)
+                    rolling[time_period].add(slab,
+                            slabs_done[time_period].pop(slab))
+            elif n_jobs[key] == 0:
+                time_period, period = key
+                time_str = periods[key][0]
+                counts = period_counts.pop(key)
+                counts.base = period_plans[time_period][period]['base']
+                counts.save(prop_dirs[time_period], time_str, outputs)
+                print(f'Proportions completed for {time_str}')
 
-    # create output files
-    prop_data = [open_sw_prop, partial_sw_prop, nonwater_prop]
-    data_str = ['open_sw', 'partial_sw', 'nonwater']
+    for rolling_sums in rolling.values():
+        rolling_sums.finish()
 
-    for i, data in enumerate(prop_data):
-        utils.create_output_file(data, data_str[i],
-                prop_dir, time_str,
-                geo_transform, projection)
+    if own_plan:
+        save_manifests(prop_dirs, plan, outputs)
 
 
-def process_by_year(all_files, all_dates, prop_dir, max_extent):
+def plan_periods(all_files, all_dates, prop_dirs, grid, calendars,
+                    update=False):
     '''
-    Process files yearly.
+    Find the periods to process and the files to read for each.
+    Without update, every period is processed from all of its
+    files. With update, the manifest of the counts saved by the
+    last run (see utils_proportions.read_manifest) is checked:
+    periods whose files were all counted are skipped, and periods
+    with new files only read the new files and add their counts
+    to the saved counts. Periods are processed from all of their
+    files if files were removed, or if the grid has changed.
+    Rolling windows are always processed from all of their files,
+    and are left out of the manifests: their slabs are not saved
+    as counts of their own, so they cannot be updated.
     INPUTS:
         all_files : list of str : list of paths to all DSWE files of interest
         all_dates : list of dates : list of dates of files of interest
-        prop_dir : str : path to save output data
-        max_extent : list of float : max extent of all files;
-            in form [minx, maxy, maxx, miny]
+        prop_dirs : dict : time periods to process files by as
+            keys, and paths to save their output data as values
+        grid : dict : common grid covering all files; see
+            utils_proportions.make_grid
+        calendars : dict : time periods as keys and their
+            calendars as values; see make_calendars
+        update : bool : if True, only process new files
     RETURNS:
-        processed data saved in prop_dir
+        plan : tuple : (period_plans, manifests); period_plans
+            has time periods as keys and dicts of period keys and
+            {'time_str', 'files' (paths to read), 'base' (add saved
+            counts), 'names' (names of all files of the period)}
+            as values; manifests has the manifest to update for
+            each time period (None for rolling windows)
     '''
-    all_years = [i.year for i in all_dates]
-    start_year = min(all_years)
-    end_year = max(all_years)
+    period_plans = {}
+    manifests = {}
+    for time_period, prop_dir in prop_dirs.items():
+        period_plans[time_period] = {}
+        groups = group_files(all_files, all_dates, calendars[time_period])
+        if calendars[time_period].rolling:
+            # process all slabs from all of their files
+            manifests[time_period] = None
+            for period, (time_str, current_files) in groups.items():
+                names = sorted(os.path.basename(file) for file in current_files)
+                period_plans[time_period][period] = {'time_str': time_str,
+                                                        'files': current_files,
+                                                        'base': False,
+                                                        'names': names}
+            print(f'{len(groups)} slabs to process for {time_period}')
+            continue
 
-    for current_time in range(start_year, end_year+1):
-        current_files = []
-        # make a list of files in the current year of interest
-        for i, file in enumerate(all_files):
-            file_time = all_years[i]
-            if file_time == current_time:
-                current_files.append(file)
+        manifest = {'grid': utils.manifest_grid(grid), 'periods': {}}
+        if update:
+            saved = utils.read_manifest(prop_dir)
+            if saved['grid'] == manifest['grid']:
+                manifest = saved
+            elif saved['grid'] is not None:
+                print(f'Grid has changed; processing all files for {time_period}')
+        manifests[time_period] = manifest
 
-        # process files in current year of interest
-        time_str = str(current_time)
-        process_files(current_files, prop_dir, max_extent, time_str)
-        if current_files != []:
-            print(f'Proportions completed for {time_str}')
+        for period, (time_str, current_files) in groups.items():
+            names = sorted(os.path.basename(file) for file in current_files)
+            counted = set(manifest['periods'].get(time_str, []))
+            if counted == set(names):
+                # period is up to date
+                continue
 
+            saved_files = [utils.counts_path(prop_dir, time_str)] + [
+                                utils.output_path(data_str, prop_dir, time_str)
+                                for data_str in ['open_sw', 'partial_sw', 'nonwater']]
+            base = (bool(counted) and counted <= set(names) and
+                        all(os.path.isfile(file) for file in saved_files))
+            if base:
+                current_files = [file for file in current_files
+                                    if os.path.basename(file) not in counted]
+            period_plans[time_period][period] = {'time_str': time_str,
+                                                    'files': current_files,
+                                                    'base': base,
+                                                    'names': names}
+        print(f'{len(period_plans[time_period])} periods to process for {time_period}')
+    return period_plans, manifests
 
-def process_by_month(all_files, all_dates, prop_dir, max_extent):
+
+def save_manifests(prop_dirs, plan, outputs):
     '''
-    Process files monthly.
+    Replace the saved counts of the periods processed in this
+    run, and record the files they include in the manifests.
+    INPUTS:
+        prop_dirs : dict : time periods as keys, and paths to
+            their output data as values
+        plan : tuple : periods processed; see plan_periods
+        outputs : dict : output files of the periods; see
+            PeriodCounts.save
+    '''
+    period_plans, manifests = plan
+    for key in outputs:
+        if key[2] == 'counts':
+            prop_dir, time_str, _ = key
+            utils.save_counts_file(prop_dir, time_str)
+
+    for time_period, prop_dir in prop_dirs.items():
+        manifest = manifests[time_period]
+        if manifest is None:
+            # rolling windows are always processed from all files
+            continue
+        for period_plan in period_plans[time_period].values():
+            time_str = period_plan['time_str']
+            if (prop_dir, time_str, 'counts') in outputs:
+                manifest['periods'][time_str] = period_plan['names']
+        os.makedirs(os.path.join(prop_dir, utils.COUNTS_DIR), exist_ok=True)
+        utils.write_manifest(prop_dir, manifest)
+
+
+def process_chunks(index, prop_dirs, grid, calendars, workers=1,
+                        chunk_size=None, update=False):
+    '''
+    Process files chunk by chunk of the common grid, so that
+    memory use is bounded by the chunk size rather than the size
+    of the study area. Only the part of each file inside the
+    current chunk is read, and the proportions of each chunk
+    are written into their window of the output files.
+    INPUTS:
+        index : SceneIndex : index of all DSWE files of interest;
+            see utils_proportions.SceneIndex
+        prop_dirs : dict : time periods to process files by as
+            keys, and paths to save their output data as values
+        grid : dict : common grid covering all files; see
+            utils_proportions.make_grid
+        calendars : dict : time periods as keys and their
+            calendars as values; see make_calendars
+        workers : int : number of processes to use
+        chunk_size : int : number of rows and columns of each
+            chunk; if None, the whole grid is one chunk
+        update : bool : if True, only process periods with new
+            files, adding their counts to the saved counts; see
+            plan_periods
+    RETURNS:
+        processed data saved in prop_dirs
+    '''
+    plan = plan_periods(index.paths.tolist(), index.dates, prop_dirs, grid,
+                            calendars, update)
+
+    outputs = {}
+    chunks = utils.make_chunks(grid, chunk_size)
+    for i, chunk in enumerate(chunks, start=1):
+        if len(chunks) > 1:
+            print(f'Processing chunk {i} of {len(chunks)}')
+
+        # only files overlapping the chunk need to be opened
+        chunk_index = index.subset(index.in_grid(chunk))
+        chunk_files = chunk_index.paths.tolist()
+        chunk_dates = chunk_index.dates
+
+        if workers > 1:
+            process_parallel(chunk_files, chunk_dates, prop_dirs, chunk,
+                                calendars, workers, outputs, plan)
+        else:
+            process_all(chunk_files, chunk_dates, prop_dirs, chunk,
+                            calendars, outputs, plan)
+
+    save_manifests(prop_dirs, plan, outputs)
+
+
+def process_by_year(all_files, all_dates, prop_dir, grid):
+    '''
+    Process files yearly.
     INPUTS:
         all_files : list of str : list of paths to all DSWE files of interest
         all_dates : list of dates : list of dates of files of interest
         prop_dir : str : path to save output data
-        max_extent : list of float : max extent of all files;
-            in form [minx, maxy, maxx, miny]
+        grid : dict : common grid covering all files; see
+            utils_proportions.make_grid
     RETURNS:
         processed data saved in prop_dir
     '''
-    start_date = datetime.date(min(all_dates).year, 1, 1)
-    end_date = datetime.date(max(all_dates).year+1, 1, 1)
+    process_all(all_files, all_dates, {'year': prop_dir}, grid)
 
-    for current_time in rrule(freq=MONTHLY,
-            dtstart=start_date, until=end_date):
-        current_files = []
-        # make a list of files in the current month of interest
-        for i, file in enumerate(all_files):
-            file_time = all_dates[i]
-            if (file_time.month == current_time.month and
-                    file_time.year == current_time.year):
-                current_files.append(file)
 
-        # process files in current month of interest
-        time_str = current_time.strftime("%b_%Y")
-        process_files(current_files, prop_dir, max_extent, time_str)
-        if current_files != []:
-            print(f'Proportions completed for {time_str}')
+def process_by_month(all_files, all_dates, prop_dir, grid):
+    '''
+    Process files monthly.
+    INPUTS:
+        all_files : list of str : list of paths to all DSWE files of interest
+        all_dates : list of dates : list of dates of files of interest
+        prop_dir : str : path to save output data
+        grid : dict : common grid covering all files; see
+            utils_proportions.make_grid
+    RETURNS:
+        processed data saved in prop_dir
+    '''
+    process_all(all_files, all_dates, {'month': prop_dir}, grid)
 
 
-def process_by_month_across_years(all_files, all_dates, prop_dir, max_extent):
+def process_by_month_across_years(all_files, all_dates, prop_dir, grid):
     '''
     Process files across all months for all years
     INPUTS:
         all_files : list of str : list of paths to all DSWE files of interest
         all_dates : list of dates : list of dates of files of interest
         prop_dir : str : path to save output data
-        max_extent : list of float : max extent of all files;
-            in form [minx, maxy, maxx, miny]
+        grid : dict : common grid covering all files; see
+            utils_proportions.make_grid
     RETURNS:
         processed data saved in prop_dir
     '''
-    all_months = [i.month for i in all_dates]
-    start_month = min(all_months)
-    end_month = max(all_months)
+    process_all(all_files, all_dates, {'month_across_years': prop_dir},
+                    grid)
 
-    for current_time in range(start_month, end_month+1):
-        current_files = []
-        # make a list of files in the current month of interest
-        for i, file in enumerate(all_files):
-            file_time = all_months[i]
-            if file_time == current_time:
-                current_files.append(file)
 
-        # process files in current month of interest
-        month_str = datetime.date(1800, current_time, 1)
-        time_str = month_str.strftime("%B")
-        process_files(current_files, prop_dir, max_extent, time_str)
-        if current_files != []:
-            print(f'Proportions completed for {time_str}')
-
-
-def process_by_multiyear(all_files, all_dates, prop_dir, max_extent, multiyear):
+def process_by_multiyear(all_files, all_dates, prop_dir, grid, multiyear):
     '''
     Process files by group of years
     INPUTS:
         all_files : list of str : list of paths to all DSWE files of interest
         all_dates : list of dates : list of dates of files of interest
         prop_dir : str : path to save output data
-        max_extent : list of float : max extent of all files;
-            in form [minx, maxy, maxx, miny]
+        grid : dict : common grid covering all files; see
+            utils_proportions.make_grid
         multiyear : int : group of years to process files by
     RETURNS:
         processed data saved in prop_dir
     '''
-    all_years = [i.year for i in all_dates]
-    start_year = min(all_years)
-    start_year = start_year - start_year%multiyear
-    end_year = max(all_years)
-
-    for current_time in range(start_year, end_year+multiyear, multiyear):
-        current_files = []
-        # make a list of files in the current group of years
-            # of interest
-        for i, file in enumerate(all_files):
-            file_time = all_years[i]
-            
-            if (file_time - file_time%multiyear) == current_time:
-                current_files.append(file)
-
-        # process files in current range of interest
-        time_str = str(current_time) + '_' + str(current_time+multiyear-1)
-        process_files(current_files, prop_dir, max_extent, time_str)
-        if current_files != []:
-            print(f'Proportions completed for {time_str}')
+    calendars = make_calendars(['multiyear'], all_dates,
+                                {'multiyear': multiyear})
+    process_all(all_files, all_dates, {'multiyear': prop_dir},
+                    grid, calendars)
 
 
-def process_by_season(all_files, all_dates, prop_dir, max_extent):
+def process_by_season(all_files, all_dates, prop_dir, grid):
     '''
     Process files seasonally;
     seasons defined meteorologically:
@@ -209,28 +909,9 @@ def process_by_season(all_files, all_dates, prop_dir, max_extent):
         all_files : list of str : list of paths to all DSWE files of interest
         all_dates : list of dates : list of dates of files of interest
         prop_dir : str : path to save output data
-        max_extent : list of float : max extent of all files;
-            in form [minx, maxy, maxx, miny]
+        grid : dict : common grid covering all files; see
+            utils_proportions.make_grid
     RETURNS:
         processed data saved in prop_dir
     '''
-    start_date = datetime.date(min(all_dates).year-1, 12, 1)
-    end_date = datetime.date(max(all_dates).year+1, 1, 1)
-
-    for current_time in rrule(freq=MONTHLY, interval=3,
-            dtstart=start_date, until=end_date):
-        current_files = []
-        current_time_range = utils.find_season_time_range(current_time)
-        # make a list of files in the current month of interest
-        for i, file in enumerate(all_files):
-            file_time = all_dates[i]
-            if (file_time.month in current_time_range and
-                    file_time.year == current_time.year):
-                current_files.append(file)
-
-        # process files in current season of interest
-        season = utils.find_season(current_time_range)
-        time_str = season + '_' + str(current_time.year)
-        process_files(current_files, prop_dir, max_extent, time_str)
-        if current_files != []:
-            print(f'Proportions completed for {time_str}')
+    process_all(all_files, all_dates, {'season': prop_dir}, grid)
@@ -0,0 +1,248 @@
+'''
+Export the reclassified DSWE states of every date into a
+time-series cube, and read time series and counts back from it.
+
+The cube is an HDF5 file with a 'state' dataset of shape
+(n_dates, n_rows, n_cols) on the common grid of all files,
+holding the class codes of utils_proportions.reclassify
+(NONWATER, OPEN_SW, PARTIAL_SW, OTHER_VALID, INVALID), and a
+sorted 'time' dataset (days since 1970-01-01) indexing its
+first dimension. The state dataset is chunked and compressed,
+so that per-pixel time series and counts over any range of
+dates are read without opening the DSWE files again.
+'''
+import argparse
+import h5py
+import numpy as np
+import os
+import utils_proportions as utils
+
+# chunks of the state dataset (dates, rows, cols)
+CUBE_CHUNKS = (32, 256, 256)
+
+STATE_NAMES = {utils.NONWATER: 'nonwater',
+                utils.OPEN_SW: 'open_sw',
+                utils.PARTIAL_SW: 'partial_sw',
+                utils.OTHER_VALID: 'other_valid',
+                utils.INVALID: 'invalid'}
+
+
+def cube_path(main_dir, dswe_layer):
+    '''
+    Path to the time-series cube of a DSWE layer.
+    '''
+    return os.path.join(main_dir, f'dswe_cube_{dswe_layer}.h5')
+
+
+def write_cube(index, grid, file_path, chunk_size=1024):
+    '''
+    Write the reclassified states of all files into a cube.
+    The grid is processed in chunks, and dates in blocks of
+    the cube's chunk length, so that each block of the cube
+    is written once and memory use is bounded. Where several
+    files have the same date (eg. different tiles), the first
+    valid observation of each pixel is kept.
+    INPUTS:
+        index : SceneIndex : index of all DSWE files of interest;
+            see utils_proportions.SceneIndex
+        grid : dict : common grid covering all files; see
+            utils_proportions.make_grid
+        file_path : str : path to the cube to write
+    OPTIONAL INPUTS:
+        chunk_size : int : number of rows and columns of the
+            chunks of the grid that are processed at a time;
+            should be a multiple of the cube's chunks
+    RETURNS:
+        cube saved at file_path
+    '''
+    dates = np.unique(index.dates)
+    if len(dates) == 0:
+        # h5py cannot make chunks of length 0
+        raise Exception('No DSWE files to write into the cube')
+    n_rows, n_cols = grid['shape']
+    chunks = (min(CUBE_CHUNKS[0], len(dates)), min(CUBE_CHUNKS[1], n_rows),
+                min(CUBE_CHUNKS[2], n_cols))
+    n_times = chunks[0]
+
+    # write to a temporary file, so an interrupted export does
+        # not leave an incomplete cube behind
+    with h5py.File(file_path + '.tmp', 'w') as cube:
+        cube.attrs['geo_transform'] = grid['geo_transform']
+        cube.attrs['projection'] = grid['projection']
+        time = cube.create_dataset('time',
+                    data=dates.astype(np.int64).astype(np.int32))
+        time.attrs['units'] = 'days since 1970-01-01'
+        state = cube.create_dataset('state', shape=(len(dates), n_rows, n_cols),
+                    dtype=np.uint8, chunks=chunks, compression='gzip',
+                    shuffle=True, fillvalue=utils.INVALID)
+        for code, name in STATE_NAMES.items():
+            state.attrs[name] = code
+
+        for i, chunk in enumerate(utils.make_chunks(grid, chunk_size), start=1):
+            print(f'Writing chunk {i}')
+            rows, cols = chunk['window']
+
+            # date index of each file in the chunk
+            chunk_index = index.subset(index.in_grid(chunk))
+            date_index = np.searchsorted(dates, chunk_index.dates)
+            order = np.argsort(date_index, kind='stable')
+
+            # read the files of each block of dates
+            block_starts = np.searchsorted(date_index[order],
+                                np.arange(0, len(dates), n_times))
+            block_starts = np.append(block_starts, len(order))
+            for block, t_start in enumerate(range(0, len(dates), n_times)):
+                block_order = order[block_starts[block]:block_starts[block + 1]]
+                if len(block_order) == 0:
+                    # left as fill value (INVALID)
+                    continue
+
+                t_stop = min(t_start + n_times, len(dates))
+                states = np.full((t_stop - t_start,) + chunk['shape'],
+                                    utils.INVALID, dtype=np.uint8)
+                for j in block_order:
+                    raster, window = utils.read_into_grid(
+                                        chunk_index.paths[j], chunk)
+                    if raster is None:
+                        continue
+                    current = states[date_index[j] - t_start][window]
+                    np.copyto(current, utils.reclassify(raster),
+                                where=current == utils.INVALID)
+                state[t_start:t_stop, rows, cols] = states
+
+    os.replace(file_path + '.tmp', file_path)
+
+
+def read_dates(file_path):
+    '''
+    Read the dates indexing the first dimension of a cube.
+    RETURNS:
+        dates : numpy array : sorted datetime64[D] dates
+    '''
+    with h5py.File(file_path, 'r') as cube:
+        return cube['time'][:].astype('datetime64[D]')
+
+
+def read_time_series(file_path, row, col, start_date=None, end_date=None):
+    '''
+    Read the time series of states of one pixel.
+    INPUTS:
+        file_path : str : path to the cube
+        row : int : row of the pixel in the grid
+        col : int : column of the pixel in the grid
+    OPTIONAL INPUTS:
+        start_date : date : first date (inclusive)
+        end_date : date : last date (exclusive)
+    RETURNS:
+        dates : numpy array : datetime64[D] dates of the series
+        states : numpy array : class code of the pixel on each date
+    '''
+    with h5py.File(file_path, 'r') as cube:
+        dates = cube['time'][:].astype('datetime64[D]')
+        times = utils.date_range(dates, start_date, end_date)
+        return dates[times], cube['state'][times, row, col]
+
+
+def count_states(file_path, start_date=None, end_date=None, window=None):
+    '''
+    Count the observations of each state over a range of dates,
+    reading the cube one block of dates at a time; proportions
+    can then be calculated with utils_proportions.calculate_proportion.
+    INPUTS:
+        file_path : str : path to the cube
+    OPTIONAL INPUTS:
+        start_date : date : first date (inclusive)
+        end_date : date : last date (exclusive)
+        window : tuple of slice : (rows, cols) part of the grid
+            to count; defaults to the whole grid
+    RETURNS:
+        counts : dict : 'open_sw', 'partial_sw', 'nonwater' and
+            'total' (valid observations) counts as uint16 arrays
+    '''
+    with h5py.File(file_path, 'r') as cube:
+        state = cube['state']
+        if window is None:
+            window = (slice(0, state.shape[1]), slice(0, state.shape[2]))
+        rows, cols = window
+        shape = (rows.stop - rows.start, cols.stop - cols.start)
+
+        counts = {name: np.zeros(shape, dtype=np.uint16)
+                    for name in ['open_sw', 'partial_sw', 'nonwater', 'total']}
+        times = utils.date_range(cube['time'][:].astype('datetime64[D]'),
+                                    start_date, end_date)
+        n_times = state.chunks[0]
+        for t_start in range(times.start, times.stop, n_times):
+            t_stop = min(t_start + n_times, times.stop)
+            states = state[t_start:t_stop, rows, cols]
+            for name, test in [('open_sw', states == utils.OPEN_SW),
+                        ('partial_sw', states == utils.PARTIAL_SW),
+                        ('nonwater', states == utils.NONWATER),
+                        ('total', states != utils.INVALID)]:
+                counts[name] += test.sum(axis=0, dtype=np.uint16)
+    return counts
+
+
+def main(main_dir, dswe_layer, rescan=False, chunk_size=1024, min_valid=None,
+            start_date=None, end_date=None):
+    '''
+    Export the reclassified states of all DSWE files of a layer
+    into a time-series cube in main_dir.
+    INPUTS:
+        main_dir : str : main directory where DSWE data is located
+        dswe_layer : str : DSWE layer to export; INWM or INTR
+        rescan : bool : if True, walk the directory tree to add
+            uncataloged DSWE files to the catalog
+        min_valid : float : if given, only export DSWE files with
+            at least this percent of valid pixels in the catalog
+        chunk_size : int : number of rows and columns of the
+            chunks of the grid that are processed at a time
+        start_date : str : YYYY-MM-DD; only export DSWE files
+            from this date (inclusive)
+        end_date : str : YYYY-MM-DD; only export DSWE files
+            before this date (exclusive)
+    RETURNS:
+        cube saved in main_dir
+    '''
+    records = utils.get_records(main_dir, dswe_layer, rescan, min_valid)
+    index = utils.SceneIndex(records)
+    dates = index.date_range(start_date, end_date)
+    index = index.subset(np.arange(dates.start, dates.stop))
+    if len(index) == 0:
+        raise Exception(f'No {dswe_layer} files to export in {main_dir}; '
+                        'check the dates, --min_valid, or try --rescan')
+    print(f'Exporting {len(index)} total scenes')
+
+    grid = utils.make_grid(index.records)
+    file_path = cube_path(main_dir, dswe_layer)
+    write_cube(index, grid, file_path, chunk_size)
+    print(f'Cube saved in {file_path}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export the reclassified DSWE states of every date into a time-series cube.')
+
+    parser.add_argument('main_dir',
+            metavar='DIRECTORY_PATH', type=str,
+            help='main directory where DSWE data is located')
+    parser.add_argument('dswe_layer',
+            type=str.upper,
+            choices=['INWM', 'INTR'],
+            help='DSWE layer to export')
+    parser.add_argument('--rescan',
+            action='store_true',
+            help='if flagged, search all directories (not only those modified since the last run) for DSWE files missing from the catalog')
+    parser.add_argument('--min_valid',
+            metavar='PERCENT', type=float,
+            help='only export DSWE files with at least this percentage of valid data, as scored in the catalog (see filter_valid_data.py)')
+    parser.add_argument('--chunk_size',
+            metavar='N', type=int, default=1024,
+            help='process the study area in chunks of N by N pixels; defaults to 1024')
+    parser.add_argument('--start',
+            dest='start_date', type=str,
+            help='only export DSWE files from this date; YYYY-MM-DD')
+    parser.add_argument('--end',
+            dest='end_date', type=str,
+            help='only export DSWE files before this date; YYYY-MM-DD')
+
+    args = parser.parse_args()
+    main(**vars(args))
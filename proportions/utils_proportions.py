@@ -1,69 +1,190 @@
 '''
 Utility functions for proportions.py
 '''
-import datetime
-import getopt
+import json
 import os
-import re
+import shutil
 import sys
 import gdal
 import numpy as np
-from dateutil.rrule import rrule, MONTHLY
-from dateutil.relativedelta import relativedelta
-
-
-def get_file_date(dirpath, filename):
-    '''
-    Gets date that file data was collected;
-    uses convention of scene_id (entity_id) or HLS (version 1.4)
-    as filename.
-    Note: date must be obtained from filename because date is not
-    stored in DSWE metadata!
-    '''
-    # this regex catches both landsat scene IDs and ARD scene IDs as filenames
-        # eg. both LT05_CU_029008_19990127_20190120_C01_V01_INTR.tif and 
-    scene_pattern = re.compile('L[C,E,T,M]0\d_CU_\d{6}_\d{8}_\d{8}_C01_V01_.*[A-Z]{4}\.tif')
-    # this regext catches HLS filenames
-    hls_pattern = re.compile('HLS.[L,S][1,3]0.T\w{5}.\d{7}.v\d.\d_[A-Z]{4}.tif')
-
-    if scene_pattern.match(filename):
-        file_year = int(filename[15:19])
-        file_month = int(filename[19:21])
-        file_day = int(filename[21:23])
-        file_date = datetime.date(file_year, file_month, file_day)
-    elif hls_pattern.match(filename):
-        file_year = int(filename[15:19])
-        file_year_day = int(filename[20:22])
-        file_date = datetime.datetime(file_year, 1, 1) + datetime.timedelta(file_year_day - 1)
-    else:
-        raise Exception('Filename does not match expected Scene ID or HLS format.')
-
-    return file_date
-
-
-def get_files(main_dir, dswe_layer):
+import gdal_merge
+
+# the catalog of DSWE outputs is maintained by the DSWE code
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                    '..', 'hls_dswe'))
+import catalog
+
+# class codes of reclassified DSWE pixels
+NONWATER, OPEN_SW, PARTIAL_SW, OTHER_VALID, INVALID = range(5)
+
+# lookup table from DSWE pixel value to class code
+RECLASS_TABLE = np.full(256, OTHER_VALID, dtype=np.uint8)
+# NO INUNDATION: nonwater
+RECLASS_TABLE[0] = NONWATER
+# OPEN SURFACE WATER: water, high/mod confidence
+RECLASS_TABLE[[1, 2]] = OPEN_SW
+# PARTIAL SURFACE WATER: wetland, water low confidence
+RECLASS_TABLE[[3, 4]] = PARTIAL_SW
+# INVALID observations: no data or cloud/snow
+RECLASS_TABLE[[9, 255]] = INVALID
+
+# saved counts of each period are kept in this subdirectory
+    # of the output directory, with a manifest of their files
+COUNTS_DIR = 'counts'
+MANIFEST_NAME = 'manifest.json'
+
+# creation options of mosaics translated from VRTs
+MOSAIC_OPTIONS = ['TILED=YES', 'COMPRESS=DEFLATE', 'BIGTIFF=IF_SAFER',
+                    'NUM_THREADS=ALL_CPUS']
+
+
+def get_records(main_dir, dswe_layer, rescan=False, min_valid=None):
     '''
-    Creates list of DSWE files with the layer of interest
-    and list of file dates.
+    Get catalog records of all DSWE files with the layer of
+    interest. The catalog is kept by dswe.py in the DSWE output
+    directory; files are added to it from the directories that
+    were modified since the last scan (eg. after copying new
+    DSWE files in), or from all directories with rescan.
     INPUTS:
         main_dir : str : main directory where data is located
         dswe_layer : str : DSWE layer to be used in calculations
+    OPTIONAL INPUTS:
+        rescan : bool : if True, look for uncataloged files in
+            all directories, modified or not
+        min_valid : float : if given, only files with at least
+            this percent of valid pixels in the catalog are used;
+            files without a score (eg. added by a rescan) can be
+            scored with filter_valid_data.py --score_only
+    RETURNS:
+        records : list of dict : catalog record for each file,
+            sorted by date; see catalog.query_outputs
+    '''
+    conn = catalog.open_catalog(main_dir)
+    n_added, n_removed = catalog.scan_outputs(conn, main_dir,
+                                                changed_only=not rescan)
+    if n_added > 0 or rescan:
+        print(f'Added {n_added} files to the catalog')
+    if n_removed > 0:
+        print(f'Removed {n_removed} deleted files from the catalog')
+    if min_valid is None:
+        records = catalog.query_outputs(conn, main_dir, dswe_layer)
+    else:
+        records = catalog.query_outputs(conn, main_dir, dswe_layer,
+                                            min_valid / 100)
+        n_unscored = conn.execute('SELECT COUNT(*) FROM outputs WHERE layer = ? '
+                                    'AND valid_fraction IS NULL',
+                                    (dswe_layer,)).fetchone()[0]
+        if n_unscored > 0:
+            print(f'{n_unscored} files without a valid data score are not used')
+    conn.close()
+
+    for record in records:
+        # date must be obtained from the filename because
+            # date is not stored in DSWE metadata!
+        if record['acquisition_date'] is None:
+            raise Exception('Filename does not match expected Scene ID or HLS format.')
+    return records
+
+
+class SceneIndex(object):
+    '''
+    Index of DSWE files sorted by date, with columns as numpy
+    arrays: paths, dates (datetime64[D]), sensors, tile_ids,
+    footprints (see catalog.footprint_key; None if unknown) and
+    extents (minx, maxy, maxx, miny; nan if unknown). Dates are
+    parsed once when the index is built, and queries on dates
+    and extents are vectorized.
+    '''
+    def __init__(self, records):
+        records = sorted(records, key=lambda record: record['acquisition_date'])
+        self.records = records
+        self.paths = np.array([record['path'] for record in records],
+                                dtype=object)
+        self.dates = np.array([record['acquisition_date'] for record in records],
+                                dtype='datetime64[D]')
+        self.sensors = np.array([record['sensor'] for record in records],
+                                dtype=object)
+        self.tile_ids = np.array([record['tile_id'] for record in records],
+                                dtype=object)
+        self.footprints = np.array([record.get('footprint') for record in records],
+                                dtype=object)
+        self.extents = np.array([[record.get(key, np.nan)
+                                    for key in ['minx', 'maxy', 'maxx', 'miny']]
+                                    for record in records],
+                                dtype=float).reshape(-1, 4)
+
+    def __len__(self):
+        return len(self.paths)
+
+    def date_range(self, start_date=None, end_date=None):
+        '''
+        Find the slice of the index from start_date (inclusive)
+        to end_date (exclusive); see date_range.
+        '''
+        return date_range(self.dates, start_date, end_date)
+
+    def in_grid(self, grid):
+        '''
+        Find the files whose cataloged extent overlaps a grid
+        (eg. a chunk), without opening them.
+        RETURNS:
+            indices : numpy array : positions of the files in the index
+        '''
+        minx, x_res, _, maxy, _, y_res = grid['geo_transform']
+        n_rows, n_cols = grid['shape']
+        maxx = minx + x_res * n_cols
+        miny = maxy + y_res * n_rows
+        overlap = ((self.extents[:, 0] < maxx) & (self.extents[:, 2] > minx) &
+                    (self.extents[:, 3] < maxy) & (self.extents[:, 1] > miny))
+        return np.nonzero(overlap)[0]
+
+    def footprint_groups(self):
+        '''
+        Group files by exact footprint, using the footprint keys
+        recorded in the catalog; no raster is opened.
+        RETURNS:
+            groups : dict : footprint keys as keys, and positions
+                of the files with that footprint as values
+        '''
+        keys, inverse = np.unique(self.footprints.astype(str),
+                                    return_inverse=True)
+        order = np.argsort(inverse, kind='stable')
+        splits = np.cumsum(np.bincount(inverse, minlength=len(keys)))[:-1]
+        return dict(zip(keys.tolist(), np.split(order, splits)))
+
+    def subset(self, indices):
+        '''
+        Make an index of some of the files of this index.
+        '''
+        indices = np.sort(indices)
+        index = SceneIndex([])
+        index.records = [self.records[i] for i in indices]
+        index.paths = self.paths[indices]
+        index.dates = self.dates[indices]
+        index.sensors = self.sensors[indices]
+        index.tile_ids = self.tile_ids[indices]
+        index.footprints = self.footprints[indices]
+        index.extents = self.extents[indices]
+        return index
+
+
+def date_range(dates, start_date=None, end_date=None):
+    '''
+    Find the slice of sorted dates from start_date (inclusive)
+    to end_date (exclusive), with a search of the dates; either
+    can be None.
+    INPUTS:
+        dates : numpy array : sorted datetime64[D] dates
     RETURNS:
-        all_files : list of str : list of all relevant DSWE file paths
-        all_dates : list of dates : list of all file dates
-    '''
-    all_files = []
-    all_dates = []
-    # look through all directories and subdirectories
-    for dirpath, _, filenames in os.walk(main_dir):
-        # find all files in tree
-        for filename in filenames:
-            # if the file is the layer of interest
-            if dswe_layer in filename:
-                all_files.append(os.path.join(dirpath, filename))
-                file_date = get_file_date(dirpath, filename)
-                all_dates.append(file_date)
-    return all_files, all_dates
+        dates_slice : slice : positions of the dates in the range
+    '''
+    start = 0
+    stop = len(dates)
+    if start_date is not None:
+        start = np.searchsorted(dates, np.datetime64(start_date, 'D'))
+    if end_date is not None:
+        stop = np.searchsorted(dates, np.datetime64(end_date, 'D'))
+    return slice(int(start), int(stop))
 
 
 def make_output_dir(main_dir, time_period):
@@ -79,144 +200,170 @@ def make_output_dir(main_dir, time_period):
     return prop_dir
 
 
-def get_corner(file):
+def make_output_dirs(main_dir, calendars):
     '''
-    Get coordinates of top left corner of raster.
+    Create directories to store results of each time period in.
     INPUTS:
-        file : str : filename of interest
+        main_dir : str : main directory where data is located
+        calendars : dict : time periods to process files by as
+            keys, and their calendars as values; see
+            time_periods.make_calendars
     RETURNS:
-        top_left : tuple : coordinates of corner (x_min, y_max)
-            and filename of interest
+        prop_dirs : dict : time periods as keys and paths to
+            directories where their results will be stored as values
     '''
-    raster = gdal.Open(os.path.abspath(file))
-    geo_transform = raster.GetGeoTransform()
-    
-    x_size = raster.RasterXSize
-    y_size = raster.RasterYSize
-    x_res = geo_transform[1]
-    y_res = geo_transform[5]
-
-    x_min = geo_transform[0]
-    y_max = geo_transform[3]
-
-    top_left = (x_min, y_max, file)
+    prop_dirs = {}
+    for time_period, calendar in calendars.items():
+        prop_dirs[time_period] = make_output_dir(main_dir, calendar.name)
+    return prop_dirs
 
-    return top_left
 
-
-def find_max_extent(file, extent_0):
+def find_max_extent(record, extent_0):
     '''
     Determine the maximum extent of all files;
     ensures that no images are cropped and that
     extent/georeferencing remains consistent
     INPUTS:
-        file : str : path to current file being processed
+        record : dict : catalog record of current file
         extent_0 : list : initial extent values to be overwritten;
             in order [minx, maxy, maxx, miny]
     RETURNS:
         extent_0 : list : updated extent values
     '''
-    # calculate extent of current file
-    raster = gdal.Open(os.path.abspath(file))
-    geo_transform = raster.GetGeoTransform()
-
-    minx = geo_transform[0]
-    maxy = geo_transform[3]
-    maxx = minx + geo_transform[1] * raster.RasterXSize
-    miny = maxy + geo_transform[5] * raster.RasterYSize
-
     # rewrite extent with larger values
-    #XXX is this correct? appears to be decreasing every time
-        # (finding minimum instead of maximum extent)
-    if minx < extent_0[0]:
-        extent_0[0] = minx
-    if maxy > extent_0[1]:
-        extent_0[1] = maxy
-    if maxx > extent_0[2]:
-        extent_0[2] = maxx
-    if miny < extent_0[3]:
-        extent_0[3] = miny
+    if record['minx'] < extent_0[0]:
+        extent_0[0] = record['minx']
+    if record['maxy'] > extent_0[1]:
+        extent_0[1] = record['maxy']
+    if record['maxx'] > extent_0[2]:
+        extent_0[2] = record['maxx']
+    if record['miny'] < extent_0[3]:
+        extent_0[3] = record['miny']
     return extent_0
 
 
-def find_season_time_range(current_time):
+def make_grid(records):
     '''
-    Find time range of a particular season.
+    Define the common grid covering the max extent of all
+    files, with the pixel size and projection of the files.
     INPUTS:
-        current_time : date : current time (beginning of season)
+        records : list of dict : catalog records of all files
     RETURNS:
-        current_time_range : list of int : list of months in season
+        grid : dict : 'geo_transform' (tuple), 'projection'
+            (str) and 'shape' (n_rows, n_cols) of the grid
     '''
-    until_time = current_time + relativedelta(months=2)
+    # initialize extent to be overwritten
+    extent_0 = [1e12, -1e12, -1e12, 1e12]
+    # loop through all files to calculate max extent
+    for record in records:
+        extent_0 = find_max_extent(record, extent_0)
+    minx, maxy, maxx, miny = extent_0
 
-    current_time_range = list(rrule(freq=MONTHLY,
-            dtstart=current_time, until=until_time))
-    current_time_range = [i.month for i in current_time_range]
-    return current_time_range
+    x_res = records[0]['geo_transform'][1]
+    y_res = records[0]['geo_transform'][5]
+    n_cols = int(round((maxx - minx) / x_res))
+    n_rows = int(round((miny - maxy) / y_res))
 
+    grid = {'geo_transform': (minx, x_res, 0.0, maxy, 0.0, y_res),
+            'projection': records[0]['projection'],
+            'shape': (n_rows, n_cols)}
+    return grid
 
-def find_season(current_time_range):
+
+def make_chunks(grid, chunk_size=None):
     '''
-    Assign a string to the season in the N. Hemisphere.
+    Split the common grid into square chunks, so that counts
+    only need to be held in memory for one chunk at a time.
     INPUTS:
-        current_time_range : list of int : list of months in the season
+        grid : dict : common grid; see make_grid
+    OPTIONAL INPUTS:
+        chunk_size : int : number of rows and columns of each
+            chunk; if None, the whole grid is one chunk
     RETURNS:
-        season : str : season in N. Hemisphere
+        chunks : list of dict : one grid per chunk (see
+            make_grid), with the 'window' (rows, cols) of the
+            chunk in the grid and the 'full_grid' it is part of
     '''
-    if 12 in current_time_range:
-        season = 'Winter'
-    if 3 in current_time_range:
-        season = 'Spring'
-    if 6 in current_time_range:
-        season = 'Summer'
-    if 9 in current_time_range:
-        season = 'Autumn'
-    return season
-
-
-def open_raster(file, prop_dir, max_extent):
+    n_rows, n_cols = grid['shape']
+    if chunk_size is None:
+        chunk_size = max(n_rows, n_cols)
+    minx, x_res, _, maxy, _, y_res = grid['geo_transform']
+
+    chunks = []
+    for row_start in range(0, n_rows, chunk_size):
+        row_stop = min(row_start + chunk_size, n_rows)
+        for col_start in range(0, n_cols, chunk_size):
+            col_stop = min(col_start + chunk_size, n_cols)
+            chunks.append({'geo_transform': (minx + col_start * x_res, x_res, 0.0,
+                                                maxy + row_start * y_res, 0.0, y_res),
+                            'projection': grid['projection'],
+                            'shape': (row_stop - row_start, col_stop - col_start),
+                            'window': (slice(row_start, row_stop),
+                                        slice(col_start, col_stop)),
+                            'full_grid': grid})
+    return chunks
+
+
+def read_into_grid(file, grid):
     '''
-    Open file and read as array.
+    Read the part of a file that falls inside the common grid,
+    and find its window in the grid; nothing is written to disk.
     INPUTS:
         file : str : path to current file to open
-        prop_dir : str : path to directory to temporarially save raster
-        max_extent : list of float : max extent of all files;
-            in form [minx, maxy, maxx, miny]
+        grid : dict : common grid; see make_grid
     RETURNS:
-        raster : numpy array : array form of raster image
-        geo_transform : tuple : raster positions related to
-            georeferences coordinates by affine transform
-        projection : list : GDAL projection metadata
+        raster : numpy array : array of the raster inside the
+            grid; None if the raster is outside of the grid
+        window : tuple of slice : (rows, cols) position of
+            raster in the grid
     '''
-    # open the current file
-    raster = gdal.Open(os.path.abspath(file))
-
-    # expand layer to max extent of all data for the path/row
-    raster_max_extent = os.path.join(prop_dir, 'raster_temp.tif')
-    raster = gdal.Translate(raster_max_extent, raster, projWin=max_extent)
-    
-    geo_transform = raster.GetGeoTransform()
-    projection = raster.GetProjection()
-    raster = raster.GetRasterBand(1).ReadAsArray()
-
-    # remove temp file
-    os.remove(raster_max_extent)
-    return raster, geo_transform, projection
+    data = gdal.Open(os.path.abspath(file))
+    geo_transform = data.GetGeoTransform()
+    grid_transform = grid['geo_transform']
+    n_rows, n_cols = grid['shape']
+
+    # ensure that the file is on the same grid
+    if data.GetProjection() != grid['projection']:
+        raise Exception(f'{file} does not have the same projection as the other files')
+    if (geo_transform[1] != grid_transform[1] or
+            geo_transform[5] != grid_transform[5]):
+        raise Exception(f'{file} does not have the same pixel size as the other files')
+
+    # pixel offset of the file in the grid
+    col_off = (geo_transform[0] - grid_transform[0]) / grid_transform[1]
+    row_off = (geo_transform[3] - grid_transform[3]) / grid_transform[5]
+    if abs(col_off - round(col_off)) > 0.01 or abs(row_off - round(row_off)) > 0.01:
+        raise Exception(f'{file} is not aligned with the pixels of the other files')
+    col_off = int(round(col_off))
+    row_off = int(round(row_off))
+
+    # clip the file to the grid
+    col_start = max(col_off, 0)
+    row_start = max(row_off, 0)
+    col_stop = min(col_off + data.RasterXSize, n_cols)
+    row_stop = min(row_off + data.RasterYSize, n_rows)
+    if col_stop <= col_start or row_stop <= row_start:
+        return None, None
+
+    raster = data.GetRasterBand(1).ReadAsArray(col_start - col_off,
+                row_start - row_off,
+                col_stop - col_start, row_stop - row_start)
+    window = (slice(row_start, row_stop), slice(col_start, col_stop))
+    return raster, window
 
 
 def reclassify(raster):
     '''
-    Reclassify the layer with observations of interest
-    as 1 and observations not of interest as 0;
-    invalid observations are mapped to -1e12
+    Reclassify the layer into class codes used to count
+    observations: NONWATER, OPEN_SW, PARTIAL_SW, OTHER_VALID
+    (valid observations of none of the above) and INVALID.
+    Uses a lookup table, so only one uint8 array is created.
     INPUTS:
-        raster : numpy array : array of image raster
+        raster : numpy array : array of image raster (uint8)
     RETURNS:
-        open_sw : numpy array : open surface water pixels
-        partial_sw : numpy array : partial surface water pixels
-        nonwater : numpy array : non-water pixels
+        classes : numpy array : uint8 array of class codes
     DSWE CLASSIFICATION: for INTR and INWM layers
-        Pixel Value | rasterretation
+        Pixel Value | Interpretation
             0       |   not open_sw
             1       |   open_sw, high confidence
             2       |   open_sw, mod confidence
@@ -227,19 +374,8 @@ def reclassify(raster):
     REFERENCES:
         LANDSAT DSWE Product Guide, pg. 10
     '''
-    # VALID observations: NOT no data or cloud/snow
-    valid = np.ones(np.shape(raster))
-    valid[(raster == 9)|(raster == 255)] = 0
-
-    # NO INUNDATION: nonwater
-    nonwater = (raster == 0).astype(float)
-
-    # OPEN SURFACE WATER: water, high/mod confidence
-    open_sw = ((raster == 1)|(raster == 2)).astype(float)
-
-    # PARTIAL SURFACE WATER: wetland, water low confidence
-    partial_sw = ((raster == 3)|(raster == 4)).astype(float)
-    return open_sw, partial_sw, nonwater, valid
+    classes = RECLASS_TABLE[raster]
+    return classes
 
 
 def calculate_proportion(data, total):
@@ -258,38 +394,233 @@ def calculate_proportion(data, total):
     return proportion
 
 
-def create_output_file(data, data_str, prop_dir, time_str, geo_transform, projection):
+def output_path(data_str, prop_dir, time_str):
+    '''
+    Path to the output file of data_str for a time period.
+    '''
+    filename = time_str + '_' + data_str + '_proportion.tif'
+    return os.path.join(prop_dir, filename)
+
+
+def create_output_file(data_str, prop_dir, time_str, grid):
     '''
-    Creates output file for data in designated directory
+    Creates output file covering the grid in designated
+    directory, filled with no data (255); data is written to
+    it with write_output_window
     INPUTS:
-        data : numpy array : processed raster data
         data_str : str : string corresponding with type of data
         prop_dir : str : path to output directory
         time_str : str : time period for filename
-        geo_transform : tuple : raster positions related to
-            georeferences coordinates by affine transform
-        projection : list : GDAL projection metadata
+        grid : dict : grid of the output; see make_grid
     RETURNS:
-        output file in output_dir
+        file_path : str : path to output file in prop_dir
     '''
-    # create output filename
-    filename = time_str + '_' + data_str + '_proportion.tif'
-    file_path = os.path.join(prop_dir, filename)
-
-    i = 1
-    while os.path.isfile(file_path):
-        # file already exists
-        filename = time_str + '_' + data_str + f'_proportion({i})' + '.tif'
-        file_path = os.path.join(prop_dir, filename)
-        i += 1
-
-    shape = data.shape
+    # create output filename; an existing output of the
+        # same period is overwritten
+    file_path = output_path(data_str, prop_dir, time_str)
+    n_rows, n_cols = grid['shape']
 
     # create output file
     driver = gdal.GetDriverByName('GTiff') # save as geotiff
-    outdata = driver.Create(file_path, shape[1], shape[0], 1, gdal.GDT_Byte)
-    outdata.SetGeoTransform(geo_transform)
-    outdata.SetProjection(projection)
+    outdata = driver.Create(file_path, n_cols, n_rows, 1, gdal.GDT_Byte,
+                                ['TILED=YES'])
+    outdata.SetGeoTransform(grid['geo_transform'])
+    outdata.SetProjection(grid['projection'])
     outdata.GetRasterBand(1).SetNoDataValue(255)
-    outdata.GetRasterBand(1).WriteArray(data)
+    outdata.GetRasterBand(1).Fill(255)
+    outdata.FlushCache()
+    return file_path
+
+
+def write_output_window(file_path, data, window):
+    '''
+    Write data into a window of an output file.
+    INPUTS:
+        file_path : str : path to output file; see
+            create_output_file
+        data : numpy array : processed raster data
+        window : tuple of slice : (rows, cols) position of
+            data in the output file
+    RETURNS:
+        data written to the output file
+    '''
+    outdata = gdal.Open(file_path, gdal.GA_Update)
+    outdata.GetRasterBand(1).WriteArray(data, window[1].start,
+                                            window[0].start)
+    outdata.FlushCache()
+
+
+def build_mosaic(files, file_path, virtual=False):
+    '''
+    Mosaic output files of the same time period with a VRT,
+    where each file is a source with 255 as no data, so later
+    files are only used where they have data. The VRT is then
+    translated to a tiled, compressed GeoTIFF in one streamed,
+    multithreaded pass, or kept as the mosaic.
+    INPUTS:
+        files : list of str : paths to the output files to mosaic
+        file_path : str : path to the mosaic GeoTIFF
+    OPTIONAL INPUTS:
+        virtual : bool : if True, only write the VRT (next to
+            file_path, with a .vrt extension)
+    RETURNS:
+        mosaic_path : str : path to the mosaic
+    '''
+    vrt_options = gdal.BuildVRTOptions(srcNodata=255, VRTNodata=255)
+    if virtual:
+        vrt_path = os.path.splitext(file_path)[0] + '.vrt'
+        vrt = gdal.BuildVRT(vrt_path, files, options=vrt_options)
+        vrt.FlushCache()
+        return vrt_path
+
+    # the VRT is kept in memory and read block by block
+    vrt = gdal.BuildVRT('', files, options=vrt_options)
+    translate_options = gdal.TranslateOptions(format='GTiff',
+                            creationOptions=MOSAIC_OPTIONS)
+    outdata = gdal.Translate(file_path + '.tmp', vrt,
+                                options=translate_options)
+    outdata.FlushCache()
+    outdata = None
+    os.replace(file_path + '.tmp', file_path)
+    return file_path
+
+
+def merge_mosaic(files, file_path, threads=1):
+    '''
+    Mosaic output files of the same time period with gdal_merge,
+    which composites the files block by block into a tiled,
+    compressed GeoTIFF initialized to 255; later files are only
+    used where they have data.
+    INPUTS:
+        files : list of str : paths to the output files to mosaic
+        file_path : str : path to the mosaic GeoTIFF
+    OPTIONAL INPUTS:
+        threads : int : number of threads gdal_merge composites
+            the files on
+    RETURNS:
+        mosaic_path : str : path to the mosaic
+    '''
+    # gdal_merge updates an existing output file, so a file left
+        # by an interrupted run is removed first
+    tmp_path = file_path + '.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    argv = ['', '-q', '-o', tmp_path, '-of', 'GTiff', '-init', '255',
+            '-n', '255', '-a_nodata', '255', '-threads', str(threads)]
+    for option in MOSAIC_OPTIONS:
+        argv += ['-co', option]
+    gdal_merge.main(argv + files)
+    os.replace(tmp_path, file_path)
+    return file_path
+
+
+def counts_path(prop_dir, time_str):
+    '''
+    Path to the saved counts of a time period.
+    '''
+    return os.path.join(prop_dir, COUNTS_DIR, time_str + '_counts.tif')
+
+
+def manifest_grid(grid):
+    '''
+    Grid in the form it is stored in the manifest (see
+    read_manifest), so that it can be compared with it.
+    '''
+    return {'geo_transform': list(grid['geo_transform']),
+            'projection': grid['projection'],
+            'shape': list(grid['shape'])}
+
+
+def read_manifest(prop_dir):
+    '''
+    Read the manifest of the counts saved in prop_dir.
+    INPUTS:
+        prop_dir : str : path to output directory
+    RETURNS:
+        manifest : dict : 'grid' of the saved counts (see
+            manifest_grid; None if nothing is saved) and 'periods',
+            with time_str as keys and the sorted names of the files
+            counted in that period as values
+    '''
+    file_path = os.path.join(prop_dir, COUNTS_DIR, MANIFEST_NAME)
+    if not os.path.isfile(file_path):
+        return {'grid': None, 'periods': {}}
+    with open(file_path) as f:
+        return json.load(f)
+
+
+def write_manifest(prop_dir, manifest):
+    '''
+    Write the manifest of the counts saved in prop_dir; see
+    read_manifest.
+    '''
+    file_path = os.path.join(prop_dir, COUNTS_DIR, MANIFEST_NAME)
+    with open(file_path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(file_path + '.tmp', file_path)
+
+
+def create_counts_file(prop_dir, time_str, grid, base=False):
+    '''
+    Create a temporary file to save the counts of a time period
+    in; see save_counts_file.
+    INPUTS:
+        prop_dir : str : path to output directory
+        time_str : str : time period for filename
+        grid : dict : grid of the output; see make_grid
+    OPTIONAL INPUTS:
+        base : bool : if True, start from a copy of the counts
+            saved by an earlier run
+    RETURNS:
+        file_path : str : path to temporary counts file; bands
+            are open_sw, partial_sw, nonwater and total counts
+    '''
+    os.makedirs(os.path.join(prop_dir, COUNTS_DIR), exist_ok=True)
+    file_path = counts_path(prop_dir, time_str) + '.tmp'
+    if base:
+        shutil.copyfile(counts_path(prop_dir, time_str), file_path)
+        return file_path
+
+    n_rows, n_cols = grid['shape']
+    driver = gdal.GetDriverByName('GTiff')
+    outdata = driver.Create(file_path, n_cols, n_rows, 4, gdal.GDT_UInt16,
+                                ['TILED=YES'])
+    outdata.SetGeoTransform(grid['geo_transform'])
+    outdata.SetProjection(grid['projection'])
+    outdata.FlushCache()
+    return file_path
+
+
+def read_counts_window(file_path, window):
+    '''
+    Read a window of all bands of a counts file.
+    RETURNS:
+        counts : list of numpy array : open_sw, partial_sw,
+            nonwater and total counts
+    '''
+    data = gdal.Open(file_path)
+    rows, cols = window
+    return [data.GetRasterBand(band).ReadAsArray(cols.start, rows.start,
+                    cols.stop - cols.start, rows.stop - rows.start)
+                for band in range(1, 5)]
+
+
+def write_counts_window(file_path, counts, window):
+    '''
+    Write open_sw, partial_sw, nonwater and total counts into
+    a window of a counts file.
+    '''
+    outdata = gdal.Open(file_path, gdal.GA_Update)
+    for band, data in enumerate(counts, start=1):
+        outdata.GetRasterBand(band).WriteArray(data, window[1].start,
+                                                window[0].start)
     outdata.FlushCache()
+
+
+def save_counts_file(prop_dir, time_str):
+    '''
+    Replace the saved counts of a time period with the
+    temporary counts file written by this run.
+    '''
+    file_path = counts_path(prop_dir, time_str)
+    os.replace(file_path + '.tmp', file_path)